@@ -2,23 +2,85 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
+import asyncio
+import os
+import time
+
+import crud, models, metrics
+from cache import TTLCache
+from database import get_db
 
 SECRET_KEY = "your-secret-key"  # In a real app, use a more secure key and load from config
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Hashes made with any other cost are flagged by needs_update and rehashed on the next login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+# bcrypt runs on its own small pool instead of the shared request threadpool, so a burst of
+# logins queues here rather than starving the transaction endpoints
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+_pending_hashes = 0
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login_business")
 
+# Decoded tokens (token -> email) and authenticated businesses (email -> Business), so most
+# authenticated requests skip both the JWT decode and the database lookup
+AUTH_CACHE_TTL_SECONDS = int(os.getenv("AUTH_CACHE_TTL_SECONDS", "300"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+token_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL_SECONDS)
+business_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL_SECONDS)
+
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+def _record_pending(pending: int):
+    metrics.set_value("password_hash_in_flight", pending)
+    metrics.set_value("password_hash_queue_depth", max(0, pending - PASSWORD_HASH_WORKERS))
+
+async def _run_in_password_executor(func, *args):
+    # Only touched from the event loop, so the counter needs no lock
+    global _pending_hashes
+    if _pending_hashes >= PASSWORD_HASH_MAX_PENDING:
+        metrics.increment("password_hash_rejected_total")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many login attempts in progress, please retry",
+            headers={"Retry-After": "1"},
+        )
+    _pending_hashes += 1
+    _record_pending(_pending_hashes)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, func, *args)
+    finally:
+        _pending_hashes -= 1
+        _record_pending(_pending_hashes)
+        metrics.increment("password_hash_total")
+
+async def verify_password_async(plain_password, hashed_password) -> Tuple[bool, Optional[str]]:
+    """Verify on the password executor; returns (valid, new_hash) where new_hash is set when the cost changed"""
+    return await _run_in_password_executor(pwd_context.verify_and_update, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    return await _run_in_password_executor(pwd_context.hash, password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -28,3 +90,39 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
+
+def get_current_business(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    email = token_cache.get(token)
+    if email is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            email: str = payload.get("sub")
+            if email is None:
+                raise credentials_exception
+        except JWTError:
+            raise credentials_exception
+        # Never keep a token cached past its own expiry
+        token_cache.set(token, email, ttl_seconds=payload["exp"] - time.time() if "exp" in payload else None)
+
+    business = business_cache.get(email)
+    if business is None:
+        business = crud.get_business_by_email(db, email=email)
+        if business is None:
+            raise credentials_exception
+        # Detach it so the cached copy outlives this request's session
+        db.expunge(business)
+        business_cache.set(email, business)
+    return business
+
+@event.listens_for(models.Business, "after_update")
+@event.listens_for(models.Business, "after_delete")
+def invalidate_cached_business(mapper, connection, target):
+    business_cache.pop(target.email)
+    # Also drop the entry under the previous email if it just changed
+    for old_email in inspect(target).attrs.email.history.deleted or ():
+        business_cache.pop(old_email)
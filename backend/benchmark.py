@@ -0,0 +1,1013 @@
+"""
+Micro-benchmarks for the loyalty backend hot paths.
+Each benchmark runs against a throwaway SQLite database so the real loyalty.db is never touched.
+
+Usage: python benchmark.py <benchmark> [--rows N] [--seconds S]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+
+import models, schemas, crud, crud_loyalty_programs
+from database import Base, SQLITE_PROFILE, make_engine, make_async_engine
+
+
+def temp_database(profile=SQLITE_PROFILE):
+    """Create a fresh database in a temporary directory and return (SessionLocal, directory)"""
+    directory = tempfile.mkdtemp(prefix="loyalty-bench-")
+    engine = make_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}", profile)
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine), directory
+
+
+def run_threads(count, target, seconds):
+    """Run target(stop_event) in count threads for the given time and return the summed op counts"""
+    stop = threading.Event()
+    results = [0] * count
+
+    def worker(slot):
+        results[slot] = target(stop)
+
+    threads = [threading.Thread(target=worker, args=(slot,)) for slot in range(count)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return sum(results)
+
+
+def seed_business(db, program_type=models.LoyaltyProgramType.POINTS):
+    business = models.Business(
+        name="Bench Store", contact_person="Bench", email=f"bench-{random.random()}@example.com",
+        password_hash="x", loyalty_rate=1.0
+    )
+    db.add(business)
+    db.flush()
+    program = models.LoyaltyProgram(
+        business_id=business.id, name="Bench Program", program_type=program_type,
+        description="Benchmark program", earn_rate=1.0
+    )
+    db.add(program)
+    db.flush()
+    if program_type == models.LoyaltyProgramType.TIERED:
+        for name, min_points, multiplier in [("Bronze", 0, 1.0), ("Silver", 500, 1.25), ("Gold", 2000, 1.5)]:
+            db.add(models.TierLevel(
+                loyalty_program_id=program.id, name=name, min_points=min_points,
+                benefits=name, multiplier=multiplier
+            ))
+    db.commit()
+    return business.id, program.id
+
+
+def sample_transactions(business_id, program_id, rows, customers=500):
+    return [
+        schemas.TransactionCreate(
+            business_id=business_id,
+            customer_phone_number=f"+26377{random.randrange(customers):07d}",
+            amount_spent=round(random.uniform(1, 200), 2),
+            loyalty_program_id=program_id
+        )
+        for _ in range(rows)
+    ]
+
+
+def report(label, rows, seconds):
+    print(f"  {label:<28} {rows:>7} rows in {seconds:7.3f}s  ->  {rows / seconds:10.0f} rows/s")
+
+
+def bench_bulk_transactions(args):
+    """Single-row process_transaction vs process_transactions_bulk"""
+    for program_type in models.LoyaltyProgramType:
+        if program_type == models.LoyaltyProgramType.REFERRAL:
+            continue
+        print(f"{program_type.value} program:")
+        for label, bulk in [("process_transaction", False), ("process_transactions_bulk", True)]:
+            SessionLocal, directory = temp_database()
+            try:
+                db = SessionLocal()
+                business_id, program_id = seed_business(db, program_type)
+                transactions = sample_transactions(business_id, program_id, args.rows)
+                start = time.perf_counter()
+                if bulk:
+                    for offset in range(0, len(transactions), args.batch_size):
+                        crud_loyalty_programs.process_transactions_bulk(
+                            db, transactions[offset:offset + args.batch_size]
+                        )
+                else:
+                    for transaction in transactions:
+                        crud_loyalty_programs.process_transaction(db, transaction)
+                report(label, args.rows, time.perf_counter() - start)
+                db.close()
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_sqlite_profile(args):
+    """Write-only and mixed read/write throughput under the default and production SQLite profiles"""
+    for profile in ["default", "production"]:
+        SessionLocal, directory = temp_database(profile)
+        try:
+            db = SessionLocal()
+            business_id, _ = seed_business(db)
+            db.close()
+            read_engine = make_engine(
+                f"sqlite:///{os.path.join(directory, 'bench.db')}", profile, read_only=True
+            )
+            ReadSessionLocal = sessionmaker(bind=read_engine)
+
+            def writer(stop):
+                db = SessionLocal()
+                done = 0
+                while not stop.is_set():
+                    crud.add_points(db, schemas.TransactionCreate(
+                        business_id=business_id,
+                        customer_phone_number=f"+26377{random.randrange(1000):07d}",
+                        amount_spent=round(random.uniform(1, 200), 2)
+                    ))
+                    done += 1
+                db.close()
+                return done
+
+            def reader(stop):
+                db = ReadSessionLocal()
+                done = 0
+                while not stop.is_set():
+                    db.query(func.sum(models.Transaction.amount_spent)).filter(
+                        models.Transaction.business_id == business_id
+                    ).scalar()
+                    db.rollback()
+                    done += 1
+                db.close()
+                return done
+
+            print(f"{profile} profile:")
+            writes = run_threads(args.writers, writer, args.seconds)
+            print(f"  write-only      {writes / args.seconds:10.0f} writes/s ({args.writers} writers)")
+            stop_reads = threading.Event()
+            read_counts = []
+            read_threads = [
+                threading.Thread(target=lambda: read_counts.append(reader(stop_reads)))
+                for _ in range(args.readers)
+            ]
+            for thread in read_threads:
+                thread.start()
+            writes = run_threads(args.writers, writer, args.seconds)
+            stop_reads.set()
+            for thread in read_threads:
+                thread.join()
+            print(f"  mixed           {writes / args.seconds:10.0f} writes/s, "
+                  f"{sum(read_counts) / args.seconds:10.0f} reads/s ({args.readers} readers)")
+            read_engine.dispose()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def seed_transaction_history(SessionLocal, customers, transactions_per_customer):
+    """Seed a business with customers that each have some transaction history; returns their phone numbers"""
+    db = SessionLocal()
+    business_id, program_id = seed_business(db)
+    phones = [f"+26377{i:07d}" for i in range(customers)]
+    crud_loyalty_programs.process_transactions_bulk(db, [
+        schemas.TransactionCreate(
+            business_id=business_id, customer_phone_number=phone,
+            amount_spent=round(random.uniform(1, 200), 2), loyalty_program_id=program_id
+        )
+        for phone in phones for _ in range(transactions_per_customer)
+    ])
+    db.close()
+    return phones
+
+
+async def measure_concurrently(conversation, phones):
+    """Run one conversation per phone number concurrently while a ticker measures event loop stalls"""
+    stalls = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            before = time.perf_counter()
+            await asyncio.sleep(0.001)
+            stalls.append(time.perf_counter() - before - 0.001)
+
+    ticker_task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    await asyncio.gather(*(conversation(phone) for phone in phones))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await ticker_task
+    return elapsed, max(stalls, default=0.0)
+
+
+def bench_mcp_concurrency(args):
+    """Concurrent MCP tool calls on a sync Session inside async handlers vs an AsyncSession"""
+    from routers import mcp_server
+
+    SessionLocal, directory = temp_database()
+    try:
+        url = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        phones = seed_transaction_history(SessionLocal, args.conversations, 20)
+        AsyncSessionLocal = async_sessionmaker(make_async_engine(url), expire_on_commit=False)
+
+        async def blocking_conversation(phone):
+            # What the tools did before: synchronous queries straight on the event loop
+            db = SessionLocal()
+            try:
+                crud.get_customer_points(db, phone)
+                customer = db.query(models.Customer).filter(models.Customer.phone_number == phone).first()
+                transactions = db.query(models.Transaction).filter(
+                    models.Transaction.customer_id == customer.id
+                ).order_by(models.Transaction.timestamp.desc()).limit(20).all()
+                [tx.business.name for tx in transactions]
+                db.query(models.Transaction).filter(models.Transaction.customer_id == customer.id).all()
+            finally:
+                db.close()
+
+        async def async_conversation(phone):
+            async with AsyncSessionLocal() as db:
+                parameters = {"phone_number": phone}
+                await mcp_server.execute_check_points(parameters, db)
+                await mcp_server.execute_get_customer_transactions(parameters, db)
+                await mcp_server.execute_get_analytics(parameters, db)
+
+        print(f"{len(phones)} concurrent conversations (check_points, get_customer_transactions, get_analytics):")
+        for label, conversation in [("sync Session", blocking_conversation), ("AsyncSession", async_conversation)]:
+            elapsed, worst_stall = asyncio.run(measure_concurrently(conversation, phones))
+            print(f"  {label:<14} {elapsed:7.3f}s total, {len(phones) / elapsed:8.0f} conversations/s, "
+                  f"longest event loop stall {worst_stall * 1000:8.1f} ms")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_auth(args):
+    """Per-request latency of /transactions/add_points with and without the auth cache"""
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    import auth
+    from database import get_db
+    from routers import loyalty
+
+    SessionLocal, directory = temp_database()
+    try:
+        db = SessionLocal()
+        business_id, _ = seed_business(db)
+        email = db.query(models.Business.email).filter(models.Business.id == business_id).scalar()
+        db.close()
+
+        def override_get_db():
+            db = SessionLocal()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        app = FastAPI()
+        app.include_router(loyalty.router)
+        app.dependency_overrides[get_db] = override_get_db
+        client = TestClient(app)
+        headers = {"Authorization": f"Bearer {auth.create_access_token({'sub': email})}"}
+
+        print(f"{args.rows} requests to /transactions/add_points:")
+        timings = {}
+        for label, cached in [("uncached", False), ("cached", True)]:
+            auth.token_cache.clear()
+            auth.business_cache.clear()
+            start = time.perf_counter()
+            for _ in range(args.rows):
+                if not cached:
+                    auth.token_cache.clear()
+                    auth.business_cache.clear()
+                response = client.post("/transactions/add_points", headers=headers, json={
+                    "business_id": business_id,
+                    "customer_phone_number": f"+26377{random.randrange(1000):07d}",
+                    "amount_spent": round(random.uniform(1, 200), 2)
+                })
+                assert response.status_code == 200, response.text
+            timings[label] = (time.perf_counter() - start) / args.rows
+            print(f"  {label:<10} {timings[label] * 1000:8.3f} ms/request")
+        print(f"  saved      {(timings['uncached'] - timings['cached']) * 1000:8.3f} ms/request")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_customer_points(args):
+    """get_customer_points latency as the number of businesses on the platform grows"""
+    def full_scan_customer_points(db, phone_number):
+        # What get_customer_points did before: load every business to name five transactions
+        customer = db.query(models.Customer).filter(models.Customer.phone_number == phone_number).first()
+        transactions = db.query(models.Transaction).filter(
+            models.Transaction.customer_id == customer.id
+        ).order_by(models.Transaction.timestamp.desc()).limit(5).all()
+        business_map = {b.id: b.name for b in db.query(models.Business).all()}
+        return [business_map.get(t.business_id, "Unknown") for t in transactions]
+
+    print(f"{args.rows} lookups per platform size:")
+    for businesses in [10, 1000, 10000]:
+        SessionLocal, directory = temp_database()
+        try:
+            db = SessionLocal()
+            db.add_all([
+                models.Business(
+                    name=f"Store {i}", contact_person="Bench", email=f"store-{i}@example.com",
+                    password_hash="x", loyalty_rate=1.0
+                )
+                for i in range(businesses)
+            ])
+            db.flush()
+            phones = [f"+26377{i:07d}" for i in range(200)]
+            customers = [models.Customer(phone_number=phone, total_points=0) for phone in phones]
+            db.add_all(customers)
+            db.flush()
+            db.add_all([
+                models.Transaction(
+                    business_id=random.randrange(1, businesses + 1), customer_id=customer.id,
+                    amount_spent=10, points_earned=10
+                )
+                for customer in customers for _ in range(10)
+            ])
+            db.commit()
+
+            timings = []
+            for lookup in [full_scan_customer_points, crud.get_customer_points]:
+                crud.business_name_cache.clear()
+                start = time.perf_counter()
+                for _ in range(args.rows):
+                    lookup(db, random.choice(phones))
+                timings.append((time.perf_counter() - start) / args.rows * 1000)
+            print(f"  {businesses:>6} businesses   full scan {timings[0]:8.3f} ms/lookup   "
+                  f"cached names {timings[1]:8.3f} ms/lookup")
+            db.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_available_rewards(args):
+    """Available rewards for customers with dozens of memberships: query per membership vs reward index"""
+    def per_membership_rewards(db, phone_number):
+        # What the endpoints did before: one Reward query per membership
+        customer = db.query(models.Customer).filter(models.Customer.phone_number == phone_number).first()
+        memberships = db.query(models.CustomerMembership).filter(
+            models.CustomerMembership.customer_id == customer.id
+        ).all()
+        return [
+            reward
+            for membership in memberships
+            for reward in db.query(models.Reward).filter(
+                models.Reward.loyalty_program_id == membership.loyalty_program_id,
+                models.Reward.is_active == True,
+                models.Reward.points_required <= membership.points
+            ).all()
+        ]
+
+    def indexed_rewards(db, phone_number):
+        return crud_loyalty_programs.get_available_rewards_for_customer(db, phone_number)
+
+    for memberships in [5, 20, 50]:
+        SessionLocal, directory = temp_database()
+        try:
+            db = SessionLocal()
+            program_ids = [seed_business(db)[1] for _ in range(memberships)]
+            db.add_all([
+                models.Reward(
+                    loyalty_program_id=program_id, name=f"Reward {points}", description="Bench",
+                    points_required=points, is_active=True
+                )
+                for program_id in program_ids for points in range(100, 2100, 100)
+            ])
+            phones = [f"+26377{i:07d}" for i in range(100)]
+            customers = [models.Customer(phone_number=phone, total_points=0) for phone in phones]
+            db.add_all(customers)
+            db.flush()
+            db.add_all([
+                models.CustomerMembership(
+                    customer_id=customer.id, loyalty_program_id=program_id, points=random.randrange(2500)
+                )
+                for customer in customers for program_id in program_ids
+            ])
+            db.commit()
+
+            timings = []
+            for lookup in [per_membership_rewards, indexed_rewards]:
+                crud_loyalty_programs.reward_index.clear()
+                start = time.perf_counter()
+                for _ in range(args.rows):
+                    lookup(db, random.choice(phones))
+                timings.append((time.perf_counter() - start) / args.rows * 1000)
+            print(f"  {memberships:>3} memberships   query per membership {timings[0]:8.3f} ms/lookup   "
+                  f"reward index {timings[1]:8.3f} ms/lookup")
+            db.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_rollups(args):
+    """Dashboard totals from a scan of the transactions vs from the hourly rollups, as history grows"""
+    import datetime
+    from sqlalchemy import insert
+    import rollups
+
+    print(f"{args.rows} total_points_issued + revenue total lookups per history size:")
+    for history in [10_000, 100_000, 1_000_000]:
+        SessionLocal, directory = temp_database()
+        try:
+            db = SessionLocal()
+            business_id, program_id = seed_business(db)
+            start = datetime.datetime.utcnow() - datetime.timedelta(days=365)
+            for offset in range(0, history, 100_000):
+                db.execute(insert(models.Transaction), [
+                    {
+                        "business_id": business_id, "customer_id": i % 5000, "loyalty_program_id": program_id,
+                        "amount_spent": 10.0, "points_earned": 10, "transaction_type": models.TransactionType.EARN,
+                        "timestamp": start + datetime.timedelta(seconds=i * 365 * 86400 // history)
+                    }
+                    for i in range(offset, min(offset + 100_000, history))
+                ])
+            db.commit()
+            rollups.backfill(db)
+
+            def scan():
+                db.query(func.sum(models.Transaction.points_earned)).filter(
+                    models.Transaction.business_id == business_id, models.Transaction.points_earned > 0
+                ).scalar()
+                db.query(func.sum(models.Transaction.amount_spent)).filter(
+                    models.Transaction.business_id == business_id
+                ).scalar()
+
+            def rolled_up():
+                totals = rollups.totals(db, business_id)
+                return totals.points_issued, totals.revenue
+
+            timings = []
+            for lookup in [scan, rolled_up]:
+                begin = time.perf_counter()
+                for _ in range(args.rows):
+                    lookup()
+                timings.append((time.perf_counter() - begin) / args.rows * 1000)
+            print(f"  {history:>9} transactions   scan {timings[0]:9.3f} ms   rollups {timings[1]:7.3f} ms")
+            db.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_revenue_trend(args):
+    """Six-month revenue trend: Python grouping loop vs GROUP BY on timebuckets vs hourly rollups"""
+    import datetime
+    from sqlalchemy import insert
+    import rollups, timebuckets
+
+    SessionLocal, directory = temp_database()
+    try:
+        db = SessionLocal()
+        business_id, program_id = seed_business(db)
+        history = args.transactions
+        now = datetime.datetime.utcnow()
+        start = now - datetime.timedelta(days=180)
+        for offset in range(0, history, 100_000):
+            db.execute(insert(models.Transaction), [
+                {
+                    "business_id": business_id, "customer_id": i % 5000, "loyalty_program_id": program_id,
+                    "amount_spent": float(i % 200), "points_earned": i % 200,
+                    "transaction_type": models.TransactionType.EARN,
+                    "timestamp": start + datetime.timedelta(seconds=i * 180 * 86400 // history)
+                }
+                for i in range(offset, min(offset + 100_000, history))
+            ])
+        db.commit()
+        rollups.backfill(db)
+        since = now - datetime.timedelta(days=180)
+
+        def python_loop(tz):
+            # What revenue_stats did before: fetch every transaction and group by month in Python
+            transactions = db.query(models.Transaction.timestamp, models.Transaction.amount_spent).filter(
+                models.Transaction.business_id == business_id, models.Transaction.timestamp >= since
+            ).all()
+            zone = timebuckets.validate_timezone(tz)
+            monthly_data = {}
+            for txn in transactions:
+                local = txn.timestamp if tz == "UTC" else txn.timestamp.replace(tzinfo=datetime.timezone.utc).astimezone(zone)
+                month_key = local.strftime('%Y-%m')
+                monthly_data[month_key] = monthly_data.get(month_key, 0) + txn.amount_spent
+            return monthly_data
+
+        def sql_buckets(tz):
+            month = timebuckets.truncate(db, models.Transaction.timestamp, "month", tz, since=since)
+            return dict(db.query(month, func.sum(models.Transaction.amount_spent)).filter(
+                models.Transaction.business_id == business_id, models.Transaction.timestamp >= since
+            ).group_by(month).all())
+
+        def rollup_buckets(tz):
+            return rollups.series(
+                db, lambda column: timebuckets.truncate(db, column, "month", tz, since=since), "revenue",
+                business_id, since=since
+            )
+
+        print(f"{history} transactions over 180 days, monthly revenue trend:")
+        for tz in ["UTC", "Africa/Harare"]:
+            results = []
+            for label, trend in [("python loop", python_loop), ("SQL GROUP BY", sql_buckets), ("rollups", rollup_buckets)]:
+                begin = time.perf_counter()
+                results.append(trend(tz))
+                print(f"  {tz:<14} {label:<13} {(time.perf_counter() - begin) * 1000:10.1f} ms")
+            assert all(
+                abs(results[0][month] - result.get(month, 0)) < 1e-6 * results[0][month]
+                for result in results[1:] for month in results[0]
+            )
+        db.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def seed_customer_history(db, business_id, program_id, customers, transactions, days=365):
+    """Bulk insert customers 1..customers and transactions spread evenly over the last days"""
+    import datetime
+    from sqlalchemy import insert
+
+    db.execute(insert(models.Customer), [
+        {"id": i, "phone_number": f"+26377{i:07d}", "total_points": 0} for i in range(1, customers + 1)
+    ])
+    start = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    for offset in range(0, transactions, 100_000):
+        db.execute(insert(models.Transaction), [
+            {
+                "business_id": business_id, "customer_id": 1 + (i * 7919) % customers,
+                "loyalty_program_id": program_id, "amount_spent": float(i % 200), "points_earned": i % 200,
+                "transaction_type": models.TransactionType.EARN,
+                "timestamp": start + datetime.timedelta(seconds=i * days * 86400 // transactions)
+            }
+            for i in range(offset, min(offset + 100_000, transactions))
+        ])
+    db.commit()
+
+
+def bench_dashboard(args):
+    """The four analytics endpoints the dashboard used to call vs /analytics/dashboard, cold and cached"""
+    import rollups
+    from routers import extra
+
+    SessionLocal, directory = temp_database()
+    try:
+        db = SessionLocal()
+        business_id, program_id = seed_business(db)
+        customers, history = 5000, args.transactions
+        seed_customer_history(db, business_id, program_id, customers, history)
+        rollups.backfill(db)
+
+        def separate():
+            return {
+                "revenue_stats": extra.revenue_stats(business_id, program_id, "UTC", db),
+                "customer_insights": extra.customer_insights(business_id, program_id, db, approx=False),
+                "loyalty_performance": extra.loyalty_performance(business_id, program_id, db),
+                "business_health": extra.business_health(business_id, program_id, "UTC", db, approx=False),
+            }
+
+        def dashboard():
+            extra.dashboard_cache.clear()
+            return extra.analytics_dashboard(business_id, program_id, "UTC", db)
+
+        def cached():
+            return extra.analytics_dashboard(business_id, program_id, "UTC", db)
+
+        print(f"{history} transactions from {customers} customers, one dashboard load:")
+        for label, load in [("four endpoints", separate), ("dashboard", dashboard), ("dashboard (cached)", cached)]:
+            begin = time.perf_counter()
+            load()
+            print(f"  {label:<20} {(time.perf_counter() - begin) * 1000:10.1f} ms")
+        db.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_analytics_engine(args):
+    """Customer insights and distribution: SQL + Python engine vs the NumPy columnar engine"""
+    import datetime
+    from sqlalchemy import insert
+    import columnar
+    from routers import extra
+
+    SessionLocal, directory = temp_database()
+    try:
+        db = SessionLocal()
+        business_id, program_id = seed_business(db)
+        customers, history = 50_000, args.transactions
+        seed_customer_history(db, business_id, program_id, customers, history)
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+
+        def insights():
+            return vars(extra.customer_segments(db, business_id, program_id, since))
+
+        def distribution():
+            return extra.customer_distribution(db, business_id, program_id, 20)
+
+        def timed(engine, work):
+            columnar.ANALYTICS_ENGINE = engine
+            begin = time.perf_counter()
+            result = work()
+            return result, (time.perf_counter() - begin) * 1000
+
+        print(f"{history} transactions from {customers} customers:")
+        for label, work in [("customer insights", insights), ("customer distribution", distribution)]:
+            columnar.stores.clear()
+            expected, sql_ms = timed("sql", work)
+            _, cold_ms = timed("numpy", work)
+            result, warm_ms = timed("numpy", work)
+            assert result["customers"] == expected["customers"]
+            print(f"  {label:<22} SQL+Python {sql_ms:8.1f} ms   numpy cold {cold_ms:8.1f} ms   warm {warm_ms:7.1f} ms")
+
+        # New transactions are appended to the loaded columns rather than reloaded
+        now = datetime.datetime.utcnow()
+        db.execute(insert(models.Transaction), [
+            {
+                "business_id": business_id, "customer_id": 1 + i % customers, "loyalty_program_id": program_id,
+                "amount_spent": 10.0, "points_earned": 10, "transaction_type": models.TransactionType.EARN,
+                "timestamp": now
+            }
+            for i in range(args.rows)
+        ])
+        db.commit()
+        _, append_ms = timed("numpy", insights)
+        print(f"  insights after {args.rows} new transactions (append + compute): {append_ms:.1f} ms")
+        db.close()
+    finally:
+        columnar.ANALYTICS_ENGINE = os.getenv("ANALYTICS_ENGINE", "sql")
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_sketches(args):
+    """Distinct customers and the high value count: exact scans vs merged daily sketches, as history grows"""
+    import rollups, sketches
+    from routers import extra
+
+    for history in [100_000, args.transactions]:
+        SessionLocal, directory = temp_database()
+        try:
+            db = SessionLocal()
+            business_id, program_id = seed_business(db)
+            customers = 50_000
+            seed_customer_history(db, business_id, program_id, customers, history)
+            rollups.backfill(db)
+            begin = time.perf_counter()
+            days = sketches.rebuild(db)
+            print(f"{history} transactions from {customers} customers, {days} days sketched in {time.perf_counter() - begin:.1f}s:")
+
+            for label, endpoint, field in [
+                ("customer_count", extra.customer_count, "customer_count"),
+                ("customer_insights", extra.customer_insights, "high_value_customers"),
+            ]:
+                results, timings = [], []
+                for approx in [False, True]:
+                    begin = time.perf_counter()
+                    results.append(endpoint(business_id, program_id, db=db, approx=approx)[field])
+                    timings.append((time.perf_counter() - begin) * 1000)
+                error = (results[1] - results[0]) / results[0] * 100
+                print(f"  {label:<18} exact {timings[0]:8.1f} ms   approx {timings[1]:6.1f} ms   {field} off by {error:+.2f}%")
+            db.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_tiered_earn(args):
+    """Tiered-program sales: two tier queries and commits per sale vs the cached tier ladder"""
+    def per_sale_tier_queries(db, transaction):
+        # What process_transaction did before for a tiered program: query the tiers (and commit) before and after
+        def resolve_tier(customer_id, program_id):
+            membership = db.query(models.CustomerMembership).filter(
+                models.CustomerMembership.customer_id == customer_id,
+                models.CustomerMembership.loyalty_program_id == program_id
+            ).first()
+            tiers = db.query(models.TierLevel).filter(
+                models.TierLevel.loyalty_program_id == program_id
+            ).order_by(models.TierLevel.min_points.desc()).all()
+            tier = next((tier for tier in tiers if membership.points >= tier.min_points), None)
+            if tier:
+                membership.current_tier_id = tier.id
+                db.commit()
+            return tier
+
+        customer = db.query(models.Customer).filter(
+            models.Customer.phone_number == transaction.customer_phone_number
+        ).first()
+        if not customer:
+            customer = models.Customer(phone_number=transaction.customer_phone_number, total_points=0)
+            db.add(customer)
+            db.commit()
+        program = db.query(models.LoyaltyProgram).filter(models.LoyaltyProgram.id == transaction.loyalty_program_id).first()
+        membership = db.query(models.CustomerMembership).filter(
+            models.CustomerMembership.customer_id == customer.id,
+            models.CustomerMembership.loyalty_program_id == program.id
+        ).first()
+        if not membership:
+            membership = models.CustomerMembership(customer_id=customer.id, loyalty_program_id=program.id, points=0)
+            db.add(membership)
+            db.flush()
+        tier = resolve_tier(customer.id, program.id)
+        points_earned = int(int(transaction.amount_spent * program.earn_rate) * (tier.multiplier if tier else 1))
+        membership.points += points_earned
+        resolve_tier(customer.id, program.id)
+        customer.total_points += points_earned
+        db.add(models.Transaction(
+            business_id=transaction.business_id, customer_id=customer.id, loyalty_program_id=program.id,
+            amount_spent=transaction.amount_spent, points_earned=points_earned, tier_id=tier.id if tier else None,
+            transaction_type=models.TransactionType.EARN
+        ))
+        db.commit()
+
+    for label, process in [
+        ("tier queries per sale", per_sale_tier_queries),
+        ("cached tier ladder", crud_loyalty_programs.process_transaction),
+    ]:
+        SessionLocal, directory = temp_database()
+        try:
+            db = SessionLocal()
+            business_id, program_id = seed_business(db, models.LoyaltyProgramType.TIERED)
+            transactions = sample_transactions(business_id, program_id, args.rows)
+            crud_loyalty_programs.tier_ladder.clear()
+            start = time.perf_counter()
+            for transaction in transactions:
+                process(db, transaction)
+            report(label, args.rows, time.perf_counter() - start)
+            db.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_tier_recalculation(args):
+    """Recomputing a program's tiers: calculate_customer_tier per member vs tiers.py's set-based UPDATE"""
+    import tiers
+    from sqlalchemy import insert
+
+    for members in [10_000, 100_000, args.transactions]:
+        SessionLocal, directory = temp_database()
+        try:
+            db = SessionLocal()
+            business_id, program_id = seed_business(db, models.LoyaltyProgramType.TIERED)
+            for offset in range(0, members, 100_000):
+                ids = range(offset + 1, min(offset + 100_000, members) + 1)
+                db.execute(insert(models.Customer), [
+                    {"id": i, "phone_number": f"+26377{i:07d}", "total_points": 0} for i in ids
+                ])
+                db.execute(insert(models.CustomerMembership), [
+                    {"customer_id": i, "loyalty_program_id": program_id, "points": (i * 7919) % 3000} for i in ids
+                ])
+            db.commit()
+            tiers.recalculate_program(db, program_id)
+
+            # Raise the Silver threshold so about a quarter of the members drop to Bronze
+            silver = db.query(models.TierLevel).filter(
+                models.TierLevel.loyalty_program_id == program_id, models.TierLevel.name == "Silver"
+            ).one()
+            silver.min_points = 1250
+            db.commit()
+
+            # Per member is far too slow for the big programs, so time the first --rows members and extrapolate
+            sample = min(args.rows, members)
+            start = time.perf_counter()
+            for customer_id in range(1, sample + 1):
+                crud_loyalty_programs.calculate_customer_tier(db, customer_id, program_id)
+            per_member = (time.perf_counter() - start) / sample * members
+
+            start = time.perf_counter()
+            result = tiers.recalculate_program(db, program_id)
+            elapsed = time.perf_counter() - start
+            print(f"  {members:>9} members   per member ~{per_member:9.1f}s   "
+                  f"set-based {elapsed:7.2f}s ({result.moved} moved)")
+            db.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_membership_sweep(args):
+    """Expiry sweep duration, and counting a program's paid members by end date vs by the swept flag"""
+    import datetime
+    import memberships
+    from sqlalchemy import insert
+
+    for members in [10_000, 100_000, args.transactions]:
+        SessionLocal, directory = temp_database()
+        try:
+            db = SessionLocal()
+            program_ids = [seed_business(db, models.LoyaltyProgramType.PAID)[1] for _ in range(4)]
+            now = datetime.datetime.utcnow()
+            for offset in range(0, members, 100_000):
+                ids = range(offset + 1, min(offset + 100_000, members) + 1)
+                db.execute(insert(models.Customer), [
+                    {"id": i, "phone_number": f"+26377{i:07d}", "total_points": 0} for i in ids
+                ])
+                # Ends spread over a year either side of now, so about a day's worth lapse between sweeps
+                db.execute(insert(models.CustomerMembership), [
+                    {
+                        "customer_id": i, "loyalty_program_id": program_ids[i % 4], "points": 0, "is_paid_member": True,
+                        "membership_end": now + datetime.timedelta(minutes=(i * 7919) % 1_051_200 - 525_600)
+                    }
+                    for i in ids
+                ])
+            db.commit()
+            memberships.sweep(db, now - datetime.timedelta(days=1))
+
+            start = time.perf_counter()
+            result = memberships.sweep(db, now)
+            sweep_seconds = time.perf_counter() - start
+
+            timings = []
+            for count in [
+                lambda: db.query(func.count(models.CustomerMembership.id)).filter(
+                    models.CustomerMembership.loyalty_program_id == program_ids[0],
+                    models.CustomerMembership.is_paid_member == True,
+                    models.CustomerMembership.membership_end > datetime.datetime.utcnow()
+                ).scalar(),
+                lambda: memberships.paid_member_count(db, program_ids[0]),
+            ]:
+                start = time.perf_counter()
+                for _ in range(20):
+                    count()
+                timings.append((time.perf_counter() - start) / 20 * 1000)
+            print(f"  {members:>9} members   sweep {sweep_seconds:6.3f}s ({result.expired} expired, "
+                  f"{result.reminders} reminders)   count by end date {timings[0]:8.2f} ms   "
+                  f"by flag {timings[1]:7.2f} ms")
+            db.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_ledger(args):
+    """Balance reads from the whole ledger vs snapshot plus tail, and reconciling every customer with the ledger"""
+    import datetime
+    import ledger
+    from sqlalchemy import insert, update
+
+    SessionLocal, directory = temp_database()
+    try:
+        db = SessionLocal()
+        business_id, program_id = seed_business(db)
+        customers = args.transactions
+        old = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        for offset in range(0, customers, 100_000):
+            ids = range(offset + 1, min(offset + 100_000, customers) + 1)
+            db.execute(insert(models.Customer), [
+                {"id": i, "phone_number": f"+26377{i:07d}", "total_points": 3 * (i % 50)} for i in ids
+            ])
+            db.execute(insert(models.CustomerMembership), [
+                {"customer_id": i, "loyalty_program_id": program_id, "points": 3 * (i % 50)} for i in ids
+            ])
+            # Three entries per customer, and a long history for customer 1
+            db.execute(insert(models.PointsLedgerEntry), [
+                {"customer_id": i, "loyalty_program_id": program_id, "points": i % 50, "reason": ledger.EARN, "created_at": old}
+                for i in ids for _ in range(3)
+            ])
+        db.execute(insert(models.PointsLedgerEntry), [
+            {"customer_id": 1, "loyalty_program_id": program_id, "points": points, "reason": ledger.EARN, "created_at": old}
+            for points in [5, -5] * 25_000
+        ])
+        db.commit()
+        print(f"  {customers} customers, {3 * customers + 50_000} ledger entries")
+
+        start = time.perf_counter()
+        ledger.snapshot(db)
+        print(f"  first snapshot                   {time.perf_counter() - start:8.2f}s")
+
+        def full_sum():
+            return db.query(func.sum(models.PointsLedgerEntry.points)).filter(
+                models.PointsLedgerEntry.customer_id == 1,
+                models.PointsLedgerEntry.loyalty_program_id == program_id
+            ).scalar()
+
+        for label, read in [("sum of all entries", full_sum),
+                            ("snapshot plus tail", lambda: ledger.balance(db, 1, program_id))]:
+            start = time.perf_counter()
+            for _ in range(100):
+                read()
+            print(f"  balance read, {label:<18} {(time.perf_counter() - start) * 10:8.3f} ms")
+
+        start = time.perf_counter()
+        result = ledger.reconcile(db)
+        print(f"  reconcile, no drift              {time.perf_counter() - start:8.2f}s "
+              f"({len(result.memberships) + len(result.customers)} found)")
+
+        # Drift one customer in a hundred
+        db.execute(update(models.Customer).where(models.Customer.id % 100 == 0).values(
+            total_points=models.Customer.total_points + 1
+        ))
+        db.commit()
+        start = time.perf_counter()
+        result = ledger.reconcile(db, repair=True)
+        print(f"  reconcile and repair             {time.perf_counter() - start:8.2f}s "
+              f"({result.repaired_customers} customers repaired)")
+        db.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_points_expiry(args):
+    """Expiring a month of points bucket by bucket through the ORM vs the set-based expiry job"""
+    import datetime
+    import expiry
+    import ledger
+    from sqlalchemy import insert
+
+    SessionLocal, directory = temp_database()
+    months = expiry.POINTS_EXPIRY_MONTHS
+    try:
+        db = SessionLocal()
+        business_id, program_id = seed_business(db)
+        # Two years of monthly buckets, one ledger entry behind each
+        members = max(args.transactions // 24, 1)
+        history = [expiry.add_months(datetime.date(2024, 1, 1), n) for n in range(24)]
+        for offset in range(0, members, 20_000):
+            ids = range(offset + 1, min(offset + 20_000, members) + 1)
+            db.execute(insert(models.Customer), [
+                {"id": i, "phone_number": f"+26377{i:07d}", "total_points": 24 * (i % 40)} for i in ids
+            ])
+            db.execute(insert(models.CustomerMembership), [
+                {"customer_id": i, "loyalty_program_id": program_id, "points": 24 * (i % 40)} for i in ids
+            ])
+            db.execute(insert(models.PointsLedgerEntry), [
+                {"customer_id": i, "loyalty_program_id": program_id, "points": i % 40, "reason": ledger.EARN,
+                 "created_at": datetime.datetime.combine(month, datetime.time())}
+                for i in ids for month in history
+            ])
+            db.execute(insert(models.PointsBucket), [
+                {"customer_id": i, "loyalty_program_id": program_id, "month": month,
+                 "earned": i % 40, "consumed": 0, "expired": 0}
+                for i in ids for month in history
+            ])
+        db.commit()
+        print(f"  {members} members, {members * 24} buckets and ledger entries")
+        expiry.POINTS_EXPIRY_MONTHS = 12
+
+        def bucket_by_bucket(now):
+            due = db.query(models.PointsBucket).filter(
+                models.PointsBucket.closed_at.is_(None), models.PointsBucket.month < expiry.expiry_cutoff(now)
+            ).all()
+            for bucket in due:
+                left = bucket.earned - bucket.consumed - bucket.expired
+                membership = db.query(models.CustomerMembership).filter_by(
+                    customer_id=bucket.customer_id, loyalty_program_id=bucket.loyalty_program_id
+                ).one()
+                membership.points -= left
+                db.get(models.Customer, bucket.customer_id).total_points -= left
+                ledger.post(db, bucket.customer_id, bucket.loyalty_program_id, -left, ledger.EXPIRY)
+                bucket.expired += left
+                bucket.closed_at = now
+            db.commit()
+            return len(due)
+
+        # Each run expires one month of buckets
+        for label, run, now in [("bucket by bucket (ORM)", bucket_by_bucket, datetime.datetime(2025, 1, 2)),
+                                ("expiry.expire", lambda now: expiry.expire(db, now).buckets, datetime.datetime(2025, 2, 2))]:
+            start = time.perf_counter()
+            buckets = run(now)
+            report(label, buckets, time.perf_counter() - start)
+        start = time.perf_counter()
+        report("expiry.expire, 11 months due", expiry.expire(db, datetime.datetime(2026, 1, 2)).buckets,
+               time.perf_counter() - start)
+        drift = ledger.reconcile(db)
+        print(f"  {len(drift.memberships) + len(drift.customers)} balances disagree with the ledger afterwards")
+        db.close()
+    finally:
+        expiry.POINTS_EXPIRY_MONTHS = months
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+BENCHMARKS = {
+    "analytics-engine": bench_analytics_engine,
+    "auth": bench_auth,
+    "available-rewards": bench_available_rewards,
+    "bulk-transactions": bench_bulk_transactions,
+    "customer-points": bench_customer_points,
+    "dashboard": bench_dashboard,
+    "ledger": bench_ledger,
+    "sketches": bench_sketches,
+    "sqlite-profile": bench_sqlite_profile,
+    "mcp-concurrency": bench_mcp_concurrency,
+    "points-expiry": bench_points_expiry,
+    "membership-sweep": bench_membership_sweep,
+    "revenue-trend": bench_revenue_trend,
+    "rollups": bench_rollups,
+    "tier-recalculation": bench_tier_recalculation,
+    "tiered-earn": bench_tiered_earn,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--transactions", type=int, default=1_000_000)
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
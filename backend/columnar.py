@@ -0,0 +1,193 @@
+"""
+Columnar, in-memory copies of each business's transactions for the analytics endpoints.
+The customer, amount, points and timestamp columns are held in NumPy arrays that are appended to
+as new transactions arrive (by id), so the per-customer insights are a few vectorized passes
+instead of SQL round trips and Python loops over the results.
+
+Selected with ANALYTICS_ENGINE=numpy; the default "sql" engine computes everything in the database.
+"""
+
+import datetime
+import os
+import threading
+from types import SimpleNamespace
+from typing import Optional, Sequence
+
+import numpy as np
+from sqlalchemy import String, cast, event, func
+from sqlalchemy.orm import Session
+
+import models
+from cache import TTLCache
+
+ANALYTICS_ENGINE = os.getenv("ANALYTICS_ENGINE", "sql")
+COLUMNAR_MAX_BUSINESSES = int(os.getenv("COLUMNAR_MAX_BUSINESSES", "100"))
+# Stores are rebuilt from scratch this often, which also picks up any transaction committed out of id order
+COLUMNAR_RELOAD_SECONDS = int(os.getenv("COLUMNAR_RELOAD_SECONDS", "3600"))
+LOAD_BATCH_SIZE = 50_000
+
+QUANTILES = (0.5, 0.8, 0.9, 0.99)
+
+
+class TransactionColumns:
+    """The transactions of one business as growable NumPy columns, ordered by id"""
+
+    DTYPES = {
+        "id": np.int64,
+        "customer_id": np.int64,
+        "program_id": np.int64,  # 0 when the transaction has no loyalty program
+        "amount": np.float64,
+        "points": np.int64,
+        "timestamp": "datetime64[us]",
+    }
+
+    def __init__(self, business_id: int, capacity: int = 1024):
+        self.business_id = business_id
+        self.size = 0
+        self.last_id = 0
+        self._columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in self.DTYPES.items()}
+        self._lock = threading.Lock()
+
+    def append(self, rows: Sequence[tuple]):
+        """Add (id, customer_id, program_id, amount, points, timestamp) rows, growing the arrays by doubling;
+        timestamps may be datetimes or ISO strings"""
+        if not rows:
+            return
+        end = self.size + len(rows)
+        capacity = len(self._columns["id"])
+        if end > capacity:
+            while capacity < end:
+                capacity *= 2
+            for name, column in self._columns.items():
+                grown = np.empty(capacity, dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                self._columns[name] = grown
+        # Readers only ever see [:size], so the rows become visible once size moves past them
+        for (name, dtype), values in zip(self.DTYPES.items(), zip(*rows)):
+            self._columns[name][self.size:end] = np.array(values, dtype=dtype)
+        self.size = end
+        self.last_id = int(self._columns["id"][end - 1])
+
+    def refresh(self, db: Session, batch_size: int = LOAD_BATCH_SIZE):
+        """Append the business's transactions with ids above the last one loaded"""
+        transaction = models.Transaction
+        with self._lock:
+            while True:
+                rows = db.query(
+                    transaction.id,
+                    transaction.customer_id,
+                    func.coalesce(transaction.loyalty_program_id, 0),
+                    func.coalesce(transaction.amount_spent, 0.0),
+                    func.coalesce(transaction.points_earned, 0),
+                    # As text: NumPy parses ISO timestamps far faster than it converts datetime objects
+                    cast(transaction.timestamp, String),
+                ).filter(
+                    transaction.business_id == self.business_id,
+                    transaction.customer_id.isnot(None),
+                    transaction.id > self.last_id,
+                ).order_by(transaction.id).limit(batch_size).all()
+                self.append(rows)
+                if len(rows) < batch_size:
+                    break
+
+    def snapshot(self, loyalty_program_id: Optional[int] = None):
+        """Views of the loaded columns, restricted to one program when given"""
+        with self._lock:
+            columns = {name: column[:self.size] for name, column in self._columns.items()}
+        if loyalty_program_id:
+            mask = columns["program_id"] == loyalty_program_id
+            columns = {name: column[mask] for name, column in columns.items()}
+        return SimpleNamespace(**columns)
+
+
+stores = TTLCache(maxsize=COLUMNAR_MAX_BUSINESSES, ttl_seconds=COLUMNAR_RELOAD_SECONDS)
+_stores_lock = threading.Lock()
+
+
+def columns_for(db: Session, business_id: int, loyalty_program_id: Optional[int] = None):
+    """Up-to-date columns of a business's transactions, loading or appending to its store as needed"""
+    with _stores_lock:
+        store = stores.get(business_id)
+        if store is None:
+            store = TransactionColumns(business_id)
+            stores.set(business_id, store)
+    store.refresh(db)
+    return store.snapshot(loyalty_program_id)
+
+
+@event.listens_for(models.Transaction, "after_update")
+@event.listens_for(models.Transaction, "after_delete")
+def invalidate_columns(mapper, connection, target):
+    # Transactions are append-only in practice; anything else rebuilds the business's store
+    stores.pop(target.business_id)
+
+
+def per_customer(columns, since: Optional[datetime.datetime] = None):
+    """Per-customer totals: (customer ids, transaction counts, recent counts, amount spent, points, inverse index)"""
+    customers, inverse = np.unique(columns.customer_id, return_inverse=True)
+    count = len(customers)
+    transactions = np.bincount(inverse, minlength=count)
+    if since is not None:
+        recent = np.bincount(inverse[columns.timestamp >= np.datetime64(since, "us")], minlength=count)
+    else:
+        recent = np.zeros(count, dtype=np.int64)
+    # In cents, so ties don't depend on the order the amounts were summed in
+    spent = np.round(np.bincount(inverse, weights=columns.amount, minlength=count), 2)
+    points = np.bincount(inverse, weights=columns.points, minlength=count)
+    return customers, transactions, recent, spent, points, inverse
+
+
+def high_value_count(spent: np.ndarray) -> int:
+    """Customers spending at least as much as the customer at the top-20% mark"""
+    if not len(spent):
+        return 0
+    position = len(spent) // 5
+    threshold = -np.partition(-spent, position)[position]
+    return int(np.count_nonzero(spent >= threshold))
+
+
+def customer_segments(db: Session, business_id: int, loyalty_program_id: Optional[int], since: datetime.datetime):
+    """The counts of the SQL customer_segments, computed over the columnar store"""
+    columns = columns_for(db, business_id, loyalty_program_id)
+    customers, transactions, recent, spent, points, _ = per_customer(columns, since)
+    return SimpleNamespace(
+        customers=len(customers),
+        new=int(np.count_nonzero(recent == 1)),
+        active=int(np.count_nonzero(recent > 0)),
+        repeat=int(np.count_nonzero(transactions > 1)),
+        with_points=int(np.count_nonzero(points > 0)),
+        high_value=high_value_count(spent),
+    )
+
+
+def customer_distribution(db: Session, business_id: int, loyalty_program_id: Optional[int], bins: int):
+    """Spending quantiles and histogram, repeat rate and monthly first-purchase cohorts of a business's customers"""
+    columns = columns_for(db, business_id, loyalty_program_id)
+    customers, transactions, _, spent, _, inverse = per_customer(columns)
+    if not len(customers):
+        return {"customers": 0, "repeat_rate": 0, "spending_quantiles": {}, "spending_histogram": [], "cohorts": []}
+
+    counts, edges = np.histogram(spent, bins=bins)
+    # Cohort = month of the first purchase; fmin skips missing timestamps
+    first_seen = np.full(len(customers), np.datetime64("NaT"), dtype="datetime64[us]")
+    np.fmin.at(first_seen, inverse, columns.timestamp)
+    seen = ~np.isnat(first_seen)
+    repeat = transactions > 1
+    months, cohort = np.unique(first_seen[seen].astype("datetime64[M]"), return_inverse=True)
+    cohort_sizes = np.bincount(cohort, minlength=len(months))
+    cohort_repeats = np.bincount(cohort, weights=repeat[seen], minlength=len(months))
+    return {
+        "customers": len(customers),
+        "repeat_rate": round(int(np.count_nonzero(repeat)) / len(customers) * 100, 2),
+        "spending_quantiles": {
+            f"p{round(q * 100)}": round(float(value), 2) for q, value in zip(QUANTILES, np.quantile(spent, QUANTILES))
+        },
+        "spending_histogram": [
+            {"from": round(float(low), 2), "to": round(float(high), 2), "customers": int(count)}
+            for low, high, count in zip(edges[:-1], edges[1:], counts)
+        ],
+        "cohorts": [
+            {"month": str(month), "customers": int(size), "repeat_customers": int(repeats)}
+            for month, size, repeats in zip(months, cohort_sizes, cohort_repeats)
+        ],
+    }
@@ -1,5 +1,35 @@
+from sqlalchemy import event, func
 from sqlalchemy.orm import Session
-import models, schemas
+import models, schemas, ledger
+import rollups  # keeps transaction_rollups current on every flush
+import expiry  # keeps points_buckets current on every flush
+from cache import TTLCache
+
+# Business id -> name for labelling transactions, shared by every request in the process
+business_name_cache = TTLCache(maxsize=50000, ttl_seconds=3600)
+
+@event.listens_for(models.Business, "after_update")
+@event.listens_for(models.Business, "after_delete")
+def invalidate_business_name(mapper, connection, target):
+    business_name_cache.pop(target.id)
+
+def get_business_names(db: Session, business_ids):
+    """Names for the given business ids, served from the cache with one IN query for the misses"""
+    names = {}
+    missing = set()
+    for business_id in set(business_ids):
+        name = business_name_cache.get(business_id)
+        if name is None:
+            missing.add(business_id)
+        else:
+            names[business_id] = name
+    if missing:
+        for business_id, name in db.query(models.Business.id, models.Business.name).filter(
+            models.Business.id.in_(missing)
+        ):
+            business_name_cache.set(business_id, name)
+            names[business_id] = name
+    return names
 
 def get_business_by_email(db: Session, email: str):
     return db.query(models.Business).filter(models.Business.email == email).first()
@@ -26,6 +56,34 @@ def set_loyalty_rate(db: Session, business_id: int, loyalty_rate: float):
     db.refresh(business)
     return business
 
+def update_business_password_hash(db: Session, business: models.Business, password_hash: str):
+    business.password_hash = password_hash
+    db.commit()
+    return business
+
+def credit_points(db: Session, customer: models.Customer, points: int):
+    """
+    Add points to a customer's total_points with an SQL-side increment, so concurrent earns and
+    redemptions never overwrite each other; the attribute reloads on next access
+    """
+    db.query(models.Customer).filter(models.Customer.id == customer.id).update(
+        {models.Customer.total_points: func.coalesce(models.Customer.total_points, 0) + points},
+        synchronize_session=False
+    )
+    db.expire(customer, ["total_points"])
+
+def debit_points(db: Session, customer: models.Customer, points: int) -> bool:
+    """Take points from a customer's total_points only if it covers them, checked and applied in one UPDATE"""
+    deducted = db.query(models.Customer).filter(
+        models.Customer.id == customer.id,
+        models.Customer.total_points >= points
+    ).update(
+        {models.Customer.total_points: models.Customer.total_points - points},
+        synchronize_session=False
+    )
+    db.expire(customer, ["total_points"])
+    return bool(deducted)
+
 def add_points(db: Session, transaction: 'schemas.TransactionCreate'):
     business = db.query(models.Business).filter(models.Business.id == transaction.business_id).first()
     if not business:
@@ -34,12 +92,10 @@ def add_points(db: Session, transaction: 'schemas.TransactionCreate'):
     if not customer:
         customer = models.Customer(phone_number=transaction.customer_phone_number, total_points=0)
         db.add(customer)
-        db.commit()
-        db.refresh(customer)
+        # Flushed, not committed: the customer commits with the earn (and any idempotency reservation)
+        db.flush()
     points_earned = int(transaction.amount_spent * business.loyalty_rate)
-    customer.total_points += points_earned
-    db.commit()
-    db.refresh(customer)
+    credit_points(db, customer, points_earned)
     db_transaction = models.Transaction(
         business_id=business.id,
         customer_id=customer.id,
@@ -47,6 +103,7 @@ def add_points(db: Session, transaction: 'schemas.TransactionCreate'):
         points_earned=points_earned
     )
     db.add(db_transaction)
+    ledger.post(db, customer.id, None, points_earned, ledger.EARN, db_transaction)
     db.commit()
     db.refresh(db_transaction)
     return db_transaction
@@ -60,14 +117,11 @@ def redeem_points(db: Session, redemption: 'schemas.RedemptionCreate'):
     if not customer:
         raise Exception("Customer not found")
     
-    # Check if customer has enough points
-    if customer.total_points < redemption.points_to_redeem:
-        raise Exception(f"Not enough points. Customer has {customer.total_points} points, but {redemption.points_to_redeem} were requested.")
-    
-    # Deduct points
-    customer.total_points -= redemption.points_to_redeem
-    db.commit()
-    db.refresh(customer)
+    if not debit_points(db, customer, redemption.points_to_redeem):
+        db.rollback()
+        # Re-read, as the balance loaded with the customer may be out of date by now
+        balance = db.query(models.Customer.total_points).filter(models.Customer.id == customer.id).scalar()
+        raise Exception(f"Not enough points. Customer has {balance} points, but {redemption.points_to_redeem} were requested.")
     
     # Record redemption transaction
     db_transaction = models.Transaction(
@@ -79,6 +133,7 @@ def redeem_points(db: Session, redemption: 'schemas.RedemptionCreate'):
         reward_description=redemption.reward_description
     )
     db.add(db_transaction)
+    ledger.post(db, customer.id, None, -redemption.points_to_redeem, ledger.REDEMPTION, db_transaction)
     db.commit()
     db.refresh(db_transaction)
     
@@ -88,8 +143,12 @@ def get_customer_points(db: Session, phone_number: str):
     customer = db.query(models.Customer).filter(models.Customer.phone_number == phone_number).first()
     if not customer:
         raise Exception("Customer not found")
+    return customer_points_summary(db, customer)
+
+def customer_points_summary(db: Session, customer: models.Customer):
+    """Balance and five most recent transactions of a customer the caller has already looked up"""
     transactions = db.query(models.Transaction).filter(models.Transaction.customer_id == customer.id).order_by(models.Transaction.timestamp.desc()).limit(5).all()
-    business_map = {b.id: b.name for b in db.query(models.Business).all()}
+    business_map = get_business_names(db, [t.business_id for t in transactions])
     recent_transactions = [
         {
             "business_name": business_map.get(t.business_id, "Unknown"),
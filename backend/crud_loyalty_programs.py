@@ -1,11 +1,20 @@
-from sqlalchemy.orm import Session
-import models, schemas, crud
-from typing import Union
+from sqlalchemy import bindparam, event, func, inspect, update
+from sqlalchemy.orm import Session, object_session
+import models, schemas, crud, ledger
+from cache import TTLCache
+from typing import List, Union
+import bisect
 import datetime
+import os
 import uuid
 import string
 import random
 
+# How long a program's tiers and rewards are served from memory. Changes made through this process take effect
+# at once; this bounds how long a change made elsewhere (another worker, a script) can go unseen
+PROGRAM_CACHE_TTL_SECONDS = int(os.getenv("PROGRAM_CACHE_TTL_SECONDS", "60"))
+PROGRAM_CACHE_SIZE = 10000
+
 # Helper to generate referral code
 def generate_referral_code(length=8):
     chars = string.ascii_uppercase + string.digits
@@ -136,6 +145,79 @@ def enroll_in_paid_membership(db: Session, customer_id: int, program_id: int):
     db.refresh(membership)
     return membership
 
+class TierLadder:
+    """Tier levels of each program, sorted by min_points, so resolving a balance's tier is a bisect"""
+
+    def __init__(self, maxsize: int = PROGRAM_CACHE_SIZE, ttl_seconds: float = PROGRAM_CACHE_TTL_SECONDS):
+        self._programs = TTLCache(maxsize, ttl_seconds)
+
+    def load(self, db: Session, program_ids):
+        """(min_points list, tiers list) per program id, loading the misses in one query"""
+        entries = {}
+        for pid in program_ids:
+            entry = self._programs.get(pid)
+            if entry is not None:
+                entries[pid] = entry
+        missing = set(program_ids) - set(entries)
+        if missing:
+            loaded = {pid: ([], []) for pid in missing}
+            rows = db.query(*models.TierLevel.__table__.columns).filter(
+                models.TierLevel.loyalty_program_id.in_(missing)
+            ).order_by(models.TierLevel.min_points, models.TierLevel.id).all()
+            for row in rows:
+                # Plain copies outside any session, so requests can share them safely
+                tier = models.TierLevel(**row._mapping)
+                thresholds, tiers = loaded[tier.loyalty_program_id]
+                thresholds.append(tier.min_points or 0)
+                tiers.append(tier)
+            for pid, entry in loaded.items():
+                self._programs.set(pid, entry)
+            entries.update(loaded)
+        return entries
+
+    @staticmethod
+    def resolve(entry, points: int):
+        """The highest tier a balance of points qualifies for, or None below the lowest tier"""
+        thresholds, tiers = entry
+        position = bisect.bisect_right(thresholds, points or 0)
+        return tiers[position - 1] if position else None
+
+    def tier_for(self, db: Session, program_id: int, points: int):
+        return self.resolve(self.load(db, {program_id})[program_id], points)
+
+    def invalidate(self, program_id: int):
+        self._programs.pop(program_id)
+
+    def clear(self):
+        self._programs.clear()
+
+tier_ladder = TierLadder()
+
+@event.listens_for(models.TierLevel, "after_insert")
+@event.listens_for(models.TierLevel, "after_update")
+@event.listens_for(models.TierLevel, "after_delete")
+def invalidate_tier_ladder(mapper, connection, target):
+    tier_ladder.invalidate(target.loyalty_program_id)
+    for old_program_id in inspect(target).attrs.loyalty_program_id.history.deleted or ():
+        tier_ladder.invalidate(old_program_id)
+    # Drop it again on commit, in case a concurrent request re-read the old rows in between
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("stale_tier_programs", set()).add(target.loyalty_program_id)
+
+@event.listens_for(Session, "after_commit")
+def invalidate_committed_tier_programs(session):
+    for program_id in session.info.pop("stale_tier_programs", ()):
+        tier_ladder.invalidate(program_id)
+
+def credit_membership_points(db: Session, membership: models.CustomerMembership, points: int):
+    """Add points to a program balance with an SQL-side increment, like crud.credit_points for the total"""
+    db.query(models.CustomerMembership).filter(models.CustomerMembership.id == membership.id).update(
+        {models.CustomerMembership.points: func.coalesce(models.CustomerMembership.points, 0) + points},
+        synchronize_session=False
+    )
+    db.expire(membership, ["points"])
+
 # Calculate tier for a customer
 def calculate_customer_tier(db: Session, customer_id: int, program_id: int):
     # Get the customer's points in this program
@@ -147,17 +229,8 @@ def calculate_customer_tier(db: Session, customer_id: int, program_id: int):
     if not membership:
         return None
     
-    # Get program tiers sorted by min_points descending
-    tiers = db.query(models.TierLevel).filter(
-        models.TierLevel.loyalty_program_id == program_id
-    ).order_by(models.TierLevel.min_points.desc()).all()
-    
     # Find the highest tier the customer qualifies for
-    current_tier = None
-    for tier in tiers:
-        if membership.points >= tier.min_points:
-            current_tier = tier
-            break
+    current_tier = tier_ladder.tier_for(db, program_id, membership.points)
     
     if current_tier:
         membership.current_tier_id = current_tier.id
@@ -204,7 +277,11 @@ def process_referral(db: Session, referral: schemas.ReferralCreate):
         )
         db.add(membership)
     
-    membership.points += db_referral.points_awarded
+    db.flush()
+    credit_membership_points(db, membership, db_referral.points_awarded)
+    # Like every other program balance, referral points also count towards the customer's total
+    crud.credit_points(db, referrer, db_referral.points_awarded)
+    ledger.post(db, referrer.id, program.id, db_referral.points_awarded, ledger.REFERRAL)
     
     # Ensure the referred customer has a referral code
     if not referred.referral_code:
@@ -225,13 +302,13 @@ def process_transaction(db: Session, transaction: schemas.TransactionCreate):
     if not customer:
         customer = models.Customer(phone_number=transaction.customer_phone_number, total_points=0, referral_code=generate_referral_code())
         db.add(customer)
-        db.commit()
-        db.refresh(customer)
+        # Flushed, not committed: the customer commits with the earn (and any idempotency reservation)
+        db.flush()
     
     # Default to legacy loyalty calculation if no program specified
     if not transaction.loyalty_program_id:
         points_earned = int(transaction.amount_spent * business.loyalty_rate)
-        customer.total_points += points_earned
+        crud.credit_points(db, customer, points_earned)
         
         db_transaction = models.Transaction(
             business_id=business.id,
@@ -240,6 +317,7 @@ def process_transaction(db: Session, transaction: schemas.TransactionCreate):
             points_earned=points_earned
         )
         db.add(db_transaction)
+        ledger.post(db, customer.id, None, points_earned, ledger.EARN, db_transaction)
         db.commit()
         return db_transaction
     
@@ -270,23 +348,24 @@ def process_transaction(db: Session, transaction: schemas.TransactionCreate):
     
     if program.program_type == models.LoyaltyProgramType.POINTS:
         points_earned = int(transaction.amount_spent * program.earn_rate)
-        membership.points += points_earned
     
     elif program.program_type == models.LoyaltyProgramType.TIERED:
-        # Calculate the tier first
-        tier = calculate_customer_tier(db, customer.id, program.id)
+        # Resolve the tier before and after the sale from the cached ladder, in this transaction
+        ladder = tier_ladder.load(db, {program.id})[program.id]
+        tier = TierLadder.resolve(ladder, membership.points)
         
         # Calculate points with tier multiplier if applicable
         base_points = int(transaction.amount_spent * program.earn_rate)
         if tier:
             points_earned = int(base_points * tier.multiplier)
             tier_id = tier.id
+            membership.current_tier_id = tier.id
         else:
             points_earned = base_points
         
-        membership.points += points_earned
-        # Recalculate tier after adding points
-        calculate_customer_tier(db, customer.id, program.id)
+        new_tier = TierLadder.resolve(ladder, membership.points + points_earned)
+        if new_tier:
+            membership.current_tier_id = new_tier.id
     
     elif program.program_type == models.LoyaltyProgramType.PAID:
         # Check if customer has active paid membership
@@ -296,16 +375,15 @@ def process_transaction(db: Session, transaction: schemas.TransactionCreate):
         else:
             # Non-paid members get half the earn rate
             points_earned = int(transaction.amount_spent * program.earn_rate * 0.5)
-        
-        membership.points += points_earned
     
     elif program.program_type == models.LoyaltyProgramType.CASHBACK:
         # Calculate cashback amount
         cashback_percentage = program.earn_rate
         cashback_amount = transaction.amount_spent * (cashback_percentage / 100)
         
+    credit_membership_points(db, membership, points_earned)
     # For backward compatibility, also update total points
-    customer.total_points += points_earned
+    crud.credit_points(db, customer, points_earned)
     
     # Create transaction record
     db_transaction = models.Transaction(
@@ -320,10 +398,180 @@ def process_transaction(db: Session, transaction: schemas.TransactionCreate):
     )
     
     db.add(db_transaction)
+    ledger.post(db, customer.id, program.id, points_earned, ledger.EARN, db_transaction)
     db.commit()
     db.refresh(db_transaction)
     return db_transaction
 
+# Process a batch of transactions (e.g. an offline POS upload) in a single commit
+def process_transactions_bulk(db: Session, transactions: List[schemas.TransactionCreate]):
+    results = [None] * len(transactions)
+
+    # Resolve businesses, programs and tiers with one query each
+    business_ids = {t.business_id for t in transactions}
+    businesses = {
+        b.id: b for b in db.query(models.Business).filter(models.Business.id.in_(business_ids)).all()
+    }
+
+    program_ids = {t.loyalty_program_id for t in transactions if t.loyalty_program_id}
+    programs = {}
+    ladders = {}
+    if program_ids:
+        programs = {
+            p.id: p for p in db.query(models.LoyaltyProgram).filter(models.LoyaltyProgram.id.in_(program_ids)).all()
+        }
+        tiered_ids = [p.id for p in programs.values() if p.program_type == models.LoyaltyProgramType.TIERED]
+        if tiered_ids:
+            ladders = tier_ladder.load(db, tiered_ids)
+
+    # Validate rows up front so that failed rows never create customers
+    valid_rows = []
+    for index, row in enumerate(transactions):
+        if row.business_id not in businesses:
+            results[index] = {"index": index, "success": False, "error": "Business not found"}
+        elif row.loyalty_program_id and row.loyalty_program_id not in programs:
+            results[index] = {"index": index, "success": False, "error": "Loyalty program not found"}
+        elif row.loyalty_program_id and programs[row.loyalty_program_id].business_id != row.business_id:
+            results[index] = {"index": index, "success": False, "error": "Loyalty program does not belong to this business"}
+        elif row.amount_spent <= 0:
+            results[index] = {"index": index, "success": False, "error": "Amount spent must be positive"}
+        else:
+            valid_rows.append((index, row))
+
+    # Find or create all customers in the batch
+    phone_numbers = {row.customer_phone_number for _, row in valid_rows}
+    customers = {}
+    if phone_numbers:
+        customers = {
+            c.phone_number: c
+            for c in db.query(models.Customer).filter(models.Customer.phone_number.in_(phone_numbers)).all()
+        }
+    new_customers = [
+        models.Customer(phone_number=phone, total_points=0, referral_code=generate_referral_code())
+        for phone in phone_numbers if phone not in customers
+    ]
+    if new_customers:
+        db.add_all(new_customers)
+        db.flush()
+        customers.update({c.phone_number: c for c in new_customers})
+
+    # Find or create all memberships in the batch
+    pairs = {
+        (customers[row.customer_phone_number].id, row.loyalty_program_id)
+        for _, row in valid_rows if row.loyalty_program_id
+    }
+    memberships = {}
+    if pairs:
+        existing = db.query(models.CustomerMembership).filter(
+            models.CustomerMembership.customer_id.in_({customer_id for customer_id, _ in pairs}),
+            models.CustomerMembership.loyalty_program_id.in_({program_id for _, program_id in pairs})
+        ).all()
+        memberships = {(m.customer_id, m.loyalty_program_id): m for m in existing}
+        new_memberships = [
+            models.CustomerMembership(customer_id=customer_id, loyalty_program_id=program_id, points=0)
+            for customer_id, program_id in pairs if (customer_id, program_id) not in memberships
+        ]
+        if new_memberships:
+            db.add_all(new_memberships)
+            memberships.update({(m.customer_id, m.loyalty_program_id): m for m in new_memberships})
+
+    # Apply the earn rules in memory, in upload order
+    now = datetime.datetime.utcnow()
+    db_transactions = []
+    earned_by_customer = {}
+    # Program balances as the earn rules see them, row by row; the stored ones are incremented once at the end
+    balances = {key: membership.points or 0 for key, membership in memberships.items()}
+    for index, row in valid_rows:
+        business = businesses[row.business_id]
+        customer = customers[row.customer_phone_number]
+        points_earned = 0
+        cashback_amount = 0.0
+        tier_id = None
+        program = programs.get(row.loyalty_program_id)
+
+        if not program:
+            points_earned = int(row.amount_spent * business.loyalty_rate)
+        else:
+            membership = memberships[(customer.id, program.id)]
+
+            if program.program_type == models.LoyaltyProgramType.POINTS:
+                points_earned = int(row.amount_spent * program.earn_rate)
+
+            elif program.program_type == models.LoyaltyProgramType.TIERED:
+                ladder = ladders[program.id]
+                tier = TierLadder.resolve(ladder, balances[(customer.id, program.id)])
+                base_points = int(row.amount_spent * program.earn_rate)
+                if tier:
+                    points_earned = int(base_points * tier.multiplier)
+                    tier_id = tier.id
+                else:
+                    points_earned = base_points
+                new_tier = TierLadder.resolve(ladder, balances[(customer.id, program.id)] + points_earned)
+                if new_tier:
+                    membership.current_tier_id = new_tier.id
+
+            elif program.program_type == models.LoyaltyProgramType.PAID:
+                if membership.is_paid_member and membership.membership_end and membership.membership_end > now:
+                    points_earned = int(row.amount_spent * program.earn_rate)
+                else:
+                    points_earned = int(row.amount_spent * program.earn_rate * 0.5)
+
+            elif program.program_type == models.LoyaltyProgramType.CASHBACK:
+                cashback_amount = row.amount_spent * (program.earn_rate / 100)
+
+            balances[(customer.id, program.id)] += points_earned
+
+        earned_by_customer[customer.id] = earned_by_customer.get(customer.id, 0) + points_earned
+
+        db_transaction = models.Transaction(
+            business_id=business.id,
+            customer_id=customer.id,
+            loyalty_program_id=program.id if program else None,
+            amount_spent=row.amount_spent,
+            points_earned=points_earned,
+            cashback_amount=cashback_amount,
+            tier_id=tier_id,
+            transaction_type=models.TransactionType.EARN
+        )
+        db_transactions.append((index, db_transaction))
+        ledger.post(db, customer.id, program.id if program else None, points_earned, ledger.EARN, db_transaction)
+
+    db.add_all([t for _, t in db_transactions])
+    db.flush()
+
+    # One SQL-side increment per membership and per customer, so concurrent writers never overwrite each other's points
+    earned_by_membership = [
+        {"row_id": memberships[key].id, "earned_points": balance - (memberships[key].points or 0)}
+        for key, balance in balances.items() if balance != (memberships[key].points or 0)
+    ]
+    if earned_by_membership:
+        membership_table = models.CustomerMembership.__table__
+        db.execute(
+            update(membership_table).where(membership_table.c.id == bindparam("row_id"))
+            .values(points=func.coalesce(membership_table.c.points, 0) + bindparam("earned_points")),
+            earned_by_membership
+        )
+    if earned_by_customer:
+        customer_table = models.Customer.__table__
+        db.execute(
+            update(customer_table).where(customer_table.c.id == bindparam("row_id"))
+            .values(total_points=func.coalesce(customer_table.c.total_points, 0) + bindparam("earned_points")),
+            [{"row_id": customer_id, "earned_points": points} for customer_id, points in earned_by_customer.items()]
+        )
+
+    # Collect the results before committing so reading them doesn't reload each row
+    for index, db_transaction in db_transactions:
+        results[index] = {
+            "index": index,
+            "success": True,
+            "transaction_id": db_transaction.id,
+            "points_earned": db_transaction.points_earned,
+            "cashback_amount": db_transaction.cashback_amount
+        }
+
+    db.commit()
+    return results
+
 # Reward management functions
 def create_reward(db: Session, reward: schemas.RewardCreate):
     db_reward = models.Reward(
@@ -345,30 +593,89 @@ def get_rewards_by_program(db: Session, program_id: int):
         models.Reward.is_active == True
     ).all()
 
-def get_available_rewards_for_customer(db: Session, phone_number: str, business_id: int):
+class RewardIndex:
+    """Active rewards of each program, sorted by points_required, so affordability is a bisect"""
+
+    def __init__(self, maxsize: int = PROGRAM_CACHE_SIZE, ttl_seconds: float = PROGRAM_CACHE_TTL_SECONDS):
+        self._programs = TTLCache(maxsize, ttl_seconds)
+
+    def load(self, db: Session, program_ids):
+        """(points_required list, rewards list) per program id, loading the misses in one query"""
+        entries = {}
+        for pid in program_ids:
+            entry = self._programs.get(pid)
+            if entry is not None:
+                entries[pid] = entry
+        missing = set(program_ids) - set(entries)
+        if missing:
+            loaded = {pid: ([], []) for pid in missing}
+            rows = db.query(*models.Reward.__table__.columns).filter(
+                models.Reward.loyalty_program_id.in_(missing),
+                models.Reward.is_active == True
+            ).order_by(models.Reward.points_required, models.Reward.id).all()
+            for row in rows:
+                # Plain copies outside any session, so requests can share them safely
+                reward = models.Reward(**row._mapping)
+                thresholds, program_rewards = loaded[reward.loyalty_program_id]
+                thresholds.append(reward.points_required or 0)
+                program_rewards.append(reward)
+            for pid, entry in loaded.items():
+                self._programs.set(pid, entry)
+            entries.update(loaded)
+        return entries
+
+    @staticmethod
+    def affordable(entry, points: int):
+        thresholds, rewards = entry
+        return rewards[:bisect.bisect_right(thresholds, points or 0)]
+
+    def invalidate(self, program_id: int):
+        self._programs.pop(program_id)
+
+    def clear(self):
+        self._programs.clear()
+
+reward_index = RewardIndex()
+
+@event.listens_for(models.Reward, "after_insert")
+@event.listens_for(models.Reward, "after_update")
+@event.listens_for(models.Reward, "after_delete")
+def invalidate_reward_index(mapper, connection, target):
+    reward_index.invalidate(target.loyalty_program_id)
+    for old_program_id in inspect(target).attrs.loyalty_program_id.history.deleted or ():
+        reward_index.invalidate(old_program_id)
+    # Drop it again on commit, in case a concurrent request re-read the old rows in between
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("stale_reward_programs", set()).add(target.loyalty_program_id)
+
+@event.listens_for(Session, "after_commit")
+def invalidate_committed_reward_programs(session):
+    for program_id in session.info.pop("stale_reward_programs", ()):
+        reward_index.invalidate(program_id)
+
+def get_available_rewards_for_customer(db: Session, phone_number: str, business_id: int = None, affordable_only: bool = True):
+    """Rewards of every program the customer belongs to (only that business's programs when business_id is set)"""
     # Get customer
     customer = db.query(models.Customer).filter(models.Customer.phone_number == phone_number).first()
     if not customer:
         return []
     
-    # Get customer memberships for this business
-    memberships = db.query(models.CustomerMembership).join(
-        models.LoyaltyProgram,
-        models.CustomerMembership.loyalty_program_id == models.LoyaltyProgram.id
-    ).filter(
-        models.CustomerMembership.customer_id == customer.id,
-        models.LoyaltyProgram.business_id == business_id
-    ).all()
-    
+    # Get customer memberships, for one business or across all of them
+    query = db.query(models.CustomerMembership).filter(models.CustomerMembership.customer_id == customer.id)
+    if business_id is not None:
+        query = query.join(
+            models.LoyaltyProgram,
+            models.CustomerMembership.loyalty_program_id == models.LoyaltyProgram.id
+        ).filter(models.LoyaltyProgram.business_id == business_id)
+    memberships = query.all()
+    
+    # Rewards of all those programs come from the index in one go
+    entries = reward_index.load(db, {membership.loyalty_program_id for membership in memberships})
     available_rewards = []
     for membership in memberships:
-        # Get rewards for this program that the customer can afford
-        rewards = db.query(models.Reward).filter(
-            models.Reward.loyalty_program_id == membership.loyalty_program_id,
-            models.Reward.is_active == True,
-            models.Reward.points_required <= membership.points
-        ).all()
-        
+        entry = entries[membership.loyalty_program_id]
+        rewards = RewardIndex.affordable(entry, membership.points) if affordable_only else entry[1]
         for reward in rewards:
             available_rewards.append({
                 'reward': reward,
@@ -386,24 +693,30 @@ def redeem_reward(db: Session, redemption: schemas.RedemptionCreate):
     
     # If loyalty program is specified, handle program-specific redemption
     if redemption.loyalty_program_id:
-        # Get customer membership
-        membership = db.query(models.CustomerMembership).filter(
+        # Deduct points only if the membership balance covers them, checked and applied in one UPDATE
+        deducted = db.query(models.CustomerMembership).filter(
             models.CustomerMembership.customer_id == customer.id,
-            models.CustomerMembership.loyalty_program_id == redemption.loyalty_program_id
-        ).first()
-        
-        if not membership:
-            raise Exception("Customer is not a member of this loyalty program")
+            models.CustomerMembership.loyalty_program_id == redemption.loyalty_program_id,
+            models.CustomerMembership.points >= redemption.points_to_redeem
+        ).update(
+            {models.CustomerMembership.points: models.CustomerMembership.points - redemption.points_to_redeem},
+            synchronize_session=False
+        )
         
-        # Check if customer has enough points in this program
-        if membership.points < redemption.points_to_redeem:
+        if not deducted:
+            db.rollback()
+            membership = db.query(models.CustomerMembership).filter(
+                models.CustomerMembership.customer_id == customer.id,
+                models.CustomerMembership.loyalty_program_id == redemption.loyalty_program_id
+            ).first()
+            if not membership:
+                raise Exception("Customer is not a member of this loyalty program")
             raise Exception(f"Not enough points in this program. Customer has {membership.points} points, but {redemption.points_to_redeem} were requested.")
         
-        # Deduct points from program membership
-        membership.points -= redemption.points_to_redeem
-        
-        # Also deduct from total points for backward compatibility
-        customer.total_points -= redemption.points_to_redeem
+        # Also deduct from total points for backward compatibility, under the same guard
+        if not crud.debit_points(db, customer, redemption.points_to_redeem):
+            db.rollback()
+            raise Exception(f"Not enough points. The customer's total balance is below the {redemption.points_to_redeem} points requested.")
         
         # Create transaction
         db_transaction = models.Transaction(
@@ -417,6 +730,8 @@ def redeem_reward(db: Session, redemption: schemas.RedemptionCreate):
         )
         
         db.add(db_transaction)
+        # The entry takes the points from the oldest monthly buckets first when it is flushed (see expiry.py)
+        ledger.post(db, customer.id, redemption.loyalty_program_id, -redemption.points_to_redeem, ledger.REDEMPTION, db_transaction)
         db.commit()
         db.refresh(db_transaction)
         return db_transaction
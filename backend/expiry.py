@@ -0,0 +1,254 @@
+"""
+Points expiry in monthly buckets.
+Points a member earns in a program go into one bucket per UTC month. Redemptions consume the oldest open
+buckets first, and a nightly job expires whatever is left in buckets older than POINTS_EXPIRY_MONTHS.
+The job uses a few set-based statements per chunk of due buckets, so it never scans the ledger.
+
+Every flush that posts program entries to the points ledger updates the buckets in the same transaction.
+
+Usage: python expiry.py expire     expire the buckets that are due now
+       python expiry.py backfill   rebuild the buckets from the ledger
+"""
+
+import argparse
+import datetime
+import logging
+import os
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Optional
+
+from sqlalchemy import and_, bindparam, case, event, func, insert, literal, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+import ledger, metrics, models, timebuckets
+
+# Points expire this many months after the start of the month they were earned in; 0 turns expiry off
+POINTS_EXPIRY_MONTHS = int(os.getenv("POINTS_EXPIRY_MONTHS", "0"))
+POINTS_EXPIRY_INTERVAL_SECONDS = 86400
+EXPIRY_CHUNK_SIZE = 50_000  # bucket ids per transaction
+KEY = ("customer_id", "loyalty_program_id", "month")
+
+logger = logging.getLogger(__name__)
+
+
+def month_start(moment: datetime.datetime) -> datetime.date:
+    return datetime.date(moment.year, moment.month, 1)
+
+
+def add_months(day: datetime.date, months: int) -> datetime.date:
+    index = day.year * 12 + day.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def expiry_cutoff(now: datetime.datetime) -> datetime.date:
+    """Buckets of the months before this one have expired by now"""
+    return add_months(month_start(now), 1 - POINTS_EXPIRY_MONTHS)
+
+
+def add_earned(connection, earned):
+    """Add {(customer_id, program_id, month): points} to the buckets, creating the ones that don't exist yet"""
+    table = models.PointsBucket.__table__
+    rows = [dict(zip(KEY, key), earned=points, consumed=0, expired=0) for key, points in earned.items()]
+    dialect = connection.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        statement = (sqlite.insert if dialect == "sqlite" else postgresql.insert)(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=list(KEY), set_={"earned": table.c.earned + statement.excluded.earned}
+        )
+        connection.execute(statement, rows)
+        return
+    for row in rows:
+        result = connection.execute(
+            update(table)
+            .where(*[table.c[column] == row[column] for column in KEY])
+            .values(earned=table.c.earned + row["earned"])
+        )
+        if result.rowcount == 0:
+            connection.execute(insert(table), row)
+
+
+def consume(connection, customer_id: int, loyalty_program_id: int, points: int) -> int:
+    """Take points from the member's open buckets, oldest first; returns how many the buckets covered"""
+    table = models.PointsBucket.__table__
+    remaining = table.c.earned - table.c.consumed - table.c.expired
+    buckets = connection.execute(
+        select(table.c.id, remaining).where(
+            table.c.customer_id == customer_id,
+            table.c.loyalty_program_id == loyalty_program_id,
+            table.c.closed_at.is_(None),
+            remaining > 0,
+        ).order_by(table.c.month)
+    ).all()
+    left = points
+    for bucket_id, available in buckets:
+        if left <= 0:
+            break
+        taken = min(available, left)
+        connection.execute(update(table).where(table.c.id == bucket_id).values(consumed=table.c.consumed + taken))
+        left -= taken
+    return points - left
+
+
+@event.listens_for(Session, "after_flush")
+def update_buckets(session, flush_context):
+    # Program entries only: points outside any program never expire
+    earned = defaultdict(int)
+    spent = []
+    for obj in session.new:
+        if isinstance(obj, models.PointsLedgerEntry) and obj.loyalty_program_id:
+            if obj.points > 0:
+                month = month_start(obj.created_at or datetime.datetime.utcnow())
+                earned[(obj.customer_id, obj.loyalty_program_id, month)] += obj.points
+            elif obj.reason != ledger.EXPIRY:
+                spent.append(obj)
+    if earned:
+        add_earned(session.connection(), earned)
+    for entry in sorted(spent, key=lambda entry: entry.id):
+        consume(session.connection(), entry.customer_id, entry.loyalty_program_id, -entry.points)
+
+
+def floored_difference(balance, points):
+    """balance - points as an SQL expression, reading NULL as 0 and never going below 0"""
+    balance = func.coalesce(balance, 0)
+    return case((balance > points, balance - points), else_=0)
+
+
+def expire(db: Session, now: Optional[datetime.datetime] = None):
+    """
+    Expire the points left in every bucket that is due; returns the number of buckets closed, the points
+    expired and the drift: expired points a cached balance no longer held, so it stopped at 0 instead
+    """
+    result = SimpleNamespace(buckets=0, points=0, drift=0)
+    if POINTS_EXPIRY_MONTHS <= 0:
+        return result
+    now = now or datetime.datetime.utcnow()
+    started = time.perf_counter()
+    bucket = models.PointsBucket
+    membership = models.CustomerMembership
+    customer = models.Customer
+    remaining = bucket.earned - bucket.consumed - bucket.expired
+    due = and_(bucket.closed_at.is_(None), bucket.month < expiry_cutoff(now))
+
+    first_id, last_id = db.query(func.min(bucket.id), func.max(bucket.id)).filter(due).one()
+    for start in range(first_id or 0, (last_id or -1) + 1, EXPIRY_CHUNK_SIZE):
+        chunk = and_(due, bucket.id >= start, bucket.id < start + EXPIRY_CHUNK_SIZE)
+        expiring = and_(chunk, remaining > 0)
+        customers = select(bucket.customer_id).where(expiring)
+        # Memberships before buckets, the order redemptions lock them in (no-ops on SQLite)
+        db.execute(select(membership.id).where(membership.customer_id.in_(customers)).with_for_update())
+        db.execute(select(bucket.id).where(chunk).with_for_update())
+
+        points = db.query(func.coalesce(func.sum(remaining), 0)).filter(expiring).scalar()
+        db.execute(insert(models.PointsLedgerEntry).from_select(
+            ["customer_id", "loyalty_program_id", "points", "reason", "created_at"],
+            select(bucket.customer_id, bucket.loyalty_program_id, -remaining, literal(ledger.EXPIRY), literal(now))
+            .where(expiring)
+        ))
+        member_points = select(func.sum(remaining)).where(
+            expiring, bucket.customer_id == membership.customer_id, bucket.loyalty_program_id == membership.loyalty_program_id
+        ).scalar_subquery()
+        # A cached balance below what its buckets still hold has drifted from the ledger; it stops at 0
+        drift = db.query(func.coalesce(func.sum(member_points - func.coalesce(membership.points, 0)), 0)).filter(
+            membership.customer_id.in_(customers), member_points > func.coalesce(membership.points, 0)
+        ).scalar()
+        db.execute(
+            update(membership)
+            .where(membership.customer_id.in_(customers), member_points.isnot(None))
+            .values(points=floored_difference(membership.points, member_points))
+            .execution_options(synchronize_session=False)
+        )
+        # Summed per customer first, as one customer can hold due buckets in several programs
+        customer_points = db.query(bucket.customer_id, func.sum(remaining)).filter(expiring).group_by(bucket.customer_id).all()
+        if customer_points:
+            balances = dict(db.query(customer.id, func.coalesce(customer.total_points, 0)).filter(customer.id.in_(customers)))
+            drift += sum(max(total - balances.get(customer_id, 0), 0) for customer_id, total in customer_points)
+            customer_table = customer.__table__
+            db.execute(
+                update(customer_table).where(customer_table.c.id == bindparam("row_id"))
+                .values(total_points=floored_difference(customer_table.c.total_points, bindparam("expired_points"))),
+                [{"row_id": customer_id, "expired_points": total} for customer_id, total in customer_points]
+            )
+        result.buckets += db.execute(
+            update(bucket).where(chunk).values(expired=bucket.earned - bucket.consumed, closed_at=now)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        result.points += points
+        result.drift += drift
+        db.commit()
+
+    if result.drift:
+        logger.warning("Points expiry: cached balances held %d fewer points than their buckets; "
+                       "run python ledger.py reconcile", result.drift)
+    metrics.set_value("points_expiry_seconds", round(time.perf_counter() - started, 4))
+    metrics.increment("points_expired_total", result.points)
+    metrics.increment("points_expiry_drift_total", result.drift)
+    return result
+
+
+def backfill(db: Session, batch_size: int = 10_000) -> int:
+    """
+    Rebuild the buckets from the ledger: the points earned per month, with every redemption and expiry
+    so far taken from the oldest first. Returns the number of buckets written.
+    """
+    db.query(models.PointsBucket).delete(synchronize_session=False)
+    entry = models.PointsLedgerEntry
+    key = (entry.customer_id, entry.loyalty_program_id)
+    month = timebuckets.truncate(db, entry.created_at, "month")
+    earned_rows = db.query(*key, month, func.sum(entry.points)).filter(
+        entry.loyalty_program_id != 0, entry.points > 0
+    ).group_by(*key, month).order_by(*key, month).yield_per(batch_size)
+    spent_rows = iter(db.query(*key, -func.sum(entry.points)).filter(
+        entry.loyalty_program_id != 0, entry.points < 0
+    ).group_by(*key).order_by(*key).yield_per(batch_size))
+
+    table = models.PointsBucket.__table__
+    written = 0
+    batch = []
+    spent_key, spent = None, 0
+    pending = next(spent_rows, None)
+    for customer_id, program_id, label, points in earned_rows:
+        if (customer_id, program_id) != spent_key:
+            # Both queries are ordered by member, so the spent totals are merged in as we go
+            spent_key, spent = (customer_id, program_id), 0
+            while pending is not None and tuple(pending[:2]) < spent_key:
+                pending = next(spent_rows, None)
+            if pending is not None and tuple(pending[:2]) == spent_key:
+                spent = pending[2]
+        consumed = min(points, spent)
+        spent -= consumed
+        year, month_number = label.split("-")
+        batch.append({
+            "customer_id": customer_id, "loyalty_program_id": program_id,
+            "month": datetime.date(int(year), int(month_number), 1),
+            "earned": points, "consumed": consumed, "expired": 0,
+        })
+        if len(batch) == batch_size:
+            db.execute(insert(table), batch)
+            written += len(batch)
+            batch = []
+    if batch:
+        db.execute(insert(table), batch)
+        written += len(batch)
+    db.commit()
+    return written
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("command", choices=["expire", "backfill"])
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.command == "expire":
+            result = expire(db)
+            print(f"Expired {result.points} points from {result.buckets} buckets ({result.drift} points of drift)")
+        else:
+            print(f"Rebuilt {backfill(db)} monthly buckets")
+    finally:
+        db.close()
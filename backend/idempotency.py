@@ -0,0 +1,145 @@
+"""
+Idempotency-Key support for the earn and redeem endpoints.
+A request reserves its key before it writes anything: the key row is flushed inside the request's own
+transaction, so it commits together with the write and rolls back with it (the write paths therefore
+flush, never commit, the customers they create along the way). A concurrent retry with the
+same key waits on the unique index and then sees the outcome, so the write never runs twice. Retries
+after the first request finished get its stored response back; a key reused for a different request,
+or retried while the first is still running, is rejected. The response is stored just after the write
+commits; should the process die in between, retries get 409 until the key expires, never a second write.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+from typing import Any, Optional
+
+from fastapi import HTTPException, status
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import Session
+
+import models
+
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_KEY_TTL_HOURS", "24"))
+PURGE_INTERVAL_SECONDS = 3600
+
+
+def scope(endpoint: str, caller: str, caller_id: Any) -> str:
+    """Keys are unique per endpoint and caller, e.g. scope("redeem_reward", "business", 7)"""
+    return f"{endpoint}:{caller}:{caller_id}"
+
+
+def fingerprint(request: Any) -> str:
+    return hashlib.sha256(json.dumps(jsonable_encoder(request), sort_keys=True).encode()).hexdigest()
+
+
+def _lookup(db: Session, scope: str, key: str):
+    return db.query(models.IdempotencyKey).filter(
+        models.IdempotencyKey.scope == scope,
+        models.IdempotencyKey.key == key
+    ).first()
+
+
+def _reserve(db: Session, record: models.IdempotencyKey):
+    db.info.setdefault("idempotency_reservations", {})[(record.scope, record.key)] = (record.id, record.created_at)
+
+
+def _reservation(db: Session, scope: str, key: str):
+    """Filter for the row this session reserved; the creation time tells it apart from a later
+    reservation that reused the id of one that was rolled back"""
+    reserved_id, created_at = db.info.get("idempotency_reservations", {}).pop((scope, key), (None, None))
+    return (models.IdempotencyKey.id == reserved_id) & (models.IdempotencyKey.created_at == created_at)
+
+
+def _in_progress():
+    return HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="A request with this Idempotency-Key is still being processed; retry it shortly"
+    )
+
+
+def begin(db: Session, scope: str, key: str, request: Any) -> Optional[Any]:
+    """
+    Reserve the key for this request before its write runs. Returns the stored response if the
+    request has already been processed, or None once the key is reserved in the open transaction.
+    Raises 409 while another request holds the key and 422 if the key was used for a different request.
+    """
+    request_hash = fingerprint(request)
+    now = datetime.datetime.utcnow()
+    record = models.IdempotencyKey(
+        scope=scope,
+        key=key,
+        request_hash=request_hash,
+        created_at=now,
+        expires_at=now + datetime.timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS)
+    )
+    db.add(record)
+    try:
+        db.flush()
+        _reserve(db, record)
+        return None
+    except IntegrityError:
+        db.rollback()
+    except OperationalError:
+        # SQLite gave up waiting for the write lock the other request holds
+        db.rollback()
+        raise _in_progress()
+
+    existing = _lookup(db, scope, key)
+    if existing is None:
+        # The other request failed and gave its reservation back
+        raise _in_progress()
+    if existing.expires_at <= now:
+        # Take over the expired key, unless a concurrent request just did
+        taken = db.query(models.IdempotencyKey).filter(
+            models.IdempotencyKey.id == existing.id,
+            models.IdempotencyKey.expires_at == existing.expires_at
+        ).update({
+            "request_hash": request_hash,
+            "response_body": None,
+            "created_at": now,
+            "expires_at": record.expires_at
+        }, synchronize_session=False)
+        if taken:
+            record.id = existing.id
+            _reserve(db, record)
+            return None
+        db.rollback()
+        raise _in_progress()
+    if existing.request_hash is not None and existing.request_hash != request_hash:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="This Idempotency-Key was already used for a different request"
+        )
+    if existing.response_body is None:
+        raise _in_progress()
+    return json.loads(existing.response_body)
+
+
+def store_response(db: Session, scope: str, key: str, response: Any) -> Any:
+    """Store the response for the reserved key and return it in its serialized form"""
+    payload = jsonable_encoder(response)
+    db.query(models.IdempotencyKey).filter(_reservation(db, scope, key)).update({"response_body": json.dumps(payload)}, synchronize_session=False)
+    db.commit()
+    return payload
+
+
+def release(db: Session, scope: str, key: str):
+    """Give up the reservation after the write failed, so the client can retry with the same key"""
+    db.rollback()
+    # The reservation normally rolls back with the write; this covers a write that committed before failing
+    db.query(models.IdempotencyKey).filter(
+        _reservation(db, scope, key), models.IdempotencyKey.response_body.is_(None)
+    ).delete(synchronize_session=False)
+    db.commit()
+
+
+def purge_expired_keys(db: Session) -> int:
+    """Delete keys past their TTL; run periodically by the scheduler"""
+    deleted = db.query(models.IdempotencyKey).filter(
+        models.IdempotencyKey.expires_at <= datetime.datetime.utcnow()
+    ).delete(synchronize_session=False)
+    db.commit()
+    return deleted
@@ -0,0 +1,255 @@
+"""
+Append-only points ledger.
+Every change to a balance is posted as a points_ledger entry, in the same database transaction as the
+change itself. Customer.total_points (all of a customer's entries) and CustomerMembership.points (the
+entries of one program) stay the balances the API reads and the guarded debits check, so a read is still
+one column; the ledger is the audit trail they must sum to, and reconcile is how drift is found.
+
+A scheduler job folds new entries into points_balance_snapshots, so a balance read is one snapshot row
+plus the short tail of entries since. reconcile compares the cached balances with the ledger for every
+customer and membership in a few set-based queries, and can repair them.
+
+Usage: python ledger.py open                  post opening entries for the balances held before the ledger existed
+       python ledger.py snapshot              fold new entries into the balance snapshots now
+       python ledger.py reconcile [--repair]  report (and fix) cached balances that disagree with the ledger
+"""
+
+import argparse
+import datetime
+import os
+import sys
+from types import SimpleNamespace
+from typing import Optional
+
+from sqlalchemy import and_, bindparam, event, exists, func, insert, literal, select, union_all, update
+from sqlalchemy.orm import Session
+
+import models
+
+LEDGER_SNAPSHOT_SECONDS = int(os.getenv("LEDGER_SNAPSHOT_SECONDS", "900"))
+# Entries younger than this are left in the tail, so one whose transaction commits a little after a
+# later entry's is never skipped by a snapshot
+SNAPSHOT_SETTLE_SECONDS = 60
+REPAIR_BATCH_SIZE = 10_000
+
+EARN = "earn"
+REDEMPTION = "redemption"
+REFERRAL = "referral"
+OPENING = "opening"
+ADJUSTMENT = "adjustment"
+EXPIRY = "expiry"
+
+
+def post(db: Session, customer_id: int, loyalty_program_id: Optional[int], points: int, reason: str,
+         transaction: Optional[models.Transaction] = None):
+    """
+    Append an entry for a change the caller is making to the cached balances; program None (or 0) is
+    for points outside any program. Committed with the caller's transaction.
+    """
+    if not points:
+        return None
+    entry = models.PointsLedgerEntry(
+        customer_id=customer_id, loyalty_program_id=loyalty_program_id or 0, points=points, reason=reason,
+        transaction=transaction
+    )
+    db.add(entry)
+    return entry
+
+
+@event.listens_for(models.PointsLedgerEntry, "before_update")
+@event.listens_for(models.PointsLedgerEntry, "before_delete")
+def reject_ledger_changes(mapper, connection, target):
+    raise Exception("The points ledger is append-only; post a correcting entry instead")
+
+
+def _key_balance(db: Session, customer_id: int, loyalty_program_id: int) -> int:
+    snapshot = models.PointsBalanceSnapshot
+    entry = models.PointsLedgerEntry
+    row = db.query(snapshot.balance, snapshot.last_entry_id).filter(
+        snapshot.customer_id == customer_id, snapshot.loyalty_program_id == loyalty_program_id
+    ).first()
+    balance, last_entry_id = row if row else (0, 0)
+    # A range scan of the balance index, covering only the entries since the snapshot
+    tail = db.query(func.coalesce(func.sum(entry.points), 0)).filter(
+        entry.customer_id == customer_id,
+        entry.loyalty_program_id == loyalty_program_id,
+        entry.id > last_entry_id,
+    ).scalar()
+    return balance + tail
+
+
+def balance(db: Session, customer_id: int, loyalty_program_id: Optional[int] = None) -> int:
+    """
+    A customer's ledger balance in one program (0 for points outside any program), or across
+    everything, like Customer.total_points, when loyalty_program_id is None
+    """
+    if loyalty_program_id is not None:
+        return _key_balance(db, customer_id, loyalty_program_id)
+    # Program entries always belong to a membership, so these are all the customer's balances
+    programs = {0}
+    programs.update(pid for pid, in db.query(models.PointsBalanceSnapshot.loyalty_program_id).filter(
+        models.PointsBalanceSnapshot.customer_id == customer_id
+    ))
+    programs.update(pid for pid, in db.query(models.CustomerMembership.loyalty_program_id).filter(
+        models.CustomerMembership.customer_id == customer_id
+    ))
+    return sum(_key_balance(db, customer_id, program_id) for program_id in programs)
+
+
+def snapshot(db: Session) -> int:
+    """Fold the settled entries since the last run into the balance snapshots; returns how many balances changed"""
+    entry = models.PointsLedgerEntry
+    snapshot = models.PointsBalanceSnapshot
+    now = datetime.datetime.utcnow()
+    previous = db.query(func.max(snapshot.last_entry_id)).scalar() or 0
+    watermark = db.query(func.max(entry.id)).filter(
+        entry.id > previous, entry.created_at <= now - datetime.timedelta(seconds=SNAPSHOT_SETTLE_SECONDS)
+    ).scalar()
+    if not watermark:
+        return 0
+
+    window = and_(entry.id > previous, entry.id <= watermark)
+    same_key = and_(entry.customer_id == snapshot.customer_id, entry.loyalty_program_id == snapshot.loyalty_program_id)
+    # Balances that already have a snapshot move forward by their entries in the window...
+    updated = db.execute(
+        update(snapshot)
+        .where(snapshot.customer_id.in_(select(entry.customer_id).where(window)), exists().where(same_key, window))
+        .values(
+            balance=snapshot.balance + select(func.sum(entry.points)).where(same_key, window).scalar_subquery(),
+            last_entry_id=watermark,
+            taken_at=now,
+        )
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    # ...and the rest get their first one
+    inserted = db.execute(insert(snapshot).from_select(
+        ["customer_id", "loyalty_program_id", "balance", "last_entry_id", "taken_at"],
+        select(entry.customer_id, entry.loyalty_program_id, func.sum(entry.points), literal(watermark), literal(now))
+        .where(window, ~exists().where(same_key))
+        .group_by(entry.customer_id, entry.loyalty_program_id)
+    )).rowcount
+    db.commit()
+    return updated + inserted
+
+
+def _ledger_balances(db: Session):
+    """Subquery of (customer_id, loyalty_program_id, balance) for every balance in the ledger"""
+    entry = models.PointsLedgerEntry
+    snapshot = models.PointsBalanceSnapshot
+    # Each run moves every changed snapshot to the same watermark, so nothing below it is missing from them
+    watermark = db.query(func.max(snapshot.last_entry_id)).scalar() or 0
+    parts = union_all(
+        select(snapshot.customer_id, snapshot.loyalty_program_id, snapshot.balance.label("points")),
+        select(entry.customer_id, entry.loyalty_program_id, entry.points).where(entry.id > watermark),
+    ).subquery()
+    return select(
+        parts.c.customer_id, parts.c.loyalty_program_id, func.sum(parts.c.points).label("balance")
+    ).group_by(parts.c.customer_id, parts.c.loyalty_program_id).subquery()
+
+
+def _membership_drift(db: Session, balances):
+    membership = models.CustomerMembership
+    ledger_points = func.coalesce(balances.c.balance, 0)
+    return select(membership.id, membership.customer_id, membership.loyalty_program_id,
+                  membership.points, ledger_points.label("balance")).outerjoin(
+        balances, and_(
+            balances.c.customer_id == membership.customer_id,
+            balances.c.loyalty_program_id == membership.loyalty_program_id,
+        )
+    ).where(func.coalesce(membership.points, 0) != ledger_points)
+
+
+def _customer_drift(db: Session, balances):
+    customer = models.Customer
+    totals = select(
+        balances.c.customer_id, func.sum(balances.c.balance).label("balance")
+    ).group_by(balances.c.customer_id).subquery()
+    ledger_points = func.coalesce(totals.c.balance, 0)
+    return select(customer.id, customer.total_points.label("points"), ledger_points.label("balance")).outerjoin(
+        totals, totals.c.customer_id == customer.id
+    ).where(func.coalesce(customer.total_points, 0) != ledger_points)
+
+
+def _repair(db: Session, table, rows, column: str) -> int:
+    # Only rows whose cached balance is still the one that was compared; a sale in between leaves the rest
+    # for the next run
+    statement = update(table).where(
+        table.c.id == bindparam("row_id"), func.coalesce(table.c[column], 0) == bindparam("seen")
+    ).values({column: bindparam("fixed")})
+    repaired = 0
+    for offset in range(0, len(rows), REPAIR_BATCH_SIZE):
+        result = db.execute(statement, [
+            {"row_id": row.id, "seen": row.points or 0, "fixed": row.balance}
+            for row in rows[offset:offset + REPAIR_BATCH_SIZE]
+        ])
+        repaired += result.rowcount
+        db.commit()
+    return repaired
+
+
+def reconcile(db: Session, repair: bool = False):
+    """
+    Cached balances that disagree with the ledger, as lists of rows (id, points, balance) per table;
+    with repair, the caches are set to the ledger balances and the repaired counts are included
+    """
+    snapshot(db)
+    balances = _ledger_balances(db)
+    memberships = db.execute(_membership_drift(db, balances)).all()
+    customers = db.execute(_customer_drift(db, balances)).all()
+    result = SimpleNamespace(memberships=memberships, customers=customers, repaired_memberships=0, repaired_customers=0)
+    if repair:
+        result.repaired_memberships = _repair(db, models.CustomerMembership.__table__, memberships, "points")
+        result.repaired_customers = _repair(db, models.Customer.__table__, customers, "total_points")
+    return result
+
+
+def open_balances(db: Session):
+    """
+    Adopt the cached balances as the ledger's starting point, posting an opening entry for each
+    difference; run once after upgrading. Returns the number of entries posted.
+    """
+    entry = models.PointsLedgerEntry
+    if db.query(exists().where(entry.reason == OPENING)).scalar():
+        raise Exception("Opening balances have already been posted")
+    now = datetime.datetime.utcnow()
+    columns = ["customer_id", "loyalty_program_id", "points", "reason", "created_at"]
+    # Memberships first, so the customers' opening entries only cover what the programs don't
+    drift = _membership_drift(db, _ledger_balances(db)).subquery()
+    posted = db.execute(insert(entry).from_select(columns, select(
+        drift.c.customer_id, drift.c.loyalty_program_id, func.coalesce(drift.c.points, 0) - drift.c.balance,
+        literal(OPENING), literal(now)
+    ))).rowcount
+    drift = _customer_drift(db, _ledger_balances(db)).subquery()
+    posted += db.execute(insert(entry).from_select(columns, select(
+        drift.c.id, literal(0), func.coalesce(drift.c.points, 0) - drift.c.balance, literal(OPENING), literal(now)
+    ))).rowcount
+    db.commit()
+    return posted
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("command", choices=["open", "snapshot", "reconcile"])
+    parser.add_argument("--repair", action="store_true", help="set drifted cached balances to the ledger's")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.command == "open":
+            print(f"Posted {open_balances(db)} opening entries")
+        elif args.command == "snapshot":
+            print(f"Updated {snapshot(db)} balance snapshots")
+        else:
+            result = reconcile(db, args.repair)
+            for row in result.memberships[:20]:
+                print(f"membership {row.id}: cached {row.points} vs ledger {row.balance}")
+            for row in result.customers[:20]:
+                print(f"customer {row.id}: cached {row.points} vs ledger {row.balance}")
+            print(f"{len(result.memberships)} memberships and {len(result.customers)} customers disagree with the ledger")
+            if args.repair:
+                print(f"Repaired {result.repaired_memberships} memberships and {result.repaired_customers} customers")
+            sys.exit(1 if (result.memberships or result.customers) and not args.repair else 0)
+    finally:
+        db.close()
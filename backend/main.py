@@ -2,7 +2,7 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import os
-import models
+import models, scheduler, idempotency, metrics, sketches, memberships, ledger, expiry
 from database import engine
 from routers import auth, loyalty
 from routers.loyalty_programs import router as loyalty_programs_router
@@ -28,11 +28,31 @@ app.include_router(loyalty_programs_router)
 app.include_router(extra_router)
 app.include_router(mcp_router)
 
+# Periodic maintenance jobs
+scheduler.register_job("purge_idempotency_keys", idempotency.PURGE_INTERVAL_SECONDS, idempotency.purge_expired_keys)
+scheduler.register_job("refresh_sketches", sketches.SKETCH_REFRESH_SECONDS, sketches.refresh)
+scheduler.register_job("sweep_memberships", memberships.MEMBERSHIP_SWEEP_SECONDS, memberships.sweep)
+scheduler.register_job("snapshot_ledger", ledger.LEDGER_SNAPSHOT_SECONDS, ledger.snapshot)
+scheduler.register_job("expire_points", expiry.POINTS_EXPIRY_INTERVAL_SECONDS, expiry.expire)
+
+@app.on_event("startup")
+async def start_scheduler():
+    scheduler.start()
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    await scheduler.stop()
+
 # Root endpoint
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the Loyalty Platform API - MCP Server Ready"}
 
+# In-process counters and gauges (password hashing queue, ...)
+@app.get("/metrics")
+def read_metrics():
+    return metrics.snapshot()
+
 # Mount static files for customer portal if directory exists
 frontend_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "frontend", "src", "assets", "customer")
 if os.path.exists(frontend_dir):
@@ -0,0 +1,128 @@
+"""
+Paid-membership expiry sweeps.
+A scheduler job clears is_paid_member on every membership whose end date has passed, with one indexed
+UPDATE, and queues renewal reminders (and expiry notices) in membership_reminders for the notifier.
+Between sweeps, sales still check membership_end themselves, so nobody earns at the paid rate late.
+
+Usage: python memberships.py sweep     expire lapsed memberships and queue reminders now
+       python memberships.py pending   list the reminders waiting to be sent
+"""
+
+import argparse
+import datetime
+import os
+import time
+from types import SimpleNamespace
+from typing import List, Optional
+
+from sqlalchemy import and_, exists, func, insert, literal, select, update
+from sqlalchemy.orm import Session
+
+import metrics, models
+
+MEMBERSHIP_SWEEP_SECONDS = int(os.getenv("MEMBERSHIP_SWEEP_SECONDS", "300"))
+# Members are reminded this many days before their paid membership ends
+RENEWAL_REMINDER_DAYS = int(os.getenv("RENEWAL_REMINDER_DAYS", "7"))
+
+
+def _queue_reminders(db: Session, kind: str, *filters) -> int:
+    """Queue a reminder of this kind for each paid membership matching filters, unless one is already queued
+    for the same period; returns how many were queued"""
+    membership = models.CustomerMembership
+    reminder = models.MembershipReminder
+    already_queued = exists().where(
+        reminder.membership_id == membership.id,
+        reminder.kind == kind,
+        reminder.membership_end == membership.membership_end,
+    )
+    memberships = select(
+        membership.id, membership.customer_id, membership.loyalty_program_id, literal(kind),
+        membership.membership_end, literal(datetime.datetime.utcnow())
+    ).where(membership.is_paid_member == True, *filters, ~already_queued)
+    result = db.execute(insert(reminder).from_select(
+        ["membership_id", "customer_id", "loyalty_program_id", "kind", "membership_end", "created_at"], memberships
+    ))
+    return result.rowcount
+
+
+def sweep(db: Session, now: Optional[datetime.datetime] = None):
+    """
+    Expire lapsed paid memberships and queue renewal reminders and expiry notices; returns the number of
+    memberships expired and of reminders and notices queued
+    """
+    now = now or datetime.datetime.utcnow()
+    started = time.perf_counter()
+    membership = models.CustomerMembership
+    lapsed = and_(membership.is_paid_member == True, membership.membership_end <= now)
+
+    # The reminders, the expiry notices and the flag change commit or roll back together, so each lapsed
+    # membership gets exactly one notice
+    try:
+        reminders = _queue_reminders(
+            db, "renewal_due",
+            membership.membership_end > now,
+            membership.membership_end <= now + datetime.timedelta(days=RENEWAL_REMINDER_DAYS),
+        )
+        # Lock the lapsed memberships first, so a renewal can't slip in between the notices and the flag change
+        # (a no-op on SQLite, where the first write already holds the database lock)
+        db.execute(select(membership.id).where(lapsed).with_for_update())
+        notices = _queue_reminders(db, "expired", membership.membership_end <= now)
+        expired = db.execute(
+            update(membership).where(lapsed).values(is_paid_member=False).execution_options(synchronize_session=False)
+        ).rowcount
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    metrics.set_value("membership_sweep_seconds", round(time.perf_counter() - started, 4))
+    metrics.increment("memberships_expired_total", expired)
+    metrics.increment("membership_reminders_queued_total", reminders + notices)
+    metrics.set_value("membership_reminders_pending", db.query(func.count(models.MembershipReminder.id)).filter(
+        models.MembershipReminder.sent_at.is_(None)
+    ).scalar())
+    return SimpleNamespace(expired=expired, reminders=reminders, notices=notices)
+
+
+def paid_member_count(db: Session, loyalty_program_id: int) -> int:
+    """Active paid members of a program, as of the last sweep"""
+    return db.query(func.count(models.CustomerMembership.id)).filter(
+        models.CustomerMembership.loyalty_program_id == loyalty_program_id,
+        models.CustomerMembership.is_paid_member == True
+    ).scalar()
+
+
+def pending_reminders(db: Session, limit: int = 100) -> List[models.MembershipReminder]:
+    """The oldest reminders not yet sent; on PostgreSQL, concurrent notifiers skip each other's rows"""
+    return db.query(models.MembershipReminder).filter(
+        models.MembershipReminder.sent_at.is_(None)
+    ).order_by(models.MembershipReminder.id).limit(limit).with_for_update(skip_locked=True).all()
+
+
+def mark_sent(db: Session, reminder_ids: List[int]):
+    db.query(models.MembershipReminder).filter(
+        models.MembershipReminder.id.in_(reminder_ids)
+    ).update({"sent_at": datetime.datetime.utcnow()}, synchronize_session=False)
+    db.commit()
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("command", choices=["sweep", "pending"])
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.command == "sweep":
+            result = sweep(db)
+            print(f"Expired {result.expired} memberships, queued {result.reminders} renewal reminders "
+                  f"and {result.notices} expiry notices")
+        else:
+            for reminder in pending_reminders(db, limit=1000):
+                print(f"{reminder.kind:<12} membership {reminder.membership_id} "
+                      f"(customer {reminder.customer_id}, program {reminder.loyalty_program_id}) "
+                      f"ends {reminder.membership_end}")
+    finally:
+        db.close()
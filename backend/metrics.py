@@ -0,0 +1,24 @@
+"""
+In-process counters and gauges, exposed as JSON on GET /metrics.
+"""
+
+import threading
+from typing import Dict
+
+_values: Dict[str, float] = {}
+_lock = threading.Lock()
+
+
+def increment(name: str, amount: float = 1):
+    with _lock:
+        _values[name] = _values.get(name, 0) + amount
+
+
+def set_value(name: str, value: float):
+    with _lock:
+        _values[name] = value
+
+
+def snapshot() -> Dict[str, float]:
+    with _lock:
+        return dict(sorted(_values.items()))
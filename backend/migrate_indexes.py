@@ -0,0 +1,69 @@
+"""
+Migration script to add the composite indexes for the hot query shapes
+Safe to run against a live database: duplicate memberships are merged first, and on
+PostgreSQL the indexes are built CONCURRENTLY so writes are not blocked
+"""
+
+from sqlalchemy import create_engine, text
+from database import SQLALCHEMY_DATABASE_URL
+
+INDEXES = [
+    ("ix_transactions_customer_timestamp", "transactions", "customer_id, timestamp", False),
+    ("ix_transactions_business_timestamp", "transactions", "business_id, timestamp", False),
+    ("ux_customer_memberships_customer_program", "customer_memberships", "customer_id, loyalty_program_id", True),
+    ("ix_customer_memberships_program", "customer_memberships", "loyalty_program_id, id", False),
+    ("ix_customer_memberships_paid_end", "customer_memberships", "is_paid_member, membership_end", False),
+    ("ix_customer_memberships_program_paid", "customer_memberships", "loyalty_program_id, is_paid_member", False),
+    ("ix_referrals_business_id", "referrals", "business_id, id", False),
+]
+
+def merge_duplicate_memberships(conn):
+    # The unique index can't be built while a customer has two memberships in one program,
+    # so fold duplicates into the oldest row
+    duplicates = conn.execute(text("""
+        SELECT customer_id, loyalty_program_id, MIN(id), SUM(points), MAX(is_paid_member), MAX(membership_end)
+        FROM customer_memberships
+        GROUP BY customer_id, loyalty_program_id
+        HAVING COUNT(*) > 1
+    """)).fetchall()
+
+    for customer_id, program_id, keep_id, points, is_paid_member, membership_end in duplicates:
+        conn.execute(text("""
+            UPDATE customer_memberships
+            SET points = :points, is_paid_member = :is_paid_member, membership_end = :membership_end
+            WHERE id = :keep_id
+        """), {"points": points, "is_paid_member": is_paid_member, "membership_end": membership_end, "keep_id": keep_id})
+        conn.execute(text("""
+            DELETE FROM customer_memberships
+            WHERE customer_id = :customer_id AND loyalty_program_id = :program_id AND id != :keep_id
+        """), {"customer_id": customer_id, "program_id": program_id, "keep_id": keep_id})
+
+    print(f"Merged {len(duplicates)} duplicate membership groups")
+
+def run_migration():
+    engine = create_engine(SQLALCHEMY_DATABASE_URL)
+    postgres = engine.dialect.name == "postgresql"
+
+    with engine.connect() as conn:
+        merge_duplicate_memberships(conn)
+        conn.commit()
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for name, table, columns, unique in INDEXES:
+            statement = "CREATE UNIQUE INDEX" if unique else "CREATE INDEX"
+            if postgres:
+                statement += " CONCURRENTLY"
+            try:
+                conn.execute(text(f"{statement} IF NOT EXISTS {name} ON {table} ({columns});"))
+                print(f"Index {name} is in place")
+            except Exception as e:
+                print(f"Error creating index {name}: {e}")
+
+        # Refresh the planner statistics so the new indexes get picked up
+        conn.execute(text("ANALYZE;"))
+
+    print("Migration completed successfully!")
+
+if __name__ == "__main__":
+    run_migration()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Enum, Boolean, Text, Table
+from sqlalchemy import Column, Integer, String, Float, DateTime, Date, ForeignKey, Enum, Boolean, Text, Table, UniqueConstraint, Index, LargeBinary
 from sqlalchemy.orm import relationship
 from database import Base
 import datetime
@@ -86,6 +86,12 @@ class Business(Base):
 
 class CustomerMembership(Base):
     __tablename__ = "customer_memberships"
+    __table_args__ = (
+        Index("ux_customer_memberships_customer_program", "customer_id", "loyalty_program_id", unique=True),
+        Index("ix_customer_memberships_program", "loyalty_program_id", "id"),  # program-wide tier recalculation
+        Index("ix_customer_memberships_paid_end", "is_paid_member", "membership_end"),  # expiry sweeps
+        Index("ix_customer_memberships_program_paid", "loyalty_program_id", "is_paid_member"),  # paid-member counts
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     customer_id = Column(Integer, ForeignKey("customers.id"))
@@ -102,6 +108,9 @@ class CustomerMembership(Base):
 
 class Referral(Base):
     __tablename__ = "referrals"
+    __table_args__ = (
+        Index("ix_referrals_business_id", "business_id", "id"),  # keyset pages of a business's referrals
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     referrer_id = Column(Integer, ForeignKey("customers.id"))
@@ -134,6 +143,10 @@ class Customer(Base):
 
 class Transaction(Base):
     __tablename__ = "transactions"
+    __table_args__ = (
+        Index("ix_transactions_customer_timestamp", "customer_id", "timestamp"),  # customer history
+        Index("ix_transactions_business_timestamp", "business_id", "timestamp"),  # analytics windows
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     business_id = Column(Integer, ForeignKey("businesses.id"))
@@ -153,3 +166,116 @@ class Transaction(Base):
     loyalty_program = relationship("LoyaltyProgram")
     tier = relationship("TierLevel")
     referral = relationship("Referral")
+
+class TransactionRollup(Base):
+    """Hourly totals per business and program, kept current by the write path (see rollups.py)"""
+    __tablename__ = "transaction_rollups"
+    __table_args__ = (
+        UniqueConstraint("business_id", "loyalty_program_id", "bucket_start", name="uq_transaction_rollups_bucket"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    business_id = Column(Integer, ForeignKey("businesses.id"), nullable=False)
+    loyalty_program_id = Column(Integer, nullable=False, default=0)  # 0 for transactions outside any program
+    bucket_start = Column(DateTime, nullable=False)  # UTC hour the transactions fall in
+    transaction_count = Column(Integer, nullable=False, default=0)
+    revenue = Column(Float, nullable=False, default=0.0)  # sum of amount_spent
+    sale_count = Column(Integer, nullable=False, default=0)  # transactions with amount_spent > 0
+    points_issued = Column(Integer, nullable=False, default=0)  # sum of positive points_earned
+    issue_count = Column(Integer, nullable=False, default=0)  # transactions with points_earned > 0
+    points_redeemed = Column(Integer, nullable=False, default=0)  # sum of points_earned on redemptions (negative)
+
+class TransactionSketch(Base):
+    """Mergeable daily sketches per business and program, refreshed by a scheduler job (see sketches.py)"""
+    __tablename__ = "transaction_sketches"
+    __table_args__ = (
+        UniqueConstraint("business_id", "loyalty_program_id", "day", name="uq_transaction_sketches_day"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    business_id = Column(Integer, ForeignKey("businesses.id"), nullable=False)
+    loyalty_program_id = Column(Integer, nullable=False, default=0)  # 0 for transactions outside any program
+    day = Column(Date, nullable=False)  # UTC day the transactions fall in
+    customers = Column(LargeBinary, nullable=False)  # HyperLogLog registers of the customer ids
+    amounts = Column(LargeBinary, nullable=False)  # t-digest of amount_spent over sales
+    last_transaction_id = Column(Integer, nullable=False)  # highest transaction id the sketches have seen
+    built_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class PointsLedgerEntry(Base):
+    """Append-only record of every points change; the source of truth for balances (see ledger.py)"""
+    __tablename__ = "points_ledger"
+    __table_args__ = (
+        Index("ix_points_ledger_balance", "customer_id", "loyalty_program_id", "id"),  # snapshot tails
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
+    # 0 for points outside any program, which count towards Customer.total_points only
+    loyalty_program_id = Column(Integer, nullable=False, default=0)
+    points = Column(Integer, nullable=False)  # negative for redemptions
+    reason = Column(String, nullable=False)  # earn, redemption, referral, opening, adjustment or expiry
+    transaction_id = Column(Integer, ForeignKey("transactions.id"), nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    transaction = relationship("Transaction")
+
+class PointsBalanceSnapshot(Base):
+    """Ledger balance of a customer in one program (0 = outside any program) up to last_entry_id"""
+    __tablename__ = "points_balance_snapshots"
+    __table_args__ = (
+        UniqueConstraint("customer_id", "loyalty_program_id", name="uq_points_balance_snapshots_key"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
+    loyalty_program_id = Column(Integer, nullable=False, default=0)
+    balance = Column(Integer, nullable=False, default=0)
+    last_entry_id = Column(Integer, nullable=False)  # ledger entries up to this id are included
+    taken_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class PointsBucket(Base):
+    """Points a member earned in one month, consumed oldest first and expired whole (see expiry.py)"""
+    __tablename__ = "points_buckets"
+    __table_args__ = (
+        UniqueConstraint("customer_id", "loyalty_program_id", "month", name="uq_points_buckets_month"),
+        Index("ix_points_buckets_due", "closed_at", "month"),  # open buckets by age, for the expiry job
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
+    loyalty_program_id = Column(Integer, ForeignKey("loyalty_programs.id"), nullable=False)
+    month = Column(Date, nullable=False)  # first day of the UTC month the points were earned in
+    earned = Column(Integer, nullable=False, default=0)
+    consumed = Column(Integer, nullable=False, default=0)  # taken by redemptions
+    expired = Column(Integer, nullable=False, default=0)  # what was left when the bucket expired
+    closed_at = Column(DateTime, nullable=True)  # set when the bucket expires; nothing changes it after that
+
+class MembershipReminder(Base):
+    """Queue of paid-membership events for the notifier, filled by the expiry sweep (see memberships.py)"""
+    __tablename__ = "membership_reminders"
+    __table_args__ = (
+        # One event of each kind per membership period, however often the sweep runs
+        UniqueConstraint("membership_id", "kind", "membership_end", name="uq_membership_reminders_period"),
+        Index("ix_membership_reminders_pending", "sent_at", "id"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    membership_id = Column(Integer, ForeignKey("customer_memberships.id"), nullable=False)
+    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
+    loyalty_program_id = Column(Integer, ForeignKey("loyalty_programs.id"), nullable=False)
+    kind = Column(String, nullable=False)  # "renewal_due" before the end date, "expired" once it has passed
+    membership_end = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)  # set once the notifier has delivered it
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (UniqueConstraint("scope", "key", name="uq_idempotency_keys_scope_key"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    scope = Column(String)  # Endpoint plus caller, so keys from different businesses never collide
+    key = Column(String)
+    request_hash = Column(String)  # SHA-256 of the request, so a key reused for a different one is rejected
+    response_body = Column(Text)  # JSON-serialized response returned to retries; NULL while the request runs
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    expires_at = Column(DateTime, index=True)
@@ -0,0 +1,140 @@
+"""
+Keyset pagination and streamed JSON exports for the list endpoints.
+Pages are fetched with "WHERE key > last key seen ORDER BY key LIMIT n" (or the (timestamp, id)
+equivalent for histories), so every page costs the same no matter how deep into the table it is.
+"""
+
+import base64
+import csv
+import datetime
+import io
+import json
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from sqlalchemy import and_, or_
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+EXPORT_BATCH_SIZE = 1000
+
+
+def iter_keyset(
+    session_factory: Callable,
+    build_query: Callable[[Any, Optional[Any]], Any],
+    key_of: Callable[[Any], Any],
+    batch_size: int = EXPORT_BATCH_SIZE,
+) -> Iterator[Any]:
+    """
+    Yield every row of build_query(db, after) page by page on a session of its own,
+    so the export can outlive the request's session. key_of(row) gives the cursor of a row.
+    """
+    db = session_factory()
+    try:
+        after = None
+        while True:
+            rows = build_query(db, after).limit(batch_size).all()
+            yield from rows
+            if len(rows) < batch_size:
+                break
+            after = key_of(rows[-1])
+    finally:
+        db.close()
+
+
+def iter_streamed(
+    session_factory: Callable,
+    build_query: Callable[[Any], Any],
+    batch_size: int = EXPORT_BATCH_SIZE,
+) -> Iterator[Any]:
+    """
+    Yield every row of build_query(db) from a server-side cursor on a session of its own,
+    holding at most batch_size rows in memory at a time.
+    """
+    db = session_factory()
+    try:
+        query = build_query(db).execution_options(stream_results=True).yield_per(batch_size)
+        yield from query
+    finally:
+        db.close()
+
+
+def encode_cursor(timestamp: datetime.datetime, row_id: int) -> str:
+    """Opaque cursor for the (timestamp, id) position of a row"""
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{row_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    """Inverse of encode_cursor; raises ValueError for a malformed cursor"""
+    try:
+        timestamp, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.datetime.fromisoformat(timestamp), int(row_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def older_than(timestamp_column, id_column, cursor: Tuple[datetime.datetime, int]):
+    """Filter for the rows after a cursor in (timestamp DESC, id DESC) order"""
+    timestamp, row_id = cursor
+    return or_(timestamp_column < timestamp, and_(timestamp_column == timestamp, id_column < row_id))
+
+
+def json_array_chunks(items: Iterable[Any]) -> Iterator[str]:
+    """Encode items as one JSON array, a chunk per item"""
+    yield "["
+    for position, item in enumerate(items):
+        yield ("," if position else "") + json.dumps(jsonable_encoder(item))
+    yield "]"
+
+
+def ndjson_lines(items: Iterable[Any]) -> Iterator[str]:
+    """Encode items as newline-delimited JSON, a line per item"""
+    for item in items:
+        yield json.dumps(jsonable_encoder(item)) + "\n"
+
+
+def csv_chunks(rows: Iterable[Any], header: List[str], batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[str]:
+    """Encode rows (sequences of values) as CSV, batch_size rows per chunk"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for position, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if position % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def batched_chunks(chunks: Iterable[str], batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[str]:
+    """Join small chunks so the response isn't written one row at a time"""
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) == batch_size:
+            yield "".join(batch)
+            batch = []
+    if batch:
+        yield "".join(batch)
+
+
+def _attachment(filename: Optional[str]):
+    return {"Content-Disposition": f'attachment; filename="{filename}"'} if filename else None
+
+
+def stream_json_array(items: Iterable[Any], filename: Optional[str] = None) -> StreamingResponse:
+    return StreamingResponse(
+        batched_chunks(json_array_chunks(items)), media_type="application/json", headers=_attachment(filename)
+    )
+
+
+def stream_ndjson(items: Iterable[Any], filename: Optional[str] = None) -> StreamingResponse:
+    return StreamingResponse(
+        batched_chunks(ndjson_lines(items)), media_type="application/x-ndjson", headers=_attachment(filename)
+    )
+
+
+def stream_csv(rows: Iterable[Any], header: List[str], filename: Optional[str] = None) -> StreamingResponse:
+    return StreamingResponse(csv_chunks(rows, header), media_type="text/csv", headers=_attachment(filename))
@@ -0,0 +1,305 @@
+"""
+Hourly transaction rollups for the analytics endpoints.
+Every flush that inserts, updates or deletes transactions through the ORM applies the difference to
+transaction_rollups inside the same database transaction, so dashboards read a handful of rows per hour
+instead of rescanning history. Bulk statements (query(...).update()/delete(), Core insert/update/delete)
+and writes from outside this application bypass the listener: run `check` afterwards, and `backfill`
+for the affected business if it reports mismatches.
+
+Usage: python rollups.py backfill [--business-id N]   rebuild the rollups from the raw transactions
+       python rollups.py check [--business-id N]      compare rollups with the raw transactions per day
+"""
+
+import argparse
+import datetime
+import sys
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Callable, Optional
+
+from sqlalchemy import case, event, func, insert, inspect, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+import models, timebuckets
+
+MEASURES = ("transaction_count", "revenue", "sale_count", "points_issued", "issue_count", "points_redeemed")
+KEY = ("business_id", "loyalty_program_id", "bucket_start")
+# Transaction columns the rollups are computed from
+SOURCE_COLUMNS = ("business_id", "loyalty_program_id", "timestamp", "amount_spent", "points_earned", "transaction_type")
+
+
+def bucket_start(timestamp: datetime.datetime) -> datetime.datetime:
+    """Start of the hour a timestamp falls in"""
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def next_bucket_start(timestamp: datetime.datetime) -> datetime.datetime:
+    """First hour boundary at or after a timestamp"""
+    start = bucket_start(timestamp)
+    return start if start == timestamp else start + datetime.timedelta(hours=1)
+
+
+def raw_expressions():
+    """SQL over the transactions table computing each measure, in MEASURES order"""
+    transaction = models.Transaction
+    return {
+        "transaction_count": func.count(transaction.id),
+        "revenue": func.coalesce(func.sum(transaction.amount_spent), 0),
+        "sale_count": func.sum(case((transaction.amount_spent > 0, 1), else_=0)),
+        "points_issued": func.sum(case((transaction.points_earned > 0, transaction.points_earned), else_=0)),
+        "issue_count": func.sum(case((transaction.points_earned > 0, 1), else_=0)),
+        "points_redeemed": func.sum(case(
+            (transaction.transaction_type == models.TransactionType.REDEMPTION, transaction.points_earned), else_=0
+        )),
+    }
+
+
+def contribution(transaction: models.Transaction):
+    """What one transaction adds to its hourly bucket"""
+    amount = transaction.amount_spent or 0
+    points = transaction.points_earned or 0
+    return {
+        "transaction_count": 1,
+        "revenue": amount,
+        "sale_count": 1 if amount > 0 else 0,
+        "points_issued": points if points > 0 else 0,
+        "issue_count": 1 if points > 0 else 0,
+        "points_redeemed": points if transaction.transaction_type == models.TransactionType.REDEMPTION else 0,
+    }
+
+
+def apply_deltas(connection, deltas):
+    """Add per-bucket deltas to the rollup rows, creating the rows that don't exist yet"""
+    table = models.TransactionRollup.__table__
+    rows = [dict(zip(KEY, key), **measures) for key, measures in deltas.items()]
+    dialect = connection.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        statement = (sqlite.insert if dialect == "sqlite" else postgresql.insert)(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=list(KEY),
+            set_={measure: table.c[measure] + statement.excluded[measure] for measure in MEASURES}
+        )
+        connection.execute(statement, rows)
+        return
+    for row in rows:
+        result = connection.execute(
+            update(table)
+            .where(*[table.c[column] == row[column] for column in KEY])
+            .values({measure: table.c[measure] + row[measure] for measure in MEASURES})
+        )
+        if result.rowcount == 0:
+            connection.execute(insert(table), row)
+
+
+def previous_values(transaction: models.Transaction):
+    """The source columns of a transaction as they were before the changes this flush wrote"""
+    state = inspect(transaction)
+    values = {}
+    for column in SOURCE_COLUMNS:
+        history = state.attrs[column].history
+        values[column] = history.deleted[0] if history.deleted else getattr(transaction, column)
+    return SimpleNamespace(**values)
+
+
+def add_contribution(deltas, transaction, sign: int):
+    if transaction.business_id is None or transaction.timestamp is None:
+        return
+    key = (transaction.business_id, transaction.loyalty_program_id or 0, bucket_start(transaction.timestamp))
+    for measure, value in contribution(transaction).items():
+        deltas[key][measure] += sign * value
+
+
+@event.listens_for(Session, "after_flush")
+def update_rollups(session, flush_context):
+    # session.new, dirty and deleted still list what this flush wrote, with the attribute history intact
+    deltas = defaultdict(lambda: dict.fromkeys(MEASURES, 0))
+    for obj in session.new:
+        if isinstance(obj, models.Transaction):
+            add_contribution(deltas, obj, 1)
+    for obj in session.dirty:
+        if isinstance(obj, models.Transaction) and session.is_modified(obj):
+            # Moves the transaction's contribution when it changed bucket or amounts
+            add_contribution(deltas, previous_values(obj), -1)
+            add_contribution(deltas, obj, 1)
+    for obj in session.deleted:
+        if isinstance(obj, models.Transaction):
+            add_contribution(deltas, previous_values(obj), -1)
+    deltas = {key: measures for key, measures in deltas.items() if any(measures.values())}
+    if deltas:
+        apply_deltas(session.connection(), deltas)
+
+
+def rollup_filter(business_id: int, loyalty_program_id: Optional[int] = None,
+                  since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None):
+    """Filter on the rollups of a business (and program) for the whole hours within [since, until)"""
+    rollup = models.TransactionRollup
+    filters = [rollup.business_id == business_id]
+    if loyalty_program_id:
+        filters.append(rollup.loyalty_program_id == loyalty_program_id)
+    if since is not None:
+        filters.append(rollup.bucket_start >= next_bucket_start(since))
+    if until is not None:
+        filters.append(rollup.bucket_start < bucket_start(until))
+    return filters
+
+
+def edge_filters(business_id: int, loyalty_program_id: Optional[int] = None,
+                 since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None):
+    """
+    Filters on the raw transactions in the partial hours at either end of [since, until) that
+    rollup_filter leaves out; each covers under an hour of one business, read through its timestamp index
+    """
+    transaction = models.Transaction
+    base = [transaction.business_id == business_id]
+    if loyalty_program_id:
+        base.append(transaction.loyalty_program_id == loyalty_program_id)
+    first_hour = next_bucket_start(since) if since is not None else None
+    last_hour = bucket_start(until) if until is not None else None
+    # A window inside a single hour has no whole hours at all
+    if first_hour is not None and last_hour is not None and first_hour >= last_hour:
+        return [base + [transaction.timestamp >= since, transaction.timestamp < until]]
+    edges = []
+    if first_hour is not None and first_hour != since:
+        edges.append(base + [transaction.timestamp >= since, transaction.timestamp < first_hour])
+    if last_hour is not None and last_hour != until:
+        edges.append(base + [transaction.timestamp >= last_hour, transaction.timestamp < until])
+    return edges
+
+
+def totals(db: Session, business_id: int, loyalty_program_id: Optional[int] = None,
+           since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None):
+    """Summed measures for a business (and program) over [since, until); one attribute per measure"""
+    rollup = models.TransactionRollup
+    row = db.query(
+        *[func.coalesce(func.sum(getattr(rollup, measure)), 0).label(measure) for measure in MEASURES]
+    ).filter(*rollup_filter(business_id, loyalty_program_id, since, until)).one()
+    values = dict(row._mapping)
+    expressions = raw_expressions()
+    for edge in edge_filters(business_id, loyalty_program_id, since, until):
+        edge_row = db.query(*[expressions[measure] for measure in MEASURES]).filter(*edge).one()
+        for measure, value in zip(MEASURES, edge_row):
+            values[measure] += value or 0
+    return SimpleNamespace(**values)
+
+
+def series(db: Session, bucket_of: Callable, measure: str, business_id: int,
+           loyalty_program_id: Optional[int] = None, since: Optional[datetime.datetime] = None, raw: bool = False):
+    """
+    One measure summed per bucket since a point in time, as {bucket: total};
+    bucket_of(column) turns a timestamp column into the SQL bucket expression (see timebuckets).
+    With raw=True every bucket comes from the transactions themselves, for buckets that don't line up
+    with whole UTC hours (local time in a zone such as Asia/Kolkata, see timebuckets.whole_hour_offsets)
+    """
+    raw_bucket = bucket_of(models.Transaction.timestamp)
+    if raw:
+        transaction = models.Transaction
+        window = [transaction.business_id == business_id]
+        if loyalty_program_id:
+            window.append(transaction.loyalty_program_id == loyalty_program_id)
+        if since is not None:
+            window.append(transaction.timestamp >= since)
+        return dict(db.query(raw_bucket, raw_expressions()[measure]).filter(*window).group_by(raw_bucket).all())
+
+    rollup = models.TransactionRollup
+    bucket = bucket_of(rollup.bucket_start)
+    result = dict(db.query(bucket, func.sum(getattr(rollup, measure))).filter(
+        *rollup_filter(business_id, loyalty_program_id, since)
+    ).group_by(bucket).all())
+    for edge in edge_filters(business_id, loyalty_program_id, since):
+        for key, value in db.query(raw_bucket, raw_expressions()[measure]).filter(*edge).group_by(raw_bucket):
+            result[key] = result.get(key, 0) + (value or 0)
+    return result
+
+
+def raw_measures(db: Session, unit: str, business_id: Optional[int] = None):
+    """The rollup measures computed straight from the transactions, grouped per business, program and bucket"""
+    transaction = models.Transaction
+    bucket = timebuckets.truncate(db, transaction.timestamp, unit)
+    program = func.coalesce(transaction.loyalty_program_id, 0)
+    expressions = raw_expressions()
+    query = db.query(
+        transaction.business_id, program, bucket, *[expressions[measure] for measure in MEASURES]
+    ).filter(transaction.business_id.isnot(None), transaction.timestamp.isnot(None))
+    if business_id is not None:
+        query = query.filter(transaction.business_id == business_id)
+    return query.group_by(transaction.business_id, program, bucket)
+
+
+def backfill(db: Session, business_id: Optional[int] = None, batch_size: int = 1000) -> int:
+    """Rebuild the rollups from the raw transactions; returns the number of hourly buckets written"""
+    rollup_query = db.query(models.TransactionRollup)
+    if business_id is not None:
+        rollup_query = rollup_query.filter(models.TransactionRollup.business_id == business_id)
+    rollup_query.delete(synchronize_session=False)
+
+    table = models.TransactionRollup.__table__
+    written = 0
+    batch = []
+    for business, program, hour, *measures in raw_measures(db, "hour", business_id):
+        batch.append(dict(
+            business_id=business,
+            loyalty_program_id=program,
+            bucket_start=datetime.datetime.strptime(hour, timebuckets.BUCKET_FORMATS["hour"][0]),
+            **dict(zip(MEASURES, [value or 0 for value in measures]))
+        ))
+        if len(batch) == batch_size:
+            db.execute(insert(table), batch)
+            written += len(batch)
+            batch = []
+    if batch:
+        db.execute(insert(table), batch)
+        written += len(batch)
+    db.commit()
+    return written
+
+
+def check(db: Session, business_id: Optional[int] = None):
+    """Days where the rollups disagree with the raw transactions, as (business, program, day, raw, rollup) tuples"""
+    raw = {
+        (business, program, day): tuple(value or 0 for value in measures)
+        for business, program, day, *measures in raw_measures(db, "day", business_id)
+    }
+
+    rollup = models.TransactionRollup
+    day = timebuckets.truncate(db, rollup.bucket_start, "day")
+    query = db.query(
+        rollup.business_id, rollup.loyalty_program_id, day,
+        *[func.sum(getattr(rollup, measure)) for measure in MEASURES]
+    )
+    if business_id is not None:
+        query = query.filter(rollup.business_id == business_id)
+    rolled = {
+        (business, program, day_label): tuple(value or 0 for value in measures)
+        for business, program, day_label, *measures in query.group_by(rollup.business_id, rollup.loyalty_program_id, day)
+    }
+
+    empty = (0,) * len(MEASURES)
+    mismatches = []
+    for key in sorted(set(raw) | set(rolled), key=lambda k: (k[0], k[1], k[2])):
+        expected, actual = raw.get(key, empty), rolled.get(key, empty)
+        if any(abs(a - b) > 1e-6 * max(1, abs(a)) for a, b in zip(expected, actual)):
+            mismatches.append((*key, expected, actual))
+    return mismatches
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("command", choices=["backfill", "check"])
+    parser.add_argument("--business-id", type=int)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.command == "backfill":
+            print(f"Rebuilt {backfill(db, args.business_id)} hourly buckets")
+        else:
+            mismatches = check(db, args.business_id)
+            for business, program, day, expected, actual in mismatches:
+                print(f"business {business} program {program} on {day}: raw {expected} vs rollup {actual}")
+            print(f"{len(mismatches)} mismatching days" if mismatches else "Rollups match the raw transactions")
+            sys.exit(1 if mismatches else 0)
+    finally:
+        db.close()
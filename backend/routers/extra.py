@@ -1,10 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException, Path, Query
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Path, Query, Header, Response
+from sqlalchemy import or_
+from sqlalchemy.orm import Session, aliased
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-import crud, schemas, models
-from database import get_db
+import crud, crud_loyalty_programs, schemas, models, idempotency, timebuckets, pagination, rollups, columnar, sketches, ledger
+from database import get_db, get_read_db, ReadSessionLocal
 from typing import List, Optional
+from types import SimpleNamespace
+from cache import TTLCache
 import datetime
 
 router = APIRouter(
@@ -15,12 +18,13 @@ router = APIRouter(
 # --- Enhanced AI Recommendations ---
 @router.get("/customers/recommendations/{phone_number}")
 def get_recommendations(phone_number: str = Path(...), business_id: int = Query(None), db: Session = Depends(get_db)):
-    from sqlalchemy import func
-    
     customer = db.query(models.Customer).filter(models.Customer.phone_number == phone_number).first()
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
-    
+    return recommendations_for_customer(db, customer, business_id)
+
+def recommendations_for_customer(db: Session, customer: models.Customer, business_id: Optional[int] = None):
+    """Recommendations for a customer the caller has already looked up"""
     recs = []
     
     # Get customer's transaction history
@@ -164,53 +168,123 @@ def complete_referral(
     
     referrer = db.query(models.Customer).filter(models.Customer.id == referral.referrer_id).first()
     if referrer:
-        referrer.total_points += points_to_award_referrer
+        crud.credit_points(db, referrer, points_to_award_referrer)
         referral.points_awarded = points_to_award_referrer
+        if referral.loyalty_program_id:
+            # The bonus belongs to the referral's program, so its membership balance gets it too,
+            # as process_referral does
+            membership = db.query(models.CustomerMembership).filter(
+                models.CustomerMembership.customer_id == referrer.id,
+                models.CustomerMembership.loyalty_program_id == referral.loyalty_program_id
+            ).first()
+            if not membership:
+                membership = models.CustomerMembership(
+                    customer_id=referrer.id,
+                    loyalty_program_id=referral.loyalty_program_id,
+                    points=0
+                )
+                db.add(membership)
+                db.flush()
+            crud_loyalty_programs.credit_membership_points(db, membership, points_to_award_referrer)
+        
+        # Record the bonus as a transaction and in the ledger, under the same program
+        referral_transaction = models.Transaction(
+            business_id=referral.business_id,
+            customer_id=referrer.id,
+            loyalty_program_id=referral.loyalty_program_id,
+            amount_spent=0,
+            points_earned=points_to_award_referrer,
+            transaction_type=models.TransactionType.REFERRAL,
+            referral_id=referral.id,
+            reward_description="Referral bonus"
+        )
+        db.add(referral_transaction)
+        ledger.post(
+            db, referrer.id, referral.loyalty_program_id, points_to_award_referrer, ledger.REFERRAL, referral_transaction
+        )
         db.commit()
     
     return {"message": "Referral completed and points awarded"}
 
+def referrals_query(db: Session, business_id: int, status: Optional[str], after_id: Optional[int]):
+    # Referrer and referred phone numbers come from one aliased join instead of two lookups per row
+    referrer = aliased(models.Customer)
+    referred = aliased(models.Customer)
+    query = db.query(
+        models.Referral.id,
+        models.Referral.business_id,
+        models.Referral.points_awarded,
+        referrer.phone_number.label("referrer_phone"),
+        referred.phone_number.label("referred_phone")
+    ).outerjoin(
+        referrer, referrer.id == models.Referral.referrer_id
+    ).outerjoin(
+        referred, referred.id == models.Referral.referred_id
+    ).filter(models.Referral.business_id == business_id)
+    if status == "completed":
+        query = query.filter(models.Referral.points_awarded > 0)
+    elif status == "pending":
+        query = query.filter(or_(models.Referral.points_awarded.is_(None), models.Referral.points_awarded <= 0))
+    if after_id is not None:
+        query = query.filter(models.Referral.id > after_id)
+    return query.order_by(models.Referral.id)
+
+def referral_row(row):
+    return {
+        "referral_id": row.id,
+        "status": "completed" if (row.points_awarded or 0) > 0 else "pending",
+        "referrer_phone": row.referrer_phone,
+        "referred_phone": row.referred_phone,
+        "business_id": row.business_id,
+        "points_awarded": row.points_awarded
+    }
+
 @router.get("/referrals/all", response_model=List[dict])
 def get_all_referrals(
+    response: Response,
     business_id: int = Query(...),
-    db: Session = Depends(get_db)
+    status: Optional[str] = Query(None, pattern="^(pending|completed)$"),
+    after_id: Optional[int] = Query(None, description="Return referrals with an id greater than this (keyset cursor)"),
+    limit: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1, le=pagination.MAX_PAGE_SIZE),
+    stream: bool = Query(False, description="Stream every matching referral as one JSON array"),
+    db: Session = Depends(get_read_db)
 ):
-    referrals = db.query(models.Referral).filter(models.Referral.business_id == business_id).all()
-    result = []
-    for r in referrals:
-        referrer = db.query(models.Customer).filter(models.Customer.id == r.referrer_id).first() if r.referrer_id else None
-        referred = db.query(models.Customer).filter(models.Customer.id == r.referred_id).first() if r.referred_id else None
-        result.append({
-            "referral_id": r.id,
-            "status": "completed" if r.points_awarded > 0 else "pending",
-            "referrer_phone": referrer.phone_number if referrer else None,
-            "referred_phone": referred.phone_number if referred else None,
-            "business_id": r.business_id,
-            "points_awarded": r.points_awarded
-        })
-    return result
+    if stream:
+        rows = pagination.iter_keyset(
+            ReadSessionLocal,
+            lambda export_db, after: referrals_query(export_db, business_id, status, after if after is not None else after_id),
+            key_of=lambda row: row.id
+        )
+        return pagination.stream_json_array(
+            (referral_row(row) for row in rows), filename=f"referrals-{business_id}.json"
+        )
+
+    rows = referrals_query(db, business_id, status, after_id).limit(limit).all()
+    # Cursor for the next page; absent on the last one
+    if len(rows) == limit:
+        response.headers["X-Next-After-Id"] = str(rows[-1].id)
+    return [referral_row(row) for row in rows]
 
 # --- Reporting Endpoints ---
 @router.get("/reports/total_points_issued")
-def total_points_issued(business_id: int = Query(...), loyalty_program_id: int = Query(None), db: Session = Depends(get_db)):
-    base_filter = [models.Transaction.business_id == business_id, models.Transaction.points_earned > 0]
-    if loyalty_program_id:
-        base_filter.append(models.Transaction.loyalty_program_id == loyalty_program_id)
-    
-    total = db.query(models.Transaction).filter(*base_filter).with_entities(models.Transaction.points_earned).all()
-    return {"total_points_issued": sum(t[0] for t in total)}
+def total_points_issued(business_id: int = Query(...), loyalty_program_id: int = Query(None), db: Session = Depends(get_read_db)):
+    totals = rollups.totals(db, business_id, loyalty_program_id)
+    return {"total_points_issued": int(totals.points_issued)}
 
 @router.get("/reports/total_redemptions")
-def total_redemptions(business_id: int = Query(...), loyalty_program_id: int = Query(None), db: Session = Depends(get_db)):
-    base_filter = [models.Transaction.business_id == business_id, models.Transaction.transaction_type == models.TransactionType.REDEMPTION]
-    if loyalty_program_id:
-        base_filter.append(models.Transaction.loyalty_program_id == loyalty_program_id)
-    
-    total = db.query(models.Transaction).filter(*base_filter).with_entities(models.Transaction.points_earned).all()
-    return {"total_redemptions": -sum(t[0] for t in total)}
+def total_redemptions(business_id: int = Query(...), loyalty_program_id: int = Query(None), db: Session = Depends(get_read_db)):
+    totals = rollups.totals(db, business_id, loyalty_program_id)
+    return {"total_redemptions": -int(totals.points_redeemed)}
 
 @router.get("/reports/customer_count")
-def customer_count(business_id: int = Query(...), loyalty_program_id: int = Query(None), db: Session = Depends(get_db)):
+def customer_count(business_id: int = Query(...), loyalty_program_id: int = Query(None), db: Session = Depends(get_read_db),
+                   approx: bool = Query(False, description="Estimate from the daily sketches instead of counting")):
+    if approx:
+        merged = sketches.merged(db, business_id, loyalty_program_id)
+        # Until the first refresh has sketched this business, the exact count is the only answer
+        if merged.as_of is not None:
+            return {"customer_count": merged.customers.count(), **approximation(merged)}
+
     base_filter = [models.Transaction.business_id == business_id]
     if loyalty_program_id:
         base_filter.append(models.Transaction.loyalty_program_id == loyalty_program_id)
@@ -219,7 +293,7 @@ def customer_count(business_id: int = Query(...), loyalty_program_id: int = Quer
     return {"customer_count": count}
 
 @router.get("/reports/top_customers")
-def top_customers(business_id: int = Query(...), n: int = Query(5), loyalty_program_id: int = Query(None), db: Session = Depends(get_db)):
+def top_customers(business_id: int = Query(...), n: int = Query(5), loyalty_program_id: int = Query(None), db: Session = Depends(get_read_db)):
     from sqlalchemy import func
     
     base_filter = [models.Transaction.business_id == business_id]
@@ -229,15 +303,35 @@ def top_customers(business_id: int = Query(...), n: int = Query(5), loyalty_prog
     results = db.query(models.Customer.phone_number, func.sum(models.Transaction.points_earned).label('points')).join(models.Transaction).filter(*base_filter).group_by(models.Customer.id).order_by(func.sum(models.Transaction.points_earned).desc()).limit(n).all()
     return [{"phone_number": r[0], "points": r[1]} for r in results]
 
-@router.get("/reports/all_customers")
-def all_customers(business_id: int = Query(...), loyalty_program_id: int = Query(None), db: Session = Depends(get_db)):
+def all_customers_query(db: Session, business_id: int, loyalty_program_id: Optional[int]):
     from sqlalchemy import func
     
     base_filter = [models.Transaction.business_id == business_id]
     if loyalty_program_id:
         base_filter.append(models.Transaction.loyalty_program_id == loyalty_program_id)
     
-    results = db.query(models.Customer.phone_number, func.sum(models.Transaction.points_earned).label('points')).join(models.Transaction).filter(*base_filter).group_by(models.Customer.id).order_by(func.sum(models.Transaction.points_earned).desc()).all()
+    return db.query(models.Customer.phone_number, func.sum(models.Transaction.points_earned).label('points')).join(models.Transaction).filter(*base_filter).group_by(models.Customer.id).order_by(func.sum(models.Transaction.points_earned).desc())
+
+def export_all_customers(session_factory, business_id: int, loyalty_program_id: Optional[int], format: str):
+    """Streamed all_customers response; rows come off a server-side cursor, so memory stays flat"""
+    rows = pagination.iter_streamed(
+        session_factory, lambda export_db: all_customers_query(export_db, business_id, loyalty_program_id)
+    )
+    filename = f"customers-{business_id}.{format}"
+    if format == "csv":
+        return pagination.stream_csv(rows, ["phone_number", "points"], filename=filename)
+    return pagination.stream_ndjson(({"phone_number": r[0], "points": r[1]} for r in rows), filename=filename)
+
+@router.get("/reports/all_customers")
+def all_customers(
+    business_id: int = Query(...),
+    loyalty_program_id: int = Query(None),
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$", description="Stream the full list as CSV or NDJSON"),
+    db: Session = Depends(get_read_db)
+):
+    if format:
+        return export_all_customers(ReadSessionLocal, business_id, loyalty_program_id, format)
+    results = all_customers_query(db, business_id, loyalty_program_id).all()
     return [{"phone_number": r[0], "points": r[1]} for r in results]
 
 # --- MCP Endpoints ---
@@ -245,13 +339,60 @@ def all_customers(business_id: int = Query(...), loyalty_program_id: int = Query
 def mcp_customer_points(phone_number: str, db: Session = Depends(get_db)):
     return crud.get_customer_points(db, phone_number)
 
+def customer_history_query(db: Session, customer_id: int, cursor=None):
+    # Newest first, with the business name joined in rather than loaded per row
+    query = db.query(models.Transaction, models.Business.name).outerjoin(
+        models.Business, models.Transaction.business_id == models.Business.id
+    ).filter(models.Transaction.customer_id == customer_id)
+    if cursor is not None:
+        query = query.filter(pagination.older_than(models.Transaction.timestamp, models.Transaction.id, cursor))
+    return query.order_by(models.Transaction.timestamp.desc(), models.Transaction.id.desc())
+
+def history_row(row):
+    t, business_name = row
+    return {
+        "id": t.id,
+        "business_name": business_name or "Unknown",
+        "amount_spent": t.amount_spent,
+        "points_earned": t.points_earned,
+        "type": t.transaction_type.value,
+        "timestamp": t.timestamp
+    }
+
 @router.get("/mcp/customer/transactions/{phone_number}")
-def mcp_customer_transactions(phone_number: str, db: Session = Depends(get_db)):
+def mcp_customer_transactions(
+    phone_number: str,
+    response: Response,
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    limit: int = Query(pagination.DEFAULT_PAGE_SIZE, ge=1, le=pagination.MAX_PAGE_SIZE),
+    stream: bool = Query(False, description="Stream the whole history as NDJSON"),
+    db: Session = Depends(get_db)
+):
+    """
+    A customer's transactions, newest first, one page at a time: at most `limit` rows (500 unless
+    given), with X-Next-Cursor set while there are more. Use stream=true for the whole history at once.
+    """
     customer = db.query(models.Customer).filter(models.Customer.phone_number == phone_number).first()
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
-    txns = db.query(models.Transaction).filter(models.Transaction.customer_id == customer.id).order_by(models.Transaction.timestamp.desc()).all()
-    return [{"amount_spent": t.amount_spent, "points_earned": t.points_earned, "type": t.transaction_type.value, "timestamp": t.timestamp} for t in txns]
+    try:
+        position = pagination.decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if stream:
+        customer_id = customer.id
+        rows = pagination.iter_streamed(
+            ReadSessionLocal, lambda export_db: customer_history_query(export_db, customer_id, position)
+        )
+        return pagination.stream_ndjson((history_row(row) for row in rows))
+
+    rows = customer_history_query(db, customer.id, position).limit(limit).all()
+    # Cursor for the next page; absent on the last one
+    if len(rows) == limit:
+        last = rows[-1][0]
+        response.headers["X-Next-Cursor"] = pagination.encode_cursor(last.timestamp, last.id)
+    return [history_row(row) for row in rows]
 
 @router.get("/mcp/business/{business_id}")
 def mcp_business(business_id: int, db: Session = Depends(get_db)):
@@ -264,164 +405,155 @@ def mcp_business(business_id: int, db: Session = Depends(get_db)):
 def mcp_recommendations(phone_number: str, db: Session = Depends(get_db)):
     return get_recommendations(phone_number, db)
 
+def approximation(merged, percentiles=()):
+    """What an approx=true answer adds: the error bounds of the sketches and when they were last refreshed"""
+    bounds = {"customers_relative_error": round(merged.customers.relative_error(), 4)}
+    if percentiles:
+        bounds["sale_amount_percentile_rank_error"] = {
+            f"p{round(q * 100)}": round(merged.amounts.rank_error(q), 4) for q in percentiles
+        }
+    return {"approximate": True, "error_bounds": bounds, "as_of": merged.as_of}
+
 # --- Enhanced Analytics Endpoints ---
-@router.get("/analytics/revenue_stats")
-def revenue_stats(business_id: int = Query(...), loyalty_program_id: int = Query(None), db: Session = Depends(get_db)):
-    """Get revenue statistics for the business"""
-    from sqlalchemy import func
-    
-    # Base filter
-    base_filter = [models.Transaction.business_id == business_id]
-    
-    # Add loyalty program filter if specified
+DASHBOARD_CACHE_TTL_SECONDS = int(os.getenv("DASHBOARD_CACHE_TTL_SECONDS", "30"))
+dashboard_cache = TTLCache(maxsize=1000, ttl_seconds=DASHBOARD_CACHE_TTL_SECONDS)
+
+def check_timezone(tz: str):
+    try:
+        timebuckets.validate_timezone(tz)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def customer_segments(db: Session, business_id: int, loyalty_program_id: Optional[int], since: datetime.datetime):
+    """
+    Customer counts for a business (and program) from one grouped pass over its transactions:
+    the per-customer totals are ranked by spending in SQL, so only a single row comes back
+    """
+    if columnar.ANALYTICS_ENGINE == "numpy":
+        return columnar.customer_segments(db, business_id, loyalty_program_id, since)
+    from sqlalchemy import func, case, cast, Float, Numeric
+    transaction = models.Transaction
+    base_filter = [transaction.business_id == business_id]
     if loyalty_program_id:
-        base_filter.append(models.Transaction.loyalty_program_id == loyalty_program_id)
-    
-    # Total revenue
-    total_revenue = db.query(func.sum(models.Transaction.amount_spent)).filter(
-        *base_filter
-    ).scalar() or 0
-    
-    # Average transaction value
-    avg_transaction = db.query(func.avg(models.Transaction.amount_spent)).filter(
-        *base_filter,
-        models.Transaction.amount_spent > 0
-    ).scalar() or 0
-    
-    # Monthly revenue trend (last 6 months) - using SQLite compatible functions
-    from datetime import datetime, timedelta
-    six_months_ago = datetime.utcnow() - timedelta(days=180)
-    
-    # Get raw data and process in Python since SQLite doesn't have date_trunc
-    transactions = db.query(
-        models.Transaction.timestamp,
-        models.Transaction.amount_spent
-    ).filter(
-        *base_filter,
-        models.Transaction.timestamp >= six_months_ago
-    ).all()
-    
-    # Group by month in Python
-    monthly_data = {}
-    for txn in transactions:
-        month_key = txn.timestamp.strftime('%Y-%m')
-        if month_key not in monthly_data:
-            monthly_data[month_key] = 0
-        monthly_data[month_key] += txn.amount_spent
-    
-    monthly_revenue = [{"month": k, "revenue": v} for k, v in sorted(monthly_data.items())]
-    
+        base_filter.append(transaction.loyalty_program_id == loyalty_program_id)
+
+    per_customer = db.query(
+        transaction.customer_id,
+        func.count(transaction.id).label("transactions"),
+        func.sum(case((transaction.timestamp >= since, 1), else_=0)).label("recent_transactions"),
+        # In cents (round() needs a numeric on PostgreSQL), so ties don't depend on the summation order
+        func.round(cast(func.sum(transaction.amount_spent), Numeric), 2, type_=Float).label("spent"),
+        func.sum(transaction.points_earned).label("points"),
+    ).filter(*base_filter).group_by(transaction.customer_id).cte("per_customer")
+
+    # Joining the grouped rows rather than every transaction keeps the scan to the transactions table;
+    # count() over the spending order includes ties, i.e. how many customers spent at least as much
+    by_spending = per_customer.c.spent.desc().nullslast()
+    ranked = db.query(
+        per_customer,
+        func.row_number().over(order_by=by_spending).label("position"),
+        func.count().over(order_by=by_spending).label("spent_at_least"),
+        func.count().over().label("customer_total"),
+    ).join(models.Customer, models.Customer.id == per_customer.c.customer_id).subquery("ranked")
+
+    row = db.query(
+        func.count().label("customers"),
+        func.sum(case((ranked.c.recent_transactions == 1, 1), else_=0)).label("new"),
+        func.sum(case((ranked.c.recent_transactions > 0, 1), else_=0)).label("active"),
+        func.sum(case((ranked.c.transactions > 1, 1), else_=0)).label("repeat"),
+        func.sum(case((ranked.c.points > 0, 1), else_=0)).label("with_points"),
+        # High value: everyone spending at least as much as the customer at the top-20% mark
+        func.max(case((ranked.c.position == ranked.c.customer_total // 5 + 1, ranked.c.spent_at_least))).label("high_value"),
+    ).one()
+    return SimpleNamespace(**{key: int(value or 0) for key, value in row._mapping.items()})
+
+def quantile(sorted_values, q: float):
+    """Linear interpolation between the closest ranks, as numpy.quantile does"""
+    position = q * (len(sorted_values) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+def customer_distribution(db: Session, business_id: int, loyalty_program_id: Optional[int], bins: int):
+    """Spending quantiles and histogram, repeat rate and monthly first-purchase cohorts of a business's customers"""
+    if columnar.ANALYTICS_ENGINE == "numpy":
+        return columnar.customer_distribution(db, business_id, loyalty_program_id, bins)
+    from sqlalchemy import func, cast, Float, Numeric
+    transaction = models.Transaction
+    base_filter = [transaction.business_id == business_id, transaction.customer_id.isnot(None)]
+    if loyalty_program_id:
+        base_filter.append(transaction.loyalty_program_id == loyalty_program_id)
+    rows = db.query(
+        func.count(transaction.id),
+        func.round(cast(func.coalesce(func.sum(transaction.amount_spent), 0.0), Numeric), 2, type_=Float),
+        func.min(transaction.timestamp),
+    ).filter(*base_filter).group_by(transaction.customer_id).all()
+    if not rows:
+        return {"customers": 0, "repeat_rate": 0, "spending_quantiles": {}, "spending_histogram": [], "cohorts": []}
+
+    spent = sorted(float(row[1]) for row in rows)
+    low, high = spent[0], spent[-1]
+    if low == high:
+        low, high = low - 0.5, high + 0.5
+    width = (high - low) / bins
+    histogram = [0] * bins
+    for value in spent:
+        histogram[min(int((value - low) / width), bins - 1)] += 1
+
+    cohorts = {}
+    for transactions, _, first_seen in rows:
+        if first_seen is not None:
+            cohort = cohorts.setdefault(first_seen.strftime("%Y-%m"), [0, 0])
+            cohort[0] += 1
+            cohort[1] += 1 if transactions > 1 else 0
+    repeat_customers = len([row for row in rows if row[0] > 1])
+    return {
+        "customers": len(rows),
+        "repeat_rate": round(repeat_customers / len(rows) * 100, 2),
+        "spending_quantiles": {
+            f"p{round(q * 100)}": round(quantile(spent, q), 2) for q in columnar.QUANTILES
+        },
+        "spending_histogram": [
+            {"from": round(low + width * i, 2), "to": round(low + width * (i + 1), 2), "customers": count}
+            for i, count in enumerate(histogram)
+        ],
+        "cohorts": [
+            {"month": month, "customers": size, "repeat_customers": repeats}
+            for month, (size, repeats) in sorted(cohorts.items())
+        ],
+    }
+
+def revenue_summary(db: Session, totals, business_id: int, loyalty_program_id: Optional[int], tz: str):
+    # Monthly revenue trend (last 6 months)
+    six_months_ago = datetime.datetime.utcnow() - datetime.timedelta(days=180)
+    # Hourly rollups can't be split at a local month boundary that falls on the half hour
+    monthly_data = rollups.series(
+        db, lambda column: timebuckets.truncate(db, column, "month", tz, since=six_months_ago), "revenue",
+        business_id, loyalty_program_id, since=six_months_ago,
+        raw=not timebuckets.whole_hour_offsets(tz, six_months_ago)
+    )
+    avg_transaction = totals.revenue / totals.sale_count if totals.sale_count else 0
     return {
-        "total_revenue": float(total_revenue),
+        "total_revenue": float(totals.revenue),
         "average_transaction": float(avg_transaction),
-        "monthly_revenue": monthly_revenue
+        "monthly_revenue": [{"month": k, "revenue": v} for k, v in sorted(monthly_data.items())]
     }
 
-@router.get("/analytics/customer_insights")
-def customer_insights(business_id: int = Query(...), loyalty_program_id: int = Query(None), db: Session = Depends(get_db)):
-    """Get customer behavior insights"""
-    from sqlalchemy import func
-    from datetime import datetime, timedelta
-    
-    last_30_days = datetime.utcnow() - timedelta(days=30)
-    
-    # Base filter
-    base_filter = [models.Transaction.business_id == business_id]
-    
-    # Add loyalty program filter if specified
-    if loyalty_program_id:
-        base_filter.append(models.Transaction.loyalty_program_id == loyalty_program_id)
-    
-    # New customers (customers with only one transaction in the last 30 days)
-    new_customers = db.query(models.Customer.id).join(models.Transaction).filter(
-        *base_filter,
-        models.Transaction.timestamp >= last_30_days
-    ).group_by(models.Customer.id).having(func.count(models.Transaction.id) == 1).count()
-    
-    # Repeat customers (customers with more than one transaction ever)
-    repeat_customers = db.query(models.Customer.id).join(models.Transaction).filter(
-        *base_filter
-    ).group_by(models.Customer.id).having(func.count(models.Transaction.id) > 1).count()
-    
-    # High value customers - simplified approach
-    # Get all customers and their total spending, then find top 20%
-    customer_spending = db.query(
-        models.Customer.id,
-        func.sum(models.Transaction.amount_spent).label('total_spent')
-    ).join(models.Transaction).filter(
-        *base_filter
-    ).group_by(models.Customer.id).all()
-    
-    if customer_spending:
-        spending_amounts = [cs.total_spent for cs in customer_spending]
-        spending_amounts.sort(reverse=True)
-        threshold_index = int(len(spending_amounts) * 0.2)  # Top 20%
-        if threshold_index < len(spending_amounts):
-            threshold = spending_amounts[threshold_index]
-            high_value_customers = len([s for s in spending_amounts if s >= threshold])
-        else:
-            high_value_customers = len(spending_amounts)
-    else:
-        high_value_customers = 0
-    
-    # Active customers (customers who made purchase in last 30 days)
-    active_customers = db.query(models.Customer.id).join(models.Transaction).filter(
-        *base_filter,
-        models.Transaction.timestamp >= last_30_days
-    ).distinct().count()
-    
+def insights_summary(segments):
     return {
-        "new_customers_this_month": new_customers,
-        "repeat_customers": repeat_customers,
-        "high_value_customers": high_value_customers,
-        "active_customers_this_month": active_customers
+        "new_customers_this_month": segments.new,
+        "repeat_customers": segments.repeat,
+        "high_value_customers": segments.high_value,
+        "active_customers_this_month": segments.active
     }
 
-@router.get("/analytics/loyalty_performance")
-def loyalty_performance(business_id: int = Query(...), loyalty_program_id: int = Query(None), db: Session = Depends(get_db)):
-    """Get loyalty program performance metrics"""
-    from sqlalchemy import func
-    
-    # Base filter
-    base_filter = [models.Transaction.business_id == business_id]
-    
-    # Add loyalty program filter if specified
-    if loyalty_program_id:
-        base_filter.append(models.Transaction.loyalty_program_id == loyalty_program_id)
-    
-    # Points economics
-    total_points_issued = db.query(func.sum(models.Transaction.points_earned)).filter(
-        *base_filter,
-        models.Transaction.points_earned > 0
-    ).scalar() or 0
-    
-    total_points_redeemed = db.query(func.sum(models.Transaction.points_earned)).filter(
-        *base_filter,
-        models.Transaction.transaction_type == models.TransactionType.REDEMPTION
-    ).scalar() or 0
-    
+def loyalty_summary(totals, segments):
+    total_points_issued = totals.points_issued
+    total_points_redeemed = totals.points_redeemed
     outstanding_points = total_points_issued + total_points_redeemed  # redeemed points are negative
-    
-    # Redemption rate
     redemption_rate = (abs(total_points_redeemed) / total_points_issued * 100) if total_points_issued > 0 else 0
-    
-    # Average points per transaction
-    avg_points_per_transaction = db.query(func.avg(models.Transaction.points_earned)).filter(
-        *base_filter,
-        models.Transaction.points_earned > 0
-    ).scalar() or 0
-    
-    # Loyalty program adoption
-    customers_with_points = db.query(models.Customer.id).join(models.Transaction).filter(
-        *base_filter
-    ).group_by(models.Customer.id).having(func.sum(models.Transaction.points_earned) > 0).count()
-    
-    total_customers = db.query(models.Customer.id).join(models.Transaction).filter(
-        *base_filter
-    ).distinct().count()
-    
-    adoption_rate = (customers_with_points / total_customers * 100) if total_customers > 0 else 0
-    
+    avg_points_per_transaction = totals.points_issued / totals.issue_count if totals.issue_count else 0
+    adoption_rate = (segments.with_points / segments.customers * 100) if segments.customers > 0 else 0
     return {
         "total_points_issued": int(total_points_issued),
         "total_points_redeemed": abs(int(total_points_redeemed)),
@@ -431,64 +563,155 @@ def loyalty_performance(business_id: int = Query(...), loyalty_program_id: int =
         "loyalty_adoption_rate": round(adoption_rate, 2)
     }
 
-@router.get("/analytics/business_health")
-def business_health(business_id: int = Query(...), loyalty_program_id: int = Query(None), db: Session = Depends(get_db)):
-    """Get overall business health metrics"""
-    from sqlalchemy import func
-    from datetime import datetime, timedelta
-    
-    # Transaction frequency
-    last_30_days = datetime.utcnow() - timedelta(days=30)
-    last_60_days = datetime.utcnow() - timedelta(days=60)
-    
-    # Base filter
-    base_filter = [models.Transaction.business_id == business_id]
-    
-    # Add loyalty program filter if specified
-    if loyalty_program_id:
-        base_filter.append(models.Transaction.loyalty_program_id == loyalty_program_id)
-    
-    transactions_this_month = db.query(models.Transaction).filter(
-        *base_filter,
-        models.Transaction.timestamp >= last_30_days
-    ).count()
-    
-    transactions_last_month = db.query(models.Transaction).filter(
-        *base_filter,
-        models.Transaction.timestamp >= last_60_days,
-        models.Transaction.timestamp < last_30_days
-    ).count()
-    
-    # Growth rate
+def health_summary(db: Session, totals, customer_count: int, business_id: int, loyalty_program_id: Optional[int], tz: str):
+    last_30_days = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+    last_60_days = datetime.datetime.utcnow() - datetime.timedelta(days=60)
+
+    # Counts come from the hourly rollups
+    transactions_this_month = rollups.totals(
+        db, business_id, loyalty_program_id, since=last_30_days
+    ).transaction_count
+    transactions_last_month = rollups.totals(
+        db, business_id, loyalty_program_id, since=last_60_days, until=last_30_days
+    ).transaction_count
     growth_rate = ((transactions_this_month - transactions_last_month) / transactions_last_month * 100) if transactions_last_month > 0 else 0
-    
-    # Customer lifetime value estimate - simplified approach
-    # Get average spending per customer
-    customer_totals = db.query(
-        func.sum(models.Transaction.amount_spent).label('total')
-    ).filter(
-        *base_filter
-    ).group_by(models.Transaction.customer_id).subquery()
-    
-    avg_customer_value = db.query(func.avg(customer_totals.c.total)).scalar() or 0
-    
+
+    # Average spending per customer: rolled-up revenue over the number of distinct customers
+    avg_customer_value = totals.revenue / customer_count if customer_count else 0
+
     # Peak transaction hours
-    peak_hours = db.query(
-        func.strftime('%H', models.Transaction.timestamp).label('hour'),
-        func.count(models.Transaction.id).label('count')
-    ).filter(
-        *base_filter,
-        models.Transaction.timestamp >= last_30_days
-    ).group_by(func.strftime('%H', models.Transaction.timestamp)).order_by(func.count(models.Transaction.id).desc()).limit(3).all()
-    
+    hourly_counts = rollups.series(
+        db, lambda column: timebuckets.hour_of_day(db, column, tz, since=last_30_days), "transaction_count",
+        business_id, loyalty_program_id, since=last_30_days,
+        raw=not timebuckets.whole_hour_offsets(tz, last_30_days)
+    )
+    peak_hours = sorted(hourly_counts.items(), key=lambda item: item[1], reverse=True)[:3]
+
     return {
         "transactions_this_month": transactions_this_month,
         "transactions_last_month": transactions_last_month,
         "growth_rate": round(growth_rate, 2),
         "avg_customer_lifetime_value": round(float(avg_customer_value), 2),
-        "peak_hours": [{"hour": int(h[0]), "count": h[1]} for h in peak_hours if h[0]]
+        "peak_hours": [{"hour": int(h[0]), "count": h[1]} for h in peak_hours if h[0] is not None]
     }
 
+@router.get("/analytics/revenue_stats")
+def revenue_stats(
+    business_id: int = Query(...),
+    loyalty_program_id: int = Query(None),
+    tz: str = Query("UTC", description="IANA timezone the monthly trend is bucketed in, e.g. Africa/Harare"),
+    db: Session = Depends(get_read_db)
+):
+    """Get revenue statistics for the business"""
+    check_timezone(tz)
+    # Totals come from the hourly rollups rather than a scan of the transactions
+    totals = rollups.totals(db, business_id, loyalty_program_id)
+    return revenue_summary(db, totals, business_id, loyalty_program_id, tz)
+
+@router.get("/analytics/customer_insights")
+def customer_insights(business_id: int = Query(...), loyalty_program_id: int = Query(None), db: Session = Depends(get_read_db),
+                      approx: bool = Query(False, description="Estimate from the daily sketches instead of scanning")):
+    """
+    Get customer behavior insights.
+    With approx=true the answer comes from the daily sketches: active customers from merged HyperLogLogs,
+    high value customers as the top 20% of the estimated customer count (ties at the threshold aside)
+    and percentiles of the individual sale amounts from merged t-digests. Those are per sale, not per
+    customer like the exact high value threshold: a customer's total spans days, which daily sketches
+    can't add up. New and repeat customers need per-customer transaction counts, so they are only
+    available exactly. A business not yet sketched gets the exact answer.
+    """
+    last_30_days = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+    if approx:
+        merged = sketches.merged(db, business_id, loyalty_program_id)
+        if merged.as_of is not None:
+            customers = merged.customers.count()
+            return {
+                "active_customers_this_month": sketches.merged(
+                    db, business_id, loyalty_program_id, since=last_30_days
+                ).customers.count(),
+                "high_value_customers": customers // 5 + 1 if customers else 0,
+                "sale_amount_percentiles": {
+                    f"p{round(q * 100)}": round(merged.amounts.quantile(q) or 0, 2) for q in sketches.PERCENTILES
+                },
+                **approximation(merged, sketches.PERCENTILES)
+            }
+    return insights_summary(customer_segments(db, business_id, loyalty_program_id, since=last_30_days))
+
+@router.get("/analytics/loyalty_performance")
+def loyalty_performance(business_id: int = Query(...), loyalty_program_id: int = Query(None), db: Session = Depends(get_read_db)):
+    """Get loyalty program performance metrics"""
+    last_30_days = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+    totals = rollups.totals(db, business_id, loyalty_program_id)
+    return loyalty_summary(totals, customer_segments(db, business_id, loyalty_program_id, since=last_30_days))
+
+@router.get("/analytics/customer_distribution")
+def customer_distribution_stats(
+    business_id: int = Query(...),
+    loyalty_program_id: int = Query(None),
+    bins: int = Query(10, ge=1, le=100),
+    db: Session = Depends(get_read_db)
+):
+    """Distribution of customer spending, repeat rate and monthly cohorts"""
+    return customer_distribution(db, business_id, loyalty_program_id, bins)
+
+@router.get("/analytics/business_health")
+def business_health(
+    business_id: int = Query(...),
+    loyalty_program_id: int = Query(None),
+    tz: str = Query("UTC", description="IANA timezone the peak hours are reported in, e.g. Africa/Harare"),
+    db: Session = Depends(get_read_db),
+    approx: bool = Query(False, description="Estimate the customer count behind the lifetime value from the daily sketches")
+):
+    """Get overall business health metrics"""
+    from sqlalchemy import func
+    check_timezone(tz)
+    totals = rollups.totals(db, business_id, loyalty_program_id)
+
+    if approx:
+        merged = sketches.merged(db, business_id, loyalty_program_id)
+        if merged.as_of is not None:
+            health = health_summary(db, totals, merged.customers.count(), business_id, loyalty_program_id, tz)
+            return {**health, **approximation(merged)}
+
+    base_filter = [models.Transaction.business_id == business_id]
+    if loyalty_program_id:
+        base_filter.append(models.Transaction.loyalty_program_id == loyalty_program_id)
+    customer_count = db.query(func.count(func.distinct(models.Transaction.customer_id))).filter(
+        *base_filter
+    ).scalar() or 0
+    return health_summary(db, totals, customer_count, business_id, loyalty_program_id, tz)
+
+@router.get("/analytics/dashboard")
+def analytics_dashboard(
+    business_id: int = Query(...),
+    loyalty_program_id: int = Query(None),
+    tz: str = Query("UTC", description="IANA timezone the monthly trend and peak hours are reported in"),
+    db: Session = Depends(get_read_db)
+):
+    """
+    revenue_stats, customer_insights, loyalty_performance and business_health in one response.
+    The transactions are scanned once for the customer counts and every total comes from the
+    rollups; the result is cached for DASHBOARD_CACHE_TTL_SECONDS.
+    """
+    check_timezone(tz)
+    key = (business_id, loyalty_program_id or None, tz)
+    dashboard = dashboard_cache.get(key)
+    if dashboard is not None:
+        return dashboard
+
+    now = datetime.datetime.utcnow()
+    totals = rollups.totals(db, business_id, loyalty_program_id)
+    segments = customer_segments(db, business_id, loyalty_program_id, since=now - datetime.timedelta(days=30))
+    dashboard = {
+        "revenue_stats": revenue_summary(db, totals, business_id, loyalty_program_id, tz),
+        "customer_insights": insights_summary(segments),
+        "loyalty_performance": loyalty_summary(totals, segments),
+        "business_health": health_summary(db, totals, segments.customers, business_id, loyalty_program_id, tz),
+        "generated_at": now.isoformat()
+    }
+    dashboard_cache.set(key, dashboard)
+    return dashboard
+
 # --- Enhanced Referral/Affiliate Code Endpoints ---
 @router.get("/customers/{phone_number}/referral-code")
 def get_customer_referral_code(phone_number: str = Path(...), db: Session = Depends(get_db)):
@@ -530,10 +753,36 @@ def process_transaction_with_referral(
     amount_spent: float = Query(...),
     referral_code: str = Query(...),
     loyalty_program_id: int = Query(None),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     """Process a transaction where a new customer uses a referral code"""
     
+    # Reserve the key, or replay the original response for a retried request
+    scope = idempotency.scope("transaction_with_referral", "business", business_id)
+    if idempotency_key:
+        request = {
+            "business_id": business_id, "customer_phone_number": customer_phone_number, "amount_spent": amount_spent,
+            "referral_code": referral_code, "loyalty_program_id": loyalty_program_id
+        }
+        stored = idempotency.begin(db, scope, idempotency_key, request)
+        if stored is not None:
+            return stored
+    
+    try:
+        response = _process_transaction_with_referral(
+            db, business_id, customer_phone_number, amount_spent, referral_code, loyalty_program_id
+        )
+    except Exception:
+        if idempotency_key:
+            idempotency.release(db, scope, idempotency_key)
+        raise
+    if idempotency_key:
+        return idempotency.store_response(db, scope, idempotency_key, response)
+    return response
+
+def _process_transaction_with_referral(db: Session, business_id: int, customer_phone_number: str, amount_spent: float,
+                                       referral_code: str, loyalty_program_id: Optional[int]):
     # Find the referrer by code
     referrer = db.query(models.Customer).filter(models.Customer.referral_code == referral_code).first()
     if not referrer:
@@ -551,8 +800,8 @@ def process_transaction_with_referral(
             referral_code=generate_referral_code()
         )
         db.add(customer)
-        db.commit()
-        db.refresh(customer)
+        # Flushed, not committed: the customer commits with the earn and the idempotency reservation
+        db.flush()
     
     # Only process referral if this is a new customer
     if is_new_customer:
@@ -568,13 +817,13 @@ def process_transaction_with_referral(
         db.add(referral)
         
         # Award points to referrer (add to legacy total_points for backward compatibility)
-        referrer.total_points += 50
+        crud.credit_points(db, referrer, 50)
         
         # Process the transaction for the new customer
         business = db.query(models.Business).filter(models.Business.id == business_id).first()
         if business:
             points_earned = int(amount_spent * business.loyalty_rate)
-            customer.total_points += points_earned
+            crud.credit_points(db, customer, points_earned)
             
             # Create transaction record
             transaction = models.Transaction(
@@ -603,9 +852,13 @@ def process_transaction_with_referral(
             )
             db.add(referral_transaction)
             
+            # Both awards went to the legacy total_points, outside any program's balance
+            ledger.post(db, customer.id, None, points_earned, ledger.EARN, transaction)
+            ledger.post(db, referrer.id, None, 50, ledger.REFERRAL, referral_transaction)
+            
             db.commit()
             
-            return {
+            response = {
                 "message": "Transaction processed with referral bonus",
                 "new_customer": {
                     "phone_number": customer.phone_number,
@@ -619,11 +872,13 @@ def process_transaction_with_referral(
                 },
                 "referral_id": referral.id
             }
+            return response
+        raise HTTPException(status_code=404, detail="Business not found")
     else:
         raise HTTPException(status_code=400, detail="Customer already exists - referral code cannot be used")
 
 @router.get("/analytics/referral_performance")
-def referral_performance_analytics(business_id: int = Query(...), db: Session = Depends(get_db)):
+def referral_performance_analytics(business_id: int = Query(...), db: Session = Depends(get_read_db)):
     """Get referral program performance analytics"""
     from sqlalchemy import func
     from datetime import datetime, timedelta
@@ -711,6 +966,8 @@ def create_customer(
         referral_code=generate_referral_code()
     )
     db.add(customer)
+    db.flush()
+    ledger.post(db, customer.id, None, initial_points, ledger.ADJUSTMENT)
     db.commit()
     db.refresh(customer)
     
@@ -1,13 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query, Path
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Path, Header
 from sqlalchemy.orm import Session
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-import crud, schemas, auth, models
+import crud, schemas, auth, models, crud_loyalty_programs, idempotency
 from database import get_db
-from fastapi.security import OAuth2PasswordBearer
-from auth import oauth2_scheme
-from jose import JWTError, jwt
-from typing import List
+from auth import get_current_business
+from typing import List, Optional
 from pydantic import constr
 import re
 
@@ -16,24 +14,6 @@ router = APIRouter(
     tags=["loyalty"],
 )
 
-def get_current_business(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    try:
-        payload = jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    business = crud.get_business_by_email(db, email=email)
-    if business is None:
-        raise credentials_exception
-    return business
-
 def validate_phone_number(phone_number: str) -> str:
     # Zimbabwe phone number validation (basic, can be improved)
     if not re.fullmatch(r"^\+?\d{9,15}$", phone_number):
@@ -58,7 +38,8 @@ def set_loyalty_rate(
 def add_points(
     transaction: schemas.TransactionCreate,
     db: Session = Depends(get_db),
-    current_business: schemas.Business = Depends(get_current_business)
+    current_business: schemas.Business = Depends(get_current_business),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     if transaction.business_id != current_business.id:
         raise HTTPException(status_code=403, detail="Not authorized to add points for this business")
@@ -66,10 +47,21 @@ def add_points(
     validate_phone_number(transaction.customer_phone_number)
     if transaction.amount_spent <= 0:
         raise HTTPException(status_code=422, detail="Amount spent must be positive.")
+    # Reserve the key, or replay the original response for a retried request
+    scope = idempotency.scope("add_points", "business", current_business.id)
+    if idempotency_key:
+        stored = idempotency.begin(db, scope, idempotency_key, transaction)
+        if stored is not None:
+            return stored
     try:
-        return crud.add_points(db, transaction)
+        db_transaction = crud.add_points(db, transaction)
     except Exception as e:
+        if idempotency_key:
+            idempotency.release(db, scope, idempotency_key)
         raise HTTPException(status_code=400, detail=str(e))
+    if idempotency_key:
+        return idempotency.store_response(db, scope, idempotency_key, db_transaction)
+    return db_transaction
 
 @router.get("/customers/points/{phone_number}", response_model=schemas.CustomerPointsResponse)
 def get_customer_points(
@@ -86,7 +78,8 @@ def get_customer_points(
 def redeem_points(
     redemption: schemas.RedemptionCreate,
     db: Session = Depends(get_db),
-    current_business: schemas.Business = Depends(get_current_business)
+    current_business: schemas.Business = Depends(get_current_business),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     if redemption.business_id != current_business.id:
         raise HTTPException(status_code=403, detail="Not authorized to redeem points for this business")
@@ -96,18 +89,29 @@ def redeem_points(
     if redemption.points_to_redeem <= 0:
         raise HTTPException(status_code=422, detail="Points to redeem must be positive.")
     
+    # Reserve the key, or replay the original response for a retried request
+    scope = idempotency.scope("redeem_points", "business", current_business.id)
+    if idempotency_key:
+        stored = idempotency.begin(db, scope, idempotency_key, redemption)
+        if stored is not None:
+            return stored
+    
     try:
         transaction = crud.redeem_points(db, redemption)
-        
-        # Send SMS notification (placeholder for now)
-        send_sms_placeholder(
-            redemption.customer_phone_number, 
-            f"You have redeemed {redemption.points_to_redeem} points for: {redemption.reward_description}"
-        )
-        
-        return transaction
     except Exception as e:
+        if idempotency_key:
+            idempotency.release(db, scope, idempotency_key)
         raise HTTPException(status_code=400, detail=str(e))
+    
+    # Send SMS notification (placeholder for now)
+    send_sms_placeholder(
+        redemption.customer_phone_number, 
+        f"You have redeemed {redemption.points_to_redeem} points for: {redemption.reward_description}"
+    )
+    
+    if idempotency_key:
+        return idempotency.store_response(db, scope, idempotency_key, transaction)
+    return transaction
 
 # Placeholder for SMS function
 def send_sms_placeholder(phone_number: str, message: str):
@@ -124,32 +128,8 @@ def get_customer_available_rewards_public(
 ):
     """Public endpoint to get available rewards for a customer"""
     try:
-        # Get customer
-        customer = db.query(models.Customer).filter(models.Customer.phone_number == phone_number).first()
-        if not customer:
-            return []
-        
-        # Get customer memberships across all businesses
-        memberships = db.query(models.CustomerMembership).filter(
-            models.CustomerMembership.customer_id == customer.id
-        ).all()
-        
-        available_rewards = []
-        for membership in memberships:
-            # Get rewards for this program that the customer can see
-            rewards = db.query(models.Reward).filter(
-                models.Reward.loyalty_program_id == membership.loyalty_program_id,
-                models.Reward.is_active == True
-            ).all()
-            
-            for reward in rewards:
-                available_rewards.append({
-                    'reward': reward,
-                    'membership': membership,
-                    'customer_points': membership.points
-                })
-        
-        return available_rewards
+        # Every active reward, affordable or not, so the portal can show what to work towards
+        return crud_loyalty_programs.get_available_rewards_for_customer(db, phone_number, affordable_only=False)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -159,7 +139,8 @@ def get_customer_available_rewards_public(
 @router.post("/customers/redeem-reward")
 def redeem_reward_public(
     redemption: dict,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     """Public endpoint to redeem a reward for a customer"""
     try:
@@ -177,12 +158,10 @@ def redeem_reward_public(
         reward_description = redemption['reward_description']
         loyalty_program_id = redemption['loyalty_program_id']
         
-        # Find customer
-        customer = db.query(models.Customer).filter(models.Customer.phone_number == phone_number).first()
-        if not customer:
+        if not isinstance(points_to_redeem, int) or points_to_redeem <= 0:
             raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Customer not found"
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="Points to redeem must be a positive integer."
             )
         
         # Get loyalty program
@@ -193,45 +172,29 @@ def redeem_reward_public(
                 detail="Loyalty program not found"
             )
         
-        # Get customer membership
-        membership = db.query(models.CustomerMembership).filter(
-            models.CustomerMembership.customer_id == customer.id,
-            models.CustomerMembership.loyalty_program_id == loyalty_program_id
-        ).first()
-        
-        if not membership:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Customer is not a member of this loyalty program"
-            )
-        
-        # Check if customer has enough points
-        if membership.points < points_to_redeem:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Not enough points. Customer has {membership.points} points, but {points_to_redeem} were requested."
-            )
-        
-        # Deduct points from program membership
-        membership.points -= points_to_redeem
-        
-        # Also deduct from total points for backward compatibility
-        customer.total_points -= points_to_redeem
-        
-        # Create transaction
-        transaction = models.Transaction(
-            business_id=program.business_id,
-            customer_id=customer.id,
-            loyalty_program_id=loyalty_program_id,
-            amount_spent=0,
-            points_earned=-points_to_redeem,
-            transaction_type=models.TransactionType.REDEMPTION,
-            reward_description=reward_description
-        )
-        
-        db.add(transaction)
-        db.commit()
-        db.refresh(transaction)
+        # Reserve the key, or replay the original response for a retried request
+        scope = idempotency.scope("redeem_reward_public", "customer", phone_number)
+        if idempotency_key:
+            stored = idempotency.begin(db, scope, idempotency_key, redemption)
+            if stored is not None:
+                return stored
+        
+        # Deduct the points atomically through the shared redemption path
+        try:
+            transaction = crud_loyalty_programs.redeem_reward(db, schemas.RedemptionCreate(
+                business_id=program.business_id,
+                customer_phone_number=phone_number,
+                points_to_redeem=points_to_redeem,
+                reward_description=reward_description,
+                loyalty_program_id=loyalty_program_id
+            ))
+        except Exception as e:
+            if idempotency_key:
+                idempotency.release(db, scope, idempotency_key)
+            error_msg = str(e)
+            if "Customer not found" in error_msg or "not a member" in error_msg:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=error_msg)
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=error_msg)
         
         # Send SMS notification
         send_sms_placeholder(
@@ -239,6 +202,8 @@ def redeem_reward_public(
             f"You have redeemed {points_to_redeem} points for: {reward_description}"
         )
         
+        if idempotency_key:
+            return idempotency.store_response(db, scope, idempotency_key, transaction)
         return transaction
         
     except HTTPException:
@@ -1,12 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query, Path
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Path, Header
 from sqlalchemy.orm import Session
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-import crud, schemas, auth, crud_loyalty_programs, models
+import crud, schemas, auth, crud_loyalty_programs, models, idempotency, tiers, memberships
 from database import get_db
 from typing import List, Optional
-from auth import oauth2_scheme
-from jose import JWTError, jwt
+from auth import get_current_business
 from pydantic import constr
 import re
 
@@ -15,25 +14,6 @@ router = APIRouter(
     tags=["loyalty-programs"],
 )
 
-# Authentication helper function
-def get_current_business(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    try:
-        payload = jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    business = crud.get_business_by_email(db, email=email)
-    if business is None:
-        raise credentials_exception
-    return business
-
 # Create a new loyalty program
 @router.post("/", response_model=schemas.LoyaltyProgram)
 def create_loyalty_program(
@@ -131,12 +111,43 @@ def delete_loyalty_program(
     deleted_program = crud_loyalty_programs.delete_loyalty_program(db, program_id)
     return deleted_program
 
+# Recompute the tier of every member of a tiered program, e.g. after its thresholds change
+@router.post("/{program_id}/recalculate-tiers", response_model=schemas.TierRecalculationResult)
+def recalculate_program_tiers(
+    program_id: int = Path(..., gt=0),
+    db: Session = Depends(get_db),
+    current_business: schemas.Business = Depends(get_current_business)
+):
+    # Check program exists
+    existing_program = crud_loyalty_programs.get_loyalty_program(db, program_id)
+    if not existing_program:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Loyalty program not found"
+        )
+    
+    # Verify business owns the program
+    if existing_program.business_id != current_business.id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not authorized to recalculate tiers for this program"
+        )
+    
+    if existing_program.program_type != models.LoyaltyProgramType.TIERED:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Only tiered programs have tiers to recalculate"
+        )
+    
+    return vars(tiers.recalculate_program(db, program_id))
+
 # Process a transaction with a loyalty program
 @router.post("/transaction", response_model=schemas.Transaction)
 def process_transaction(
     transaction: schemas.TransactionCreate,
     db: Session = Depends(get_db),
-    current_business: schemas.Business = Depends(get_current_business)
+    current_business: schemas.Business = Depends(get_current_business),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     # Verify business owns the transaction
     if transaction.business_id != current_business.id:
@@ -160,13 +171,74 @@ def process_transaction(
                 detail="Not authorized to use this loyalty program"
             )
     
+    # Reserve the key, or replay the original response for a retried request
+    scope = idempotency.scope("process_transaction", "business", current_business.id)
+    if idempotency_key:
+        stored = idempotency.begin(db, scope, idempotency_key, transaction)
+        if stored is not None:
+            return stored
+    
     try:
-        return crud_loyalty_programs.process_transaction(db, transaction)
+        db_transaction = crud_loyalty_programs.process_transaction(db, transaction)
     except Exception as e:
+        if idempotency_key:
+            idempotency.release(db, scope, idempotency_key)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(e)
         )
+    
+    if idempotency_key:
+        return idempotency.store_response(db, scope, idempotency_key, db_transaction)
+    return db_transaction
+
+# Maximum number of rows accepted in a single bulk upload
+MAX_BULK_TRANSACTIONS = 5000
+
+# Process a batch of transactions uploaded by a till
+@router.post("/transactions/bulk", response_model=schemas.BulkTransactionResult)
+def process_transactions_bulk(
+    batch: schemas.BulkTransactionCreate,
+    db: Session = Depends(get_db),
+    current_business: schemas.Business = Depends(get_current_business),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    if len(batch.transactions) > MAX_BULK_TRANSACTIONS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"A batch may contain at most {MAX_BULK_TRANSACTIONS} transactions"
+        )
+    
+    # Verify business owns every transaction in the batch
+    if any(t.business_id != current_business.id for t in batch.transactions):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not authorized to process transactions for this business"
+        )
+    
+    # Reserve the key, or replay the original response for a retried upload
+    scope = idempotency.scope("process_transactions_bulk", "business", current_business.id)
+    if idempotency_key:
+        stored = idempotency.begin(db, scope, idempotency_key, batch)
+        if stored is not None:
+            return stored
+    
+    try:
+        results = crud_loyalty_programs.process_transactions_bulk(db, batch.transactions)
+    except Exception:
+        if idempotency_key:
+            idempotency.release(db, scope, idempotency_key)
+        raise
+    failed = sum(1 for r in results if not r["success"])
+    response = {
+        "processed": len(results) - failed,
+        "failed": failed,
+        "results": results
+    }
+    
+    if idempotency_key:
+        return idempotency.store_response(db, scope, idempotency_key, response)
+    return response
 
 # Process a referral
 @router.post("/referral", response_model=schemas.Referral)
@@ -247,6 +319,29 @@ def enroll_in_paid_membership(
     
     return membership
 
+# Count the active members of a paid membership program
+@router.get("/paid-membership/{program_id}/members")
+def count_paid_members(
+    program_id: int = Path(..., gt=0),
+    db: Session = Depends(get_db),
+    current_business: schemas.Business = Depends(get_current_business)
+):
+    program = crud_loyalty_programs.get_loyalty_program(db, program_id)
+    if not program:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Loyalty program not found"
+        )
+    
+    if program.business_id != current_business.id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not authorized to view this program"
+        )
+    
+    # Lapsed memberships are cleared by the expiry sweep, so the flag alone is an indexed count
+    return {"program_id": program_id, "paid_members": memberships.paid_member_count(db, program_id)}
+
 # Get a customer's memberships
 @router.get("/customer/{phone_number}/memberships", response_model=List[schemas.CustomerMembership])
 def get_customer_memberships(
@@ -330,7 +425,8 @@ def get_customer_available_rewards(
 def redeem_reward(
     redemption: schemas.RedemptionCreate,
     db: Session = Depends(get_db),
-    current_business: schemas.Business = Depends(get_current_business)
+    current_business: schemas.Business = Depends(get_current_business),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     # Verify business owns the redemption
     if redemption.business_id != current_business.id:
@@ -339,13 +435,26 @@ def redeem_reward(
             detail="Not authorized to process redemptions for this business"
         )
     
+    # Reserve the key, or replay the original response for a retried request
+    scope = idempotency.scope("redeem_reward", "business", current_business.id)
+    if idempotency_key:
+        stored = idempotency.begin(db, scope, idempotency_key, redemption)
+        if stored is not None:
+            return stored
+    
     try:
-        return crud_loyalty_programs.redeem_reward(db, redemption)
+        transaction = crud_loyalty_programs.redeem_reward(db, redemption)
     except Exception as e:
+        if idempotency_key:
+            idempotency.release(db, scope, idempotency_key)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(e)
         )
+    
+    if idempotency_key:
+        return idempotency.store_response(db, scope, idempotency_key, transaction)
+    return transaction
 
 @router.get("/customer/{phone_number}/memberships", response_model=List[schemas.CustomerMembership])
 def get_customer_memberships_for_business(
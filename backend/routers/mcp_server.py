@@ -1,12 +1,14 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import Dict, Any, Optional
+from sqlalchemy import case, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, Any, List, Optional
 from pydantic import BaseModel
+import asyncio
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-import crud, schemas, models
-from database import get_db
-from routers.extra import get_recommendations
+import crud, schemas, models, pagination
+from database import get_async_db, AsyncSessionLocal
+from routers.extra import recommendations_for_customer
 
 router = APIRouter(
     prefix="/mcp",
@@ -25,33 +27,79 @@ class MCPToolResponse(BaseModel):
     error: Optional[str] = None
     context: Optional[Dict[str, Any]] = {}
 
+class MCPBatchRequest(BaseModel):
+    requests: List[MCPToolRequest]
+
+class MCPBatchResponse(BaseModel):
+    results: List[MCPToolResponse]
+
+# Maximum number of tool calls accepted in one batch
+MAX_BATCH_TOOLS = 10
+
 # MCP Tool Execution Endpoint
 @router.post("/tool", response_model=MCPToolResponse)
 async def execute_mcp_tool(
     request: MCPToolRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Execute MCP tools with proper context handling
     """
+    return await run_mcp_tool(request, db)
+
+# MCP Batch Tool Execution Endpoint
+@router.post("/tools/batch", response_model=MCPBatchResponse)
+async def execute_mcp_tools_batch(
+    batch: MCPBatchRequest,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Execute several MCP tools concurrently, returning the results in request order
+    """
+    if len(batch.requests) > MAX_BATCH_TOOLS:
+        raise HTTPException(status_code=413, detail=f"A batch may contain at most {MAX_BATCH_TOOLS} tool calls")
+    
+    # Resolve every phone number in the batch with one query, shared by all the tools
+    phone_numbers = {
+        r.parameters.get("phone_number") for r in batch.requests if r.parameters.get("phone_number")
+    }
+    customers = {}
+    if phone_numbers:
+        rows = await db.scalars(select(models.Customer).where(models.Customer.phone_number.in_(phone_numbers)))
+        customers = {c.phone_number: c for c in rows}
+    
+    async def run(request: MCPToolRequest):
+        # An AsyncSession can't be shared by concurrent tasks, so each tool gets its own
+        async with AsyncSessionLocal() as session:
+            return await run_mcp_tool(request, session, customers)
+    
+    results = await asyncio.gather(*(run(r) for r in batch.requests))
+    return MCPBatchResponse(results=results)
+
+async def run_mcp_tool(
+    request: MCPToolRequest,
+    db: AsyncSession,
+    customers: Optional[Dict[str, models.Customer]] = None
+) -> MCPToolResponse:
+    """Dispatch one tool call; customers holds customers already looked up by the caller"""
+    context = request.context or {}
     try:
         tool_name = request.tool
         parameters = request.parameters
-        context = request.context or {}
         
         # Tool dispatch
         if tool_name == "check_points":
-            result = await execute_check_points(parameters, db)
+            result = await execute_check_points(parameters, db, customers)
         elif tool_name == "get_recommendations":
-            result = await execute_get_recommendations(parameters, db)
+            result = await execute_get_recommendations(parameters, db, customers)
         elif tool_name == "explain_referrals":
             result = await execute_explain_referrals(parameters, db)
         elif tool_name == "get_business_info":
             result = await execute_get_business_info(parameters, db)
         elif tool_name == "get_customer_transactions":
-            result = await execute_get_customer_transactions(parameters, db)
+            result = await execute_get_customer_transactions(parameters, db, customers)
         elif tool_name == "get_analytics":
-            result = await execute_get_analytics(parameters, db)
+            result = await execute_get_analytics(parameters, db, customers)
         else:
             return MCPToolResponse(
                 success=False,
@@ -73,16 +121,29 @@ async def execute_mcp_tool(
             context=context
         )
 
+async def find_customer(db: AsyncSession, phone_number: str, customers: Optional[Dict[str, models.Customer]] = None):
+    """Look up a customer by phone number, using the batch's prefetched customers when given"""
+    if customers is not None:
+        return customers.get(phone_number)
+    return await db.scalar(select(models.Customer).where(models.Customer.phone_number == phone_number))
+
 # Tool Implementations
-async def execute_check_points(parameters: Dict[str, Any], db: Session) -> Dict[str, Any]:
+async def execute_check_points(
+    parameters: Dict[str, Any],
+    db: AsyncSession,
+    customers: Optional[Dict[str, models.Customer]] = None
+) -> Dict[str, Any]:
     """Check customer points and transaction history"""
     try:
         phone_number = parameters.get("phone_number")
         if not phone_number:
             return {"success": False, "error": "Phone number is required"}
         
-        # Use existing CRUD function
-        result = crud.get_customer_points(db, phone_number)
+        customer = await find_customer(db, phone_number, customers)
+        if not customer:
+            raise Exception("Customer not found")
+        # Use existing CRUD function, run on the async connection
+        result = await db.run_sync(lambda session: crud.customer_points_summary(session, customer))
         return {
             "success": True,
             "data": {
@@ -108,7 +169,11 @@ async def execute_check_points(parameters: Dict[str, Any], db: Session) -> Dict[
             }
         return {"success": False, "error": f"Error checking points: {error_msg}"}
 
-async def execute_get_recommendations(parameters: Dict[str, Any], db: Session) -> Dict[str, Any]:
+async def execute_get_recommendations(
+    parameters: Dict[str, Any],
+    db: AsyncSession,
+    customers: Optional[Dict[str, models.Customer]] = None
+) -> Dict[str, Any]:
     """Get personalized recommendations for a customer"""
     try:
         phone_number = parameters.get("phone_number")
@@ -117,8 +182,11 @@ async def execute_get_recommendations(parameters: Dict[str, Any], db: Session) -
         if not phone_number:
             return {"success": False, "error": "Phone number is required"}
         
-        # Use existing recommendation function
-        result = get_recommendations(phone_number, business_id, db)
+        customer = await find_customer(db, phone_number, customers)
+        if not customer:
+            return {"success": False, "error": "Customer not found"}
+        # Use existing recommendation function, run on the async connection
+        result = await db.run_sync(lambda session: recommendations_for_customer(session, customer, business_id))
         return {
             "success": True,
             "data": result
@@ -126,7 +194,7 @@ async def execute_get_recommendations(parameters: Dict[str, Any], db: Session) -
     except Exception as e:
         return {"success": False, "error": str(e)}
 
-async def execute_explain_referrals(parameters: Dict[str, Any], db: Session) -> Dict[str, Any]:
+async def execute_explain_referrals(parameters: Dict[str, Any], db: AsyncSession) -> Dict[str, Any]:
     """Explain how the referral system works"""
     return {
         "success": True,
@@ -152,13 +220,13 @@ async def execute_explain_referrals(parameters: Dict[str, Any], db: Session) ->
         }
     }
 
-async def execute_get_business_info(parameters: Dict[str, Any], db: Session) -> Dict[str, Any]:
+async def execute_get_business_info(parameters: Dict[str, Any], db: AsyncSession) -> Dict[str, Any]:
     """Get information about participating businesses"""
     try:
         business_id = parameters.get("business_id")
         
         if business_id:
-            business = db.query(models.Business).filter(models.Business.id == business_id).first()
+            business = await db.scalar(select(models.Business).where(models.Business.id == business_id))
             if not business:
                 return {"success": False, "error": "Business not found"}
             
@@ -174,7 +242,7 @@ async def execute_get_business_info(parameters: Dict[str, Any], db: Session) ->
             }
         else:
             # Return general business info
-            businesses = db.query(models.Business).limit(10).all()
+            businesses = (await db.scalars(select(models.Business).limit(10))).all()
             return {
                 "success": True,
                 "data": {
@@ -192,22 +260,40 @@ async def execute_get_business_info(parameters: Dict[str, Any], db: Session) ->
     except Exception as e:
         return {"success": False, "error": str(e)}
 
-async def execute_get_customer_transactions(parameters: Dict[str, Any], db: Session) -> Dict[str, Any]:
+async def execute_get_customer_transactions(
+    parameters: Dict[str, Any],
+    db: AsyncSession,
+    customers: Optional[Dict[str, models.Customer]] = None
+) -> Dict[str, Any]:
     """Get detailed customer transaction history"""
     try:
         phone_number = parameters.get("phone_number")
-        limit = parameters.get("limit", 20)
+        limit = max(1, min(int(parameters.get("limit", 20)), pagination.MAX_PAGE_SIZE))
+        cursor = parameters.get("cursor")
         
         if not phone_number:
             return {"success": False, "error": "Phone number is required"}
         
-        customer = db.query(models.Customer).filter(models.Customer.phone_number == phone_number).first()
+        customer = await find_customer(db, phone_number, customers)
         if not customer:
             return {"success": False, "error": "Customer not found"}
         
-        transactions = db.query(models.Transaction).filter(
-            models.Transaction.customer_id == customer.id
-        ).order_by(models.Transaction.timestamp.desc()).limit(limit).all()
+        # Join the business name in, since relationships can't lazy-load on an async session
+        query = (
+            select(models.Transaction, models.Business.name)
+            .outerjoin(models.Business, models.Transaction.business_id == models.Business.id)
+            .where(models.Transaction.customer_id == customer.id)
+        )
+        if cursor:
+            query = query.where(pagination.older_than(
+                models.Transaction.timestamp, models.Transaction.id, pagination.decode_cursor(cursor)
+            ))
+        rows = (await db.execute(
+            query.order_by(models.Transaction.timestamp.desc(), models.Transaction.id.desc()).limit(limit)
+        )).all()
+        next_cursor = None
+        if rows and len(rows) == limit:
+            next_cursor = pagination.encode_cursor(rows[-1][0].timestamp, rows[-1][0].id)
         
         return {
             "success": True,
@@ -215,23 +301,28 @@ async def execute_get_customer_transactions(parameters: Dict[str, Any], db: Sess
                 "transactions": [
                     {
                         "id": tx.id,
-                        "business_name": tx.business.name if tx.business else "Unknown",
+                        "business_name": business_name or "Unknown",
                         "amount_spent": tx.amount_spent,
                         "points_earned": tx.points_earned,
                         "transaction_type": tx.transaction_type.value,
                         "timestamp": tx.timestamp.isoformat(),
                         "reward_description": tx.reward_description
                     }
-                    for tx in transactions
+                    for tx, business_name in rows
                 ],
-                "total_transactions": len(transactions),
+                "total_transactions": len(rows),
+                "next_cursor": next_cursor,
                 "customer_total_points": customer.total_points
             }
         }
     except Exception as e:
         return {"success": False, "error": str(e)}
 
-async def execute_get_analytics(parameters: Dict[str, Any], db: Session) -> Dict[str, Any]:
+async def execute_get_analytics(
+    parameters: Dict[str, Any],
+    db: AsyncSession,
+    customers: Optional[Dict[str, models.Customer]] = None
+) -> Dict[str, Any]:
     """Get analytics data for businesses or customers"""
     try:
         analytics_type = parameters.get("type", "customer")
@@ -239,18 +330,20 @@ async def execute_get_analytics(parameters: Dict[str, Any], db: Session) -> Dict
         business_id = parameters.get("business_id")
         
         if analytics_type == "customer" and phone_number:
-            customer = db.query(models.Customer).filter(models.Customer.phone_number == phone_number).first()
+            customer = await find_customer(db, phone_number, customers)
             if not customer:
                 return {"success": False, "error": "Customer not found"}
             
-            # Get customer analytics
-            transactions = db.query(models.Transaction).filter(
-                models.Transaction.customer_id == customer.id
-            ).all()
-            
-            total_spent = sum(tx.amount_spent for tx in transactions)
-            points_earned = sum(tx.points_earned for tx in transactions if tx.points_earned > 0)
-            points_redeemed = sum(abs(tx.points_earned) for tx in transactions if tx.points_earned < 0)
+            # Get customer analytics, aggregated in the database
+            stats = (await db.execute(
+                select(
+                    func.count(models.Transaction.id),
+                    func.coalesce(func.sum(models.Transaction.amount_spent), 0),
+                    func.coalesce(func.sum(case((models.Transaction.points_earned > 0, models.Transaction.points_earned), else_=0)), 0),
+                    func.coalesce(func.sum(case((models.Transaction.points_earned < 0, -models.Transaction.points_earned), else_=0)), 0)
+                ).where(models.Transaction.customer_id == customer.id)
+            )).one()
+            total_transactions, total_spent, points_earned, points_redeemed = stats
             
             return {
                 "success": True,
@@ -260,8 +353,8 @@ async def execute_get_analytics(parameters: Dict[str, Any], db: Session) -> Dict
                         "total_spent": total_spent,
                         "points_earned": points_earned,
                         "points_redeemed": points_redeemed,
-                        "total_transactions": len(transactions),
-                        "average_transaction": total_spent / len(transactions) if transactions else 0
+                        "total_transactions": total_transactions,
+                        "average_transaction": total_spent / total_transactions if total_transactions else 0
                     }
                 }
             }
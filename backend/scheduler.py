@@ -0,0 +1,48 @@
+"""
+Minimal in-process scheduler for periodic maintenance jobs.
+Each job runs in a worker thread with its own database session so it never blocks request handling.
+"""
+
+import asyncio
+from typing import Callable, List, Tuple
+
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+
+_jobs: List[Tuple[str, float, Callable[[Session], object]]] = []
+_tasks: List[asyncio.Task] = []
+
+
+def register_job(name: str, interval_seconds: float, func: Callable[[Session], object]):
+    """Run func(db) every interval_seconds once the scheduler is started"""
+    _jobs.append((name, interval_seconds, func))
+
+
+def run_job(func: Callable[[Session], object]):
+    db = SessionLocal()
+    try:
+        return func(db)
+    finally:
+        db.close()
+
+
+async def _run_periodically(name: str, interval_seconds: float, func: Callable[[Session], object]):
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await asyncio.to_thread(run_job, func)
+        except Exception as e:
+            print(f"[Scheduler] Job {name} failed: {e}")
+
+
+def start():
+    for name, interval_seconds, func in _jobs:
+        _tasks.append(asyncio.create_task(_run_periodically(name, interval_seconds, func)))
+
+
+async def stop():
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
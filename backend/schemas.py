@@ -225,3 +225,26 @@ class ReferralTransactionCreate(BaseModel):
     referral_code: str
     customer_phone_number: str
     loyalty_program_id: int
+
+# Bulk transaction upload (e.g. POS batches buffered offline)
+class BulkTransactionCreate(BaseModel):
+    transactions: List[TransactionCreate]
+
+class BulkTransactionRowResult(BaseModel):
+    index: int
+    success: bool
+    transaction_id: Optional[int] = None
+    points_earned: Optional[int] = None
+    cashback_amount: Optional[float] = None
+    error: Optional[str] = None
+
+class BulkTransactionResult(BaseModel):
+    processed: int
+    failed: int
+    results: List[BulkTransactionRowResult]
+
+# Outcome of recomputing every member's tier in a program
+class TierRecalculationResult(BaseModel):
+    program_id: int
+    members: int
+    moved: int
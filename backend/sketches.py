@@ -0,0 +1,273 @@
+"""
+Approximate analytics from mergeable daily sketches.
+For every business, program and UTC day, transaction_sketches holds a HyperLogLog of the customer ids
+and a t-digest of the sale amounts. Merging the days of a window answers distinct-customer counts and
+sale amount percentiles in milliseconds, with a known error, however long the history is.
+
+Usage: python sketches.py refresh                     sketch the days with transactions since the last refresh
+       python sketches.py rebuild [--business-id N]   re-sketch every day from the raw transactions
+"""
+
+import argparse
+import datetime
+import math
+import os
+from types import SimpleNamespace
+from typing import Iterable, List, Optional
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+import models, timebuckets
+
+HLL_PRECISION = 12  # 4096 one-byte registers per day: 1.6% standard error
+TDIGEST_COMPRESSION = 200  # about 100 centroids per digest
+SKETCH_REFRESH_SECONDS = int(os.getenv("SKETCH_REFRESH_SECONDS", "300"))
+# Transactions can commit slightly out of id order, so each refresh looks this far below the watermark again
+REFRESH_OVERLAP_IDS = 1000
+PERCENTILES = (0.5, 0.8, 0.9, 0.99)
+
+
+def _hash64(values: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer: spreads consecutive ids over all 64 bits"""
+    with np.errstate(over="ignore"):
+        x = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def _bit_length(values: np.ndarray) -> np.ndarray:
+    length = np.zeros(len(values), dtype=np.int64)
+    values = values.copy()
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = values >= (np.uint64(1) << np.uint64(shift))
+        length[high] += shift
+        values[high] >>= np.uint64(shift)
+    return length + (values > 0)
+
+
+class HyperLogLog:
+    """Distinct-count sketch; merging two sketches gives the sketch of the union"""
+
+    def __init__(self, precision: int = HLL_PRECISION, registers: Optional[np.ndarray] = None):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8) if registers is None else registers
+
+    def add(self, values: Iterable[int]):
+        hashes = _hash64(np.fromiter(values, dtype=np.int64))
+        if not len(hashes):
+            return
+        suffix_bits = 64 - self.precision
+        index = (hashes >> np.uint64(suffix_bits)).astype(np.intp)
+        # Rank of the first 1 bit in the rest of the hash
+        rank = suffix_bits - _bit_length(hashes & np.uint64((1 << suffix_bits) - 1)) + 1
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+
+    def merge(self, other: "HyperLogLog"):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self) -> int:
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate while many registers are still empty
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def relative_error(self) -> float:
+        """Two standard errors: the count is within this fraction of the truth about 95% of the time"""
+        return 2 * 1.04 / math.sqrt(len(self.registers))
+
+    def to_bytes(self) -> bytes:
+        return self.registers.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        registers = np.frombuffer(data, dtype=np.uint8).copy()
+        return cls(int(math.log2(len(registers))), registers)
+
+
+class TDigest:
+    """
+    Quantile sketch: weighted centroids, each covering at most one unit of the k1 scale
+    k(q) = compression / 2pi * asin(2q - 1), so they stay small near the tails.
+    Digests merge by clustering their centroids again.
+    """
+
+    def __init__(self, compression: float = TDIGEST_COMPRESSION):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = math.inf
+        self.max = -math.inf
+
+    @property
+    def total(self) -> float:
+        return float(self.weights.sum())
+
+    def add(self, values: Iterable[float]):
+        values = np.fromiter(values, dtype=np.float64)
+        if len(values):
+            self.min = min(self.min, float(values.min()))
+            self.max = max(self.max, float(values.max()))
+            self._cluster(np.concatenate([self.means, values]), np.concatenate([self.weights, np.ones(len(values))]))
+
+    @classmethod
+    def merge_all(cls, digests: List["TDigest"], compression: float = TDIGEST_COMPRESSION) -> "TDigest":
+        merged = cls(compression)
+        digests = [digest for digest in digests if len(digest.weights)]
+        if digests:
+            merged.min = min(digest.min for digest in digests)
+            merged.max = max(digest.max for digest in digests)
+            merged._cluster(
+                np.concatenate([digest.means for digest in digests]),
+                np.concatenate([digest.weights for digest in digests])
+            )
+        return merged
+
+    def _cluster(self, means: np.ndarray, weights: np.ndarray):
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+        # Each centroid joins the cluster its left edge falls in on the k scale
+        left_edge = (np.cumsum(weights) - weights) / weights.sum()
+        k = self.compression / (2 * math.pi) * np.arcsin(2 * left_edge - 1)
+        cluster = np.floor(k + self.compression / 4).astype(np.intp)
+        cluster_weights = np.bincount(cluster, weights=weights)
+        cluster_sums = np.bincount(cluster, weights=means * weights)
+        used = cluster_weights > 0
+        self.means = cluster_sums[used] / cluster_weights[used]
+        self.weights = cluster_weights[used]
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not len(self.weights):
+            return None
+        total = self.total
+        centers = np.cumsum(self.weights) - self.weights / 2
+        return float(np.interp(
+            q * total, np.concatenate([[0], centers, [total]]), np.concatenate([[self.min], self.means, [self.max]])
+        ))
+
+    def rank_error(self, q: float) -> float:
+        """Half the width of a centroid at q, as a fraction of all values: the answer's rank is off by at most about this"""
+        return math.pi * math.sqrt(q * (1 - q)) / self.compression
+
+    def to_bytes(self) -> bytes:
+        header = [self.compression, self.min, self.max]
+        return np.concatenate([header, self.means, self.weights]).astype(np.float64).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "TDigest":
+        values = np.frombuffer(data, dtype=np.float64)
+        digest = cls(float(values[0]))
+        digest.min, digest.max = float(values[1]), float(values[2])
+        centroids = (len(values) - 3) // 2
+        digest.means = values[3:3 + centroids].copy()
+        digest.weights = values[3 + centroids:].copy()
+        return digest
+
+
+def sketch_day(db: Session, business_id: int, loyalty_program_id: int, day: datetime.date):
+    """Build (or rebuild) the sketches of one business, program and day from its transactions"""
+    transaction = models.Transaction
+    start = datetime.datetime.combine(day, datetime.time.min)
+    program_filter = (
+        transaction.loyalty_program_id == loyalty_program_id if loyalty_program_id
+        else transaction.loyalty_program_id.is_(None)
+    )
+    rows = db.query(transaction.id, transaction.customer_id, transaction.amount_spent).filter(
+        transaction.business_id == business_id,
+        program_filter,
+        transaction.timestamp >= start,
+        transaction.timestamp < start + datetime.timedelta(days=1),
+    ).all()
+
+    customers = HyperLogLog()
+    customers.add(row.customer_id for row in rows if row.customer_id is not None)
+    amounts = TDigest()
+    amounts.add(row.amount_spent for row in rows if row.amount_spent and row.amount_spent > 0)
+
+    sketch = db.query(models.TransactionSketch).filter(
+        models.TransactionSketch.business_id == business_id,
+        models.TransactionSketch.loyalty_program_id == loyalty_program_id,
+        models.TransactionSketch.day == day,
+    ).first()
+    if sketch is None:
+        sketch = models.TransactionSketch(business_id=business_id, loyalty_program_id=loyalty_program_id, day=day)
+        db.add(sketch)
+    sketch.customers = customers.to_bytes()
+    sketch.amounts = amounts.to_bytes()
+    sketch.last_transaction_id = max([row.id for row in rows], default=0)
+    sketch.built_at = datetime.datetime.utcnow()
+
+
+def _sketch_days(db: Session, query) -> int:
+    transaction = models.Transaction
+    day = timebuckets.truncate(db, transaction.timestamp, "day")
+    keys = query.with_entities(
+        transaction.business_id, func.coalesce(transaction.loyalty_program_id, 0), day
+    ).filter(transaction.business_id.isnot(None), transaction.timestamp.isnot(None)).distinct().all()
+    for business_id, program_id, label in keys:
+        sketch_day(db, business_id, program_id, datetime.date.fromisoformat(label))
+    db.commit()
+    return len(keys)
+
+
+def refresh(db: Session) -> int:
+    """Re-sketch the days that received transactions since the last refresh; returns how many"""
+    watermark = db.query(func.max(models.TransactionSketch.last_transaction_id)).scalar() or 0
+    return _sketch_days(db, db.query(models.Transaction).filter(
+        models.Transaction.id > watermark - REFRESH_OVERLAP_IDS
+    ))
+
+
+def rebuild(db: Session, business_id: Optional[int] = None) -> int:
+    """Drop and re-sketch every day of one business (or all of them); returns the number of days"""
+    sketches = db.query(models.TransactionSketch)
+    transactions = db.query(models.Transaction)
+    if business_id is not None:
+        sketches = sketches.filter(models.TransactionSketch.business_id == business_id)
+        transactions = transactions.filter(models.Transaction.business_id == business_id)
+    sketches.delete(synchronize_session=False)
+    return _sketch_days(db, transactions)
+
+
+def merged(db: Session, business_id: int, loyalty_program_id: Optional[int] = None,
+           since: Optional[datetime.datetime] = None):
+    """
+    The sketches of a business (and program) merged over every day from since on; days are whole
+    UTC days, so a window starting mid-day also counts the earlier part of that day
+    """
+    sketch = models.TransactionSketch
+    query = db.query(sketch.customers, sketch.amounts, sketch.built_at).filter(sketch.business_id == business_id)
+    if loyalty_program_id:
+        query = query.filter(sketch.loyalty_program_id == loyalty_program_id)
+    if since is not None:
+        query = query.filter(sketch.day >= since.date())
+
+    customers = HyperLogLog()
+    digests = []
+    as_of = None
+    for row in query:
+        customers.merge(HyperLogLog.from_bytes(row.customers))
+        digests.append(TDigest.from_bytes(row.amounts))
+        as_of = max(as_of, row.built_at) if as_of else row.built_at
+    return SimpleNamespace(customers=customers, amounts=TDigest.merge_all(digests), as_of=as_of)
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("command", choices=["refresh", "rebuild"])
+    parser.add_argument("--business-id", type=int)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        days = refresh(db) if args.command == "refresh" else rebuild(db, args.business_id)
+        print(f"Sketched {days} business days")
+    finally:
+        db.close()
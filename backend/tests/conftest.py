@@ -0,0 +1,39 @@
+"""
+Shared fixtures: every test gets its own throwaway SQLite database, and the in-process caches
+are emptied afterwards so ids reused by the next database never hit stale entries.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+import auth, columnar, crud, crud_loyalty_programs
+from database import Base, make_engine
+from routers import extra
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = make_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    Base.metadata.create_all(bind=engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def SessionLocal(engine):
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    for cache in [crud.business_name_cache, auth.token_cache, auth.business_cache, columnar.stores,
+                  extra.dashboard_cache, crud_loyalty_programs.tier_ladder, crud_loyalty_programs.reward_index]:
+        cache.clear()
+
+
+@pytest.fixture
+def db(SessionLocal):
+    session = SessionLocal()
+    yield session
+    session.close()
@@ -0,0 +1,87 @@
+"""
+Checks that the NumPy columnar analytics engine reports the same customer insights and
+distribution as the SQL engine, including after new transactions are appended to its columns.
+"""
+
+import datetime
+import random
+
+import pytest
+from sqlalchemy import insert
+
+import columnar, models
+from routers.extra import customer_distribution, customer_segments
+
+BUSINESS_ID = 1
+PROGRAM_IDS = [1, 2]
+NOW = datetime.datetime.utcnow()
+
+
+@pytest.fixture
+def db(db, monkeypatch):
+    # The tests switch engines; the configured one is put back afterwards
+    monkeypatch.setattr(columnar, "ANALYTICS_ENGINE", columnar.ANALYTICS_ENGINE)
+    db.execute(insert(models.Customer), [
+        {"id": i, "phone_number": f"+26377{i:07d}", "total_points": 0} for i in range(1, 501)
+    ])
+    db.commit()
+    return db
+
+
+def add_transactions(db, rng, count):
+    rows = []
+    for _ in range(count):
+        redemption = rng.random() < 0.15
+        rows.append({
+            "business_id": BUSINESS_ID,
+            "customer_id": rng.randint(1, 500),
+            "loyalty_program_id": rng.choice(PROGRAM_IDS + [None]),
+            "amount_spent": 0.0 if redemption else rng.choice([5.0, 10.0, 12.5, 40.0, 99.99]),
+            "points_earned": -rng.randint(1, 30) if redemption else rng.choice([0, 5, 10]),
+            "transaction_type": models.TransactionType.REDEMPTION if redemption else models.TransactionType.EARN,
+            "timestamp": NOW - datetime.timedelta(seconds=rng.randint(0, 200 * 86400)),
+        })
+    db.execute(insert(models.Transaction), rows)
+    db.commit()
+
+
+def both_engines(compute):
+    results = []
+    for engine in ["sql", "numpy"]:
+        columnar.ANALYTICS_ENGINE = engine
+        results.append(compute())
+    return results
+
+
+def test_engines_agree(db):
+    rng = random.Random(7)
+    since = NOW - datetime.timedelta(days=30)
+    # The second round is appended to the columns loaded by the first
+    for _ in range(2):
+        add_transactions(db, rng, 1500)
+        for program_id in [None] + PROGRAM_IDS:
+            sql, numpy = both_engines(lambda: vars(customer_segments(db, BUSINESS_ID, program_id, since)))
+            assert sql == numpy, (program_id, sql, numpy)
+
+            sql, numpy = both_engines(lambda: customer_distribution(db, BUSINESS_ID, program_id, 8))
+            sql_quantiles, numpy_quantiles = sql.pop("spending_quantiles"), numpy.pop("spending_quantiles")
+            assert sql == numpy, (program_id, sql, numpy)
+            # numpy.quantile interpolates with a different formula, so a quantile can land a cent apart
+            assert sql_quantiles.keys() == numpy_quantiles.keys()
+            assert all(abs(sql_quantiles[q] - numpy_quantiles[q]) <= 0.01 for q in sql_quantiles)
+    assert columnar.stores.get(BUSINESS_ID).size == 3000
+
+
+def test_updates_rebuild_the_columns(db):
+    add_transactions(db, random.Random(11), 500)
+    columnar.ANALYTICS_ENGINE = "numpy"
+    before = customer_distribution(db, BUSINESS_ID, None, 4)
+
+    transaction = db.query(models.Transaction).first()
+    transaction.amount_spent = 100_000.0
+    db.commit()
+    assert columnar.stores.get(BUSINESS_ID) is None
+
+    after = customer_distribution(db, BUSINESS_ID, None, 4)
+    assert after["spending_histogram"][-1]["to"] > before["spending_histogram"][-1]["to"]
+
@@ -0,0 +1,115 @@
+"""
+Checks that a bulk upload mixing program types and invalid rows earns exactly what the same sales
+posted one by one earn, rejects only the invalid rows, and refuses rows of another business.
+"""
+
+import random
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+import crud_loyalty_programs, models, rollups, schemas
+from routers import loyalty_programs
+
+CUSTOMERS = 12
+
+
+@pytest.fixture
+def business(db):
+    """The business with a program of each type (tiers on the tiered one), and another business's program"""
+    business = models.Business(name="Till Store", contact_person="Test", email="bulk@example.com", password_hash="x", loyalty_rate=1.0)
+    other = models.Business(name="Other Store", contact_person="Test", email="other@example.com", password_hash="x", loyalty_rate=1.0)
+    db.add_all([business, other])
+    db.flush()
+    programs = {}
+    for program_type, earn_rate in [
+        (models.LoyaltyProgramType.POINTS, 2.0), (models.LoyaltyProgramType.TIERED, 1.0),
+        (models.LoyaltyProgramType.PAID, 1.0), (models.LoyaltyProgramType.CASHBACK, 5.0),
+    ]:
+        program = models.LoyaltyProgram(business_id=business.id, name=program_type.value, program_type=program_type, earn_rate=earn_rate)
+        db.add(program)
+        db.flush()
+        programs[program_type] = program.id
+    for name, min_points, multiplier in [("Bronze", 0, 1.0), ("Silver", 300, 1.5), ("Gold", 900, 2.0)]:
+        db.add(models.TierLevel(
+            loyalty_program_id=programs[models.LoyaltyProgramType.TIERED], name=name, min_points=min_points, multiplier=multiplier
+        ))
+    foreign = models.LoyaltyProgram(business_id=other.id, name="Theirs", program_type=models.LoyaltyProgramType.POINTS, earn_rate=1.0)
+    db.add(foreign)
+    db.commit()
+    return SimpleNamespace(id=business.id, programs=list(programs.values()) + [None], foreign_program_id=foreign.id)
+
+
+def sales(business, prefix):
+    """The same seeded sequence of sales for customers whose phone numbers start with prefix, as plain dicts"""
+    rng = random.Random(7)
+    return [
+        dict(
+            business_id=business.id, customer_phone_number=f"{prefix}{rng.randrange(CUSTOMERS):04d}",
+            amount_spent=round(rng.uniform(5, 250), 2), loyalty_program_id=rng.choice(business.programs)
+        )
+        for _ in range(150)
+    ]
+
+
+def balances(db, prefix):
+    customers = db.query(models.Customer).filter(models.Customer.phone_number.like(f"{prefix}%")).all()
+    memberships = db.query(models.CustomerMembership).filter(
+        models.CustomerMembership.customer_id.in_([c.id for c in customers])
+    ).all()
+    phones = {c.id: c.phone_number[len(prefix):] for c in customers}
+    return (
+        {phones[c.id]: c.total_points for c in customers},
+        {(phones[m.customer_id], m.loyalty_program_id): (m.points, m.current_tier_id) for m in memberships},
+    )
+
+
+def upload(db, business, rows):
+    return loyalty_programs.process_transactions_bulk(
+        batch=schemas.BulkTransactionCreate(transactions=[schemas.TransactionCreate(**row) for row in rows]),
+        db=db, current_business=business, idempotency_key=None
+    )
+
+
+def test_bulk_matches_single_transactions(db, business):
+    bulk_rows = sales(business, "+26377100")
+    invalid = {3: {"loyalty_program_id": 9999}, 40: {"loyalty_program_id": business.foreign_program_id}, 77: {"amount_spent": 0}}
+    for index, change in invalid.items():
+        bulk_rows[index].update(change)
+    single_rows = [{**row, "customer_phone_number": "+26377200" + row["customer_phone_number"][-4:]} for row in bulk_rows]
+
+    response = upload(db, business, bulk_rows)
+    assert (response["processed"], response["failed"]) == (len(bulk_rows) - len(invalid), len(invalid))
+    assert [r["index"] for r in response["results"] if not r["success"]] == sorted(invalid)
+    assert {response["results"][i]["error"] for i in invalid} == {
+        "Loyalty program not found", "Loyalty program does not belong to this business", "Amount spent must be positive"
+    }
+
+    single_results = []
+    for index, row in enumerate(single_rows):
+        if index in invalid:
+            continue
+        transaction = crud_loyalty_programs.process_transaction(db, schemas.TransactionCreate(**row))
+        single_results.append((transaction.points_earned, transaction.cashback_amount))
+    bulk_results = [(r["points_earned"], r["cashback_amount"]) for r in response["results"] if r["success"]]
+    assert [points for points, _ in bulk_results] == [points for points, _ in single_results]
+    assert [cashback for _, cashback in bulk_results] == pytest.approx([cashback for _, cashback in single_results])
+
+    bulk_totals, bulk_memberships = balances(db, "+26377100")
+    single_totals, single_memberships = balances(db, "+26377200")
+    assert bulk_totals == single_totals
+    assert bulk_memberships == single_memberships
+    # Some customers crossed a tier threshold within the batch
+    assert len({tier for _, tier in bulk_memberships.values() if tier}) > 1
+    assert db.query(models.Transaction).count() == 2 * (len(bulk_rows) - len(invalid))
+    assert rollups.check(db) == []
+
+
+def test_rows_of_another_business_are_refused(db, business):
+    rows = sales(business, "+26377300")[:5]
+    rows[2]["business_id"] = business.id + 1
+    with pytest.raises(HTTPException) as refused:
+        upload(db, business, rows)
+    assert refused.value.status_code == 403
+    assert db.query(models.Transaction).count() == 0
@@ -0,0 +1,107 @@
+"""
+Checks that earned points land in monthly buckets, that redemptions consume the oldest buckets first,
+and that the expiry job expires whole buckets once, keeping the cached balances in step with the ledger
+and never taking a drifted one below 0.
+"""
+
+import datetime
+
+import pytest
+from sqlalchemy import update
+
+import crud_loyalty_programs, expiry, ledger, models, schemas
+
+
+@pytest.fixture
+def db(db, monkeypatch):
+    monkeypatch.setattr(expiry, "POINTS_EXPIRY_MONTHS", 12)
+    return db
+
+
+def buckets(db, customer_id):
+    return [(b.month, b.earned, b.consumed, b.expired, b.closed_at is not None)
+            for b in db.query(models.PointsBucket).filter_by(customer_id=customer_id).order_by(models.PointsBucket.month)]
+
+
+def test_fifo_consumption_and_expiry(db):
+    business = models.Business(name="Expiry Store", contact_person="Test", email="expiry@example.com", password_hash="x")
+    db.add(business)
+    db.flush()
+    program = models.LoyaltyProgram(
+        business_id=business.id, name="Points", program_type=models.LoyaltyProgramType.POINTS, earn_rate=1.0
+    )
+    db.add(program)
+    db.commit()
+
+    def sale(phone, amount):
+        crud_loyalty_programs.process_transaction(db, schemas.TransactionCreate(
+            business_id=business.id, customer_phone_number=phone, amount_spent=amount, loyalty_program_id=program.id
+        ))
+
+    def redeem(phone, points):
+        crud_loyalty_programs.redeem_reward(db, schemas.RedemptionCreate(
+            business_id=business.id, customer_phone_number=phone, points_to_redeem=points,
+            reward_description="Coffee", loyalty_program_id=program.id
+        ))
+
+    sale("+263770000001", 100)
+    sale("+263770000002", 40)
+    # Move the first earnings back into January of last year, as if they had been made then
+    january = datetime.date(2025, 1, 1)
+    db.execute(update(models.PointsLedgerEntry).values(created_at=datetime.datetime(2025, 1, 15)))
+    assert expiry.backfill(db) == 2
+    sale("+263770000001", 50)
+    this_month = expiry.month_start(datetime.datetime.utcnow())
+    assert buckets(db, 1) == [(january, 100, 0, 0, False), (this_month, 50, 0, 0, False)]
+
+    # The oldest bucket pays first, and the rest spills into the next
+    redeem("+263770000001", 30)
+    redeem("+263770000001", 90)
+    assert buckets(db, 1) == [(january, 100, 100, 0, False), (this_month, 50, 20, 0, False)]
+
+    # January's points expire at the start of the following January
+    assert expiry.expire(db, datetime.datetime(2025, 12, 31)).buckets == 0
+    result = expiry.expire(db, datetime.datetime(2026, 1, 2))
+    assert (result.buckets, result.points) == (2, 40)
+    assert buckets(db, 1)[0] == (january, 100, 100, 0, True)
+    assert buckets(db, 2) == [(january, 40, 0, 40, True)]
+    assert db.get(models.Customer, 2).total_points == 0
+    assert expiry.expire(db, datetime.datetime(2026, 1, 3)).buckets == 0
+    drift = ledger.reconcile(db)
+    assert not drift.memberships and not drift.customers
+
+    # Rebuilding from the ledger gives the same open balances
+    before = [row[:3] for row in buckets(db, 1)]
+    assert expiry.backfill(db) == 3
+    assert [row[:3] for row in buckets(db, 1)] == before
+    assert buckets(db, 2) == [(january, 40, 40, 0, False)]
+
+
+
+def test_expiry_floors_drifted_balances(db):
+    business = models.Business(name="Drift Store", contact_person="Test", email="drift@example.com", password_hash="x")
+    db.add(business)
+    db.flush()
+    program = models.LoyaltyProgram(
+        business_id=business.id, name="Points", program_type=models.LoyaltyProgramType.POINTS, earn_rate=1.0
+    )
+    db.add(program)
+    db.commit()
+    for phone in ("+263770000011", "+263770000012"):
+        crud_loyalty_programs.process_transaction(db, schemas.TransactionCreate(
+            business_id=business.id, customer_phone_number=phone, amount_spent=60, loyalty_program_id=program.id
+        ))
+    db.execute(update(models.PointsLedgerEntry).values(created_at=datetime.datetime(2025, 1, 15)))
+    expiry.backfill(db)
+    # Cached balances that lost points outside the ledger: one too low, one NULL
+    first, second = db.query(models.Customer).order_by(models.Customer.id).all()
+    db.execute(update(models.CustomerMembership).where(models.CustomerMembership.customer_id == first.id).values(points=20))
+    db.execute(update(models.Customer).where(models.Customer.id == first.id).values(total_points=20))
+    db.execute(update(models.CustomerMembership).where(models.CustomerMembership.customer_id == second.id).values(points=None))
+    db.execute(update(models.Customer).where(models.Customer.id == second.id).values(total_points=None))
+    db.commit()
+
+    result = expiry.expire(db, datetime.datetime(2026, 1, 2))
+    assert (result.points, result.drift) == (120, 2 * 40 + 2 * 60)
+    db.expire_all()
+    assert [(c.total_points, c.memberships[0].points) for c in (first, second)] == [(0, 0), (0, 0)]
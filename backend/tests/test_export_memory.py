@@ -0,0 +1,82 @@
+"""
+Checks with tracemalloc that the streamed /reports/all_customers export keeps memory flat,
+while building the same result as a list grows with the number of customers.
+"""
+
+import asyncio
+import csv
+import io
+import json
+import tracemalloc
+
+import pytest
+from sqlalchemy import insert
+
+import models
+from routers.extra import all_customers_query, export_all_customers
+
+CUSTOMERS = 100_000
+BUSINESS_ID = 1
+# Generous ceiling for the streamed export; the materialized list needs several times this
+STREAMING_PEAK_LIMIT = 16 * 1024 * 1024
+
+
+@pytest.fixture
+def SessionLocal(SessionLocal, engine):
+    with engine.begin() as conn:
+        conn.execute(insert(models.Customer), [
+            {"id": i, "phone_number": f"+26377{i:07d}", "total_points": 0} for i in range(1, CUSTOMERS + 1)
+        ])
+        conn.execute(insert(models.Transaction), [
+            {"business_id": BUSINESS_ID, "customer_id": i, "amount_spent": 10.0, "points_earned": i % 997}
+            for i in range(1, CUSTOMERS + 1)
+        ])
+    return SessionLocal
+
+
+def consume(response):
+    """Drain a StreamingResponse, keeping only the size and the first chunk"""
+    async def drain():
+        first, size = None, 0
+        async for chunk in response.body_iterator:
+            first = first or chunk
+            size += len(chunk)
+        return first, size
+    return asyncio.run(drain())
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        result = func()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_streamed_exports_stay_bounded(SessionLocal):
+    def materialize():
+        db = SessionLocal()
+        try:
+            rows = all_customers_query(db, BUSINESS_ID, None).all()
+            return [{"phone_number": r[0], "points": r[1]} for r in rows]
+        finally:
+            db.close()
+
+    customers, list_peak = peak_memory(materialize)
+    assert len(customers) == CUSTOMERS
+
+    for format in ["csv", "ndjson"]:
+        (first, size), peak = peak_memory(
+            lambda: consume(export_all_customers(SessionLocal, BUSINESS_ID, None, format))
+        )
+        if format == "csv":
+            rows = list(csv.reader(io.StringIO(first)))
+            assert rows[0] == ["phone_number", "points"]
+            assert int(rows[1][1]) == 996
+        else:
+            assert json.loads(first.splitlines()[0])["points"] == 996
+        assert size > CUSTOMERS * 15
+        assert peak < STREAMING_PEAK_LIMIT, f"{format} export peaked at {peak} bytes"
+        assert peak * 4 < list_peak, f"{format} export peaked at {peak} bytes vs {list_peak} for the list"
+
@@ -0,0 +1,128 @@
+"""
+Checks that concurrent retries with one Idempotency-Key write a single transaction, that a key reused
+for a different request is rejected, and that a failed write gives its key back, even when the process
+dies before it can release the key.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+import crud_loyalty_programs, idempotency, ledger, models, schemas
+from routers import loyalty_programs
+
+PARALLEL_RETRIES = 8
+
+
+@pytest.fixture
+def business(db):
+    business = models.Business(name="Till Store", contact_person="Test", email="till@example.com", password_hash="x", loyalty_rate=1.0)
+    db.add(business)
+    db.flush()
+    program = models.LoyaltyProgram(
+        business_id=business.id, name="Points", program_type=models.LoyaltyProgramType.POINTS, earn_rate=1.0
+    )
+    db.add(program)
+    db.commit()
+    return SimpleNamespace(id=business.id, program_id=program.id)
+
+
+def sale(business, amount=25.0):
+    return schemas.TransactionCreate(
+        business_id=business.id, customer_phone_number="+263770000001", amount_spent=amount,
+        loyalty_program_id=business.program_id
+    )
+
+
+def post_sale(SessionLocal, business, transaction, key):
+    db = SessionLocal()
+    try:
+        return loyalty_programs.process_transaction(
+            transaction=transaction, db=db, current_business=business, idempotency_key=key
+        )
+    finally:
+        db.close()
+
+
+def test_concurrent_retries_write_once(SessionLocal, db, business):
+    start = threading.Barrier(PARALLEL_RETRIES)
+
+    def retry(_):
+        start.wait()
+        try:
+            return post_sale(SessionLocal, business, sale(business), "till-1-receipt-42")
+        except HTTPException as e:
+            assert e.status_code == 409, e.detail
+            return None
+
+    with ThreadPoolExecutor(max_workers=PARALLEL_RETRIES) as pool:
+        responses = list(pool.map(retry, range(PARALLEL_RETRIES)))
+
+    assert db.query(models.Transaction).count() == 1
+    assert db.query(models.CustomerMembership).one().points == 25
+    transaction_id = db.query(models.Transaction.id).scalar()
+    assert all(r["id"] == transaction_id for r in responses if r is not None)
+    # Once the first request has finished, every retry replays its response
+    assert post_sale(SessionLocal, business, sale(business), "till-1-receipt-42")["id"] == transaction_id
+
+
+def test_key_reused_for_a_different_request_is_rejected(SessionLocal, db, business):
+    post_sale(SessionLocal, business, sale(business, 25.0), "receipt-7")
+    with pytest.raises(HTTPException) as rejected:
+        post_sale(SessionLocal, business, sale(business, 30.0), "receipt-7")
+    assert rejected.value.status_code == 422
+    assert db.query(models.Transaction).count() == 1
+    # The same key from another endpoint or caller is a different key
+    assert idempotency.scope("redeem_reward", "business", 7) != idempotency.scope("redeem_reward_public", "customer", 7)
+
+
+def test_failed_write_releases_the_key(SessionLocal, db, business):
+    redemption = schemas.RedemptionCreate(
+        business_id=business.id, customer_phone_number="+263770000001", points_to_redeem=20,
+        reward_description="Coffee", loyalty_program_id=business.program_id
+    )
+
+    def redeem():
+        session = SessionLocal()
+        try:
+            return loyalty_programs.redeem_reward(
+                redemption=redemption, db=session, current_business=business, idempotency_key="redeem-1"
+            )
+        finally:
+            session.close()
+
+    # The customer is created by the sale below, so the first attempt fails
+    with pytest.raises(HTTPException) as failed:
+        redeem()
+    assert failed.value.status_code == 400
+    assert db.query(models.IdempotencyKey).count() == 0
+
+    post_sale(SessionLocal, business, sale(business), "sale-1")
+    assert redeem()["points_earned"] == -20
+    assert redeem()["points_earned"] == -20
+    assert db.query(models.Transaction).filter(
+        models.Transaction.transaction_type == models.TransactionType.REDEMPTION
+    ).count() == 1
+
+
+def test_crash_during_first_sale_of_a_new_customer_keeps_the_key_free(SessionLocal, db, business, monkeypatch):
+    scope = idempotency.scope("process_transaction", "business", business.id)
+
+    def crash(*args, **kwargs):
+        raise RuntimeError("worker killed")
+
+    # The write dies after creating the customer, and nothing gets to release the key
+    session = SessionLocal()
+    assert idempotency.begin(session, scope, "receipt-9", sale(business)) is None
+    monkeypatch.setattr(ledger, "post", crash)
+    with pytest.raises(RuntimeError):
+        crud_loyalty_programs.process_transaction(session, sale(business))
+    session.close()
+    monkeypatch.undo()
+
+    assert db.query(models.IdempotencyKey).count() == 0
+    assert db.query(models.Customer).count() == 0
+    assert post_sale(SessionLocal, business, sale(business), "receipt-9")["points_earned"] == 25
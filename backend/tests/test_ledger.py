@@ -0,0 +1,134 @@
+"""
+Checks that every write path posts to the points ledger, that snapshot-plus-tail balances match the
+cached ones, and that reconciliation finds and repairs drift.
+"""
+
+import random
+
+import pytest
+from sqlalchemy import update
+
+import crud, crud_loyalty_programs, ledger, models, schemas
+from routers import extra
+
+
+@pytest.fixture
+def db(db, monkeypatch):
+    # Snapshots take every entry, however recent
+    monkeypatch.setattr(ledger, "SNAPSHOT_SETTLE_SECONDS", 0)
+    return db
+
+
+def seed_programs(db):
+    business = models.Business(
+        name="Ledger Store", contact_person="Test", email="ledger@example.com", password_hash="x", loyalty_rate=1.0
+    )
+    db.add(business)
+    db.flush()
+    programs = {}
+    for program_type in [models.LoyaltyProgramType.POINTS, models.LoyaltyProgramType.TIERED,
+                         models.LoyaltyProgramType.REFERRAL]:
+        program = models.LoyaltyProgram(business_id=business.id, name=program_type.value, program_type=program_type, earn_rate=2.0)
+        db.add(program)
+        db.flush()
+        programs[program_type] = program.id
+    db.add(models.TierLevel(loyalty_program_id=programs[models.LoyaltyProgramType.TIERED], name="Gold", min_points=100, multiplier=1.5))
+    db.commit()
+    return business.id, programs
+
+
+def assert_in_step(db):
+    result = ledger.reconcile(db)
+    assert not result.memberships and not result.customers, (result.memberships, result.customers)
+    for customer in db.query(models.Customer).all():
+        assert ledger.balance(db, customer.id) == customer.total_points
+        for membership in customer.memberships:
+            assert ledger.balance(db, customer.id, membership.loyalty_program_id) == membership.points
+
+
+def test_write_paths_post_to_the_ledger(db):
+    business_id, programs = seed_programs(db)
+    rng = random.Random(3)
+    phones = [f"+2637700000{i}" for i in range(8)]
+
+    def sale(program_id):
+        return schemas.TransactionCreate(
+            business_id=business_id, customer_phone_number=rng.choice(phones),
+            amount_spent=rng.choice([10.0, 35.5, 80.0]), loyalty_program_id=program_id
+        )
+
+    for round_number in range(3):
+        for _ in range(20):
+            crud_loyalty_programs.process_transaction(db, sale(rng.choice([programs[models.LoyaltyProgramType.POINTS],
+                                                                          programs[models.LoyaltyProgramType.TIERED], None])))
+        crud_loyalty_programs.process_transactions_bulk(db, [sale(programs[models.LoyaltyProgramType.POINTS]) for _ in range(10)])
+        crud.add_points(db, sale(None))
+        crud_loyalty_programs.process_referral(db, schemas.ReferralCreate(
+            referrer_phone_number=phones[0], referred_phone_number=phones[round_number + 1],
+            business_id=business_id, loyalty_program_id=programs[models.LoyaltyProgramType.REFERRAL]
+        ))
+        for phone in phones[:3]:
+            crud_loyalty_programs.redeem_reward(db, schemas.RedemptionCreate(
+                business_id=business_id, customer_phone_number=phone, points_to_redeem=5, reward_description="Coffee",
+                loyalty_program_id=programs[models.LoyaltyProgramType.POINTS]
+            ))
+        crud.redeem_points(db, schemas.RedemptionCreate(
+            business_id=business_id, customer_phone_number=phones[0], points_to_redeem=3, reward_description="Coffee"
+        ))
+        # Balances are snapshot plus tail in every round
+        assert ledger.snapshot(db) > 0
+        assert_in_step(db)
+
+    entry = db.query(models.PointsLedgerEntry).first()
+    entry.points += 1
+    try:
+        db.commit()
+        assert False, "ledger entries must not be updated"
+    except Exception as e:
+        assert "append-only" in str(e)
+        db.rollback()
+
+
+def test_open_and_reconcile_repair(db):
+    business_id, programs = seed_programs(db)
+    program_id = programs[models.LoyaltyProgramType.POINTS]
+    # Balances from before the ledger existed
+    for i in range(1, 51):
+        db.add(models.Customer(id=i, phone_number=f"+26377{i:07d}", total_points=i * 10))
+        db.add(models.CustomerMembership(customer_id=i, loyalty_program_id=program_id, points=i * 4))
+    db.commit()
+    assert len(ledger.reconcile(db).memberships) == 50
+    assert ledger.open_balances(db) == 100
+    assert_in_step(db)
+
+    # Drift: a cached balance changed without an entry, and a customer whose total missed an award
+    db.execute(update(models.CustomerMembership).where(models.CustomerMembership.customer_id == 7).values(points=999))
+    ledger.post(db, 9, None, 25, ledger.ADJUSTMENT)
+    db.commit()
+    result = ledger.reconcile(db, repair=True)
+    assert [row.id for row in result.customers] == [9]
+    assert len(result.memberships) == 1 and result.memberships[0].balance == 28
+    assert (result.repaired_memberships, result.repaired_customers) == (1, 1)
+    assert_in_step(db)
+    assert db.get(models.Customer, 9).total_points == 115
+
+
+
+def test_completed_referral_posts_to_its_program(db):
+    business_id, programs = seed_programs(db)
+    program_id = programs[models.LoyaltyProgramType.REFERRAL]
+    referrer = models.Customer(phone_number="+263771111111", total_points=0)
+    referred = models.Customer(phone_number="+263772222222", total_points=0)
+    db.add_all([referrer, referred])
+    db.flush()
+    referral = models.Referral(
+        referrer_id=referrer.id, referred_id=referred.id, business_id=business_id, loyalty_program_id=program_id, points_awarded=0
+    )
+    db.add(referral)
+    db.commit()
+
+    extra.complete_referral(referral_id=referral.id, points_to_award_referrer=40, db=db)
+    membership = db.query(models.CustomerMembership).filter_by(customer_id=referrer.id, loyalty_program_id=program_id).one()
+    assert (membership.points, db.get(models.Customer, referrer.id).total_points) == (40, 40)
+    assert ledger.balance(db, referrer.id, program_id) == 40
+    assert_in_step(db)
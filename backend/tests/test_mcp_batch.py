@@ -0,0 +1,81 @@
+"""
+Checks that a batch of MCP tool calls looks every customer up once, however many of its tools
+are about the same customers.
+"""
+
+import asyncio
+import datetime
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+import models
+from database import make_async_engine
+from routers import mcp_server
+
+PHONES = ["+263770000001", "+263770000002"]
+TOOLS = ["check_points", "get_recommendations", "get_customer_transactions", "get_analytics"]
+
+
+@pytest.fixture
+def async_engine(engine, db, monkeypatch):
+    business = models.Business(name="Chat Store", contact_person="Test", email="chat@example.com", password_hash="x")
+    db.add(business)
+    db.flush()
+    for i, phone in enumerate(PHONES, start=1):
+        db.add(models.Customer(id=i, phone_number=phone, total_points=40 * i, referral_code=f"CODE{i}"))
+        for days_ago in range(3):
+            db.add(models.Transaction(
+                business_id=business.id, customer_id=i, amount_spent=20.0, points_earned=20,
+                timestamp=datetime.datetime.utcnow() - datetime.timedelta(days=days_ago)
+            ))
+    db.commit()
+    async_engine = make_async_engine(str(engine.url))
+    monkeypatch.setattr(mcp_server, "AsyncSessionLocal", async_sessionmaker(async_engine, expire_on_commit=False, autoflush=False))
+    yield async_engine
+    asyncio.run(async_engine.dispose())
+
+
+def test_batch_looks_each_customer_up_once(async_engine):
+    lookups = []
+
+    @event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+    def count_customer_lookups(conn, cursor, statement, parameters, context, executemany):
+        if "FROM customers" in statement and "phone_number" in statement:
+            lookups.append(statement)
+
+    batch = mcp_server.MCPBatchRequest(requests=[
+        mcp_server.MCPToolRequest(tool=tool, parameters={"phone_number": phone})
+        for phone in PHONES for tool in TOOLS
+    ])
+
+    async def run():
+        async with mcp_server.AsyncSessionLocal() as session:
+            return await mcp_server.execute_mcp_tools_batch(batch, session)
+
+    results = asyncio.run(run()).results
+    assert all(r.success for r in results), [r.error for r in results]
+    assert results[0].data["total_points"] == 40 and results[4].data["total_points"] == 80
+    assert results[1].data["recommendations"]
+    assert len(lookups) == 1, lookups
+
+
+@pytest.mark.parametrize("limit", [0, -5, 2, 3])
+def test_transaction_pages_clamp_the_limit(async_engine, limit):
+    async def page(cursor=None):
+        async with mcp_server.AsyncSessionLocal() as session:
+            return await mcp_server.execute_get_customer_transactions(
+                {"phone_number": PHONES[0], "limit": limit, "cursor": cursor}, session
+            )
+
+    seen = []
+    result = asyncio.run(page())
+    while True:
+        assert result["success"], result
+        seen += [tx["id"] for tx in result["data"]["transactions"]]
+        assert len(result["data"]["transactions"]) <= max(limit, 1)
+        if not result["data"]["next_cursor"]:
+            break
+        result = asyncio.run(page(result["data"]["next_cursor"]))
+    assert len(seen) == len(set(seen)) == 3
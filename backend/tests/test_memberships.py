@@ -0,0 +1,103 @@
+"""
+Checks that the paid-membership sweep expires lapsed memberships and queues exactly one reminder
+of each kind per membership period, however often it runs, counting only the reminders it queued,
+and that a failed sweep leaves neither notices nor flag changes behind.
+"""
+
+import datetime
+
+import pytest
+
+import crud_loyalty_programs, memberships, metrics, models
+
+
+def paid_program(db):
+    business = models.Business(name="Club", contact_person="Test", email="club@example.com", password_hash="x")
+    db.add(business)
+    db.flush()
+    program = models.LoyaltyProgram(
+        business_id=business.id, name="Club", program_type=models.LoyaltyProgramType.PAID,
+        earn_rate=1.0, membership_period_days=30
+    )
+    db.add(program)
+    db.flush()
+    return program
+
+
+def lapsed_member(db, program, customer_id, end):
+    db.add(models.Customer(id=customer_id, phone_number=f"+2637700000{customer_id}", total_points=0))
+    membership = models.CustomerMembership(
+        customer_id=customer_id, loyalty_program_id=program.id, points=0, is_paid_member=True, membership_end=end
+    )
+    db.add(membership)
+    db.flush()
+    return membership
+
+
+def test_sweep_expires_and_queues_reminders(db):
+    program = paid_program(db)
+    now = datetime.datetime.utcnow()
+    # Lapsed, ending within the reminder window, ending later, and never paid
+    ends = [now - datetime.timedelta(days=2), now + datetime.timedelta(days=3), now + datetime.timedelta(days=60), None]
+    for i, end in enumerate(ends, start=1):
+        db.add(models.Customer(id=i, phone_number=f"+2637700000{i}", total_points=0))
+        db.add(models.CustomerMembership(
+            customer_id=i, loyalty_program_id=program.id, points=0, is_paid_member=end is not None, membership_end=end
+        ))
+    db.commit()
+    assert memberships.paid_member_count(db, program.id) == 3
+
+    result = memberships.sweep(db, now)
+    assert (result.expired, result.reminders) == (1, 1)
+    assert memberships.paid_member_count(db, program.id) == 2
+    assert memberships.sweep(db, now).reminders == 0
+    pending = memberships.pending_reminders(db)
+    assert sorted((r.customer_id, r.kind) for r in pending) == [(1, "expired"), (2, "renewal_due")]
+    assert metrics.snapshot()["membership_reminders_pending"] == 2
+
+    # Renewing starts a new period, which gets its own reminder once it comes due
+    memberships.mark_sent(db, [r.id for r in pending])
+    crud_loyalty_programs.enroll_in_paid_membership(db, 2, program.id)
+    assert memberships.sweep(db, now + datetime.timedelta(days=25)).reminders == 1
+    assert memberships.sweep(db, now + datetime.timedelta(days=40)).expired == 1
+    assert memberships.paid_member_count(db, program.id) == 1
+    assert len(memberships.pending_reminders(db)) == 2
+
+
+
+def test_queued_metric_counts_inserted_notices(db):
+    program = paid_program(db)
+    now = datetime.datetime.utcnow()
+    end = now - datetime.timedelta(days=1)
+    noticed = lapsed_member(db, program, 1, end)
+    lapsed_member(db, program, 2, end)
+    # Already noticed for this period, e.g. by a sweep whose flag change was later undone by hand
+    db.add(models.MembershipReminder(
+        membership_id=noticed.id, customer_id=1, loyalty_program_id=program.id, kind="expired", membership_end=end
+    ))
+    db.commit()
+
+    queued = metrics.snapshot().get("membership_reminders_queued_total", 0)
+    result = memberships.sweep(db, now)
+    assert (result.expired, result.notices, result.reminders) == (2, 1, 0)
+    assert metrics.snapshot()["membership_reminders_queued_total"] - queued == 1
+    assert db.query(models.MembershipReminder).count() == 2
+
+
+def test_failed_sweep_leaves_no_notices(db, monkeypatch):
+    program = paid_program(db)
+    now = datetime.datetime.utcnow()
+    lapsed_member(db, program, 1, now - datetime.timedelta(days=1))
+    db.commit()
+
+    def failing_update(*args):
+        raise RuntimeError("connection lost")
+
+    monkeypatch.setattr(memberships, "update", failing_update)
+    with pytest.raises(RuntimeError):
+        memberships.sweep(db, now)
+    assert db.query(models.MembershipReminder).count() == 0
+    assert memberships.paid_member_count(db, program.id) == 1
+
+    monkeypatch.undo()
+    assert memberships.sweep(db, now).notices == 1
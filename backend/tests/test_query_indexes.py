@@ -0,0 +1,62 @@
+"""
+Checks with EXPLAIN QUERY PLAN that the hot query shapes are served by an index
+rather than a full table scan.
+"""
+
+import datetime
+
+import pytest
+from sqlalchemy import func, text
+
+import models
+
+
+def explain(db, query):
+    sql = str(query.statement.compile(db.get_bind(), compile_kwargs={"literal_binds": True}))
+    return [row[-1] for row in db.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+
+
+def assert_uses_index(plan, index_name):
+    assert any(index_name in step for step in plan), plan
+    assert not any(step.startswith("SCAN") and "INDEX" not in step for step in plan), plan
+
+
+@pytest.fixture
+def db(db):
+    # Enough rows for the planner to prefer the indexes
+    db.add_all([
+        models.Transaction(
+            business_id=i % 20, customer_id=i % 500, amount_spent=10, points_earned=10,
+            timestamp=datetime.datetime(2024, 1, 1) + datetime.timedelta(hours=i)
+        )
+        for i in range(5000)
+    ])
+    db.commit()
+    db.execute(text("ANALYZE"))
+    return db
+
+
+def test_customer_history_uses_customer_timestamp_index(db):
+    query = db.query(models.Transaction).filter(
+        models.Transaction.customer_id == 42
+    ).order_by(models.Transaction.timestamp.desc()).limit(5)
+    plan = explain(db, query)
+    assert_uses_index(plan, "ix_transactions_customer_timestamp")
+    assert not any("TEMP B-TREE" in step for step in plan), plan
+
+
+def test_analytics_window_uses_business_timestamp_index(db):
+    query = db.query(func.count(models.Transaction.id)).filter(
+        models.Transaction.business_id == 3,
+        models.Transaction.timestamp >= datetime.datetime(2024, 3, 1)
+    )
+    assert_uses_index(explain(db, query), "ix_transactions_business_timestamp")
+
+
+def test_membership_lookup_uses_unique_index(db):
+    query = db.query(models.CustomerMembership).filter(
+        models.CustomerMembership.customer_id == 42,
+        models.CustomerMembership.loyalty_program_id == 7
+    )
+    assert_uses_index(explain(db, query), "ux_customer_memberships_customer_program")
+
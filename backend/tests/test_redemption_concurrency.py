@@ -0,0 +1,144 @@
+"""
+Stress test for concurrent earns and redemptions against a single customer: redemptions never
+overspend either balance, and no earn or redemption overwrites another's change to total_points.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+import models, schemas, crud, crud_loyalty_programs
+
+TEST_PHONE = "+263771234567"
+STARTING_POINTS = 1000
+POINTS_PER_REDEMPTION = 30
+PARALLEL_REDEMPTIONS = 64
+PARALLEL_EARNS = 32
+
+
+@pytest.fixture
+def ids(db):
+    """business_id, program_id and customer_id of a customer holding STARTING_POINTS in total and in a program"""
+    business = models.Business(
+        name="Test Store", contact_person="Tester", email="store@example.com",
+        password_hash="x", loyalty_rate=1.0
+    )
+    db.add(business)
+    db.flush()
+    program = models.LoyaltyProgram(
+        business_id=business.id, name="Points", program_type=models.LoyaltyProgramType.POINTS,
+        description="Test program", earn_rate=1.0
+    )
+    db.add(program)
+    db.flush()
+    customer = models.Customer(phone_number=TEST_PHONE, total_points=STARTING_POINTS)
+    db.add(customer)
+    db.flush()
+    db.add(models.CustomerMembership(customer_id=customer.id, loyalty_program_id=program.id, points=STARTING_POINTS))
+    db.commit()
+    return SimpleNamespace(business_id=business.id, program_id=program.id, customer_id=customer.id)
+
+
+def redemption(ids, program=True, points=POINTS_PER_REDEMPTION):
+    return schemas.RedemptionCreate(
+        business_id=ids.business_id,
+        customer_phone_number=TEST_PHONE,
+        points_to_redeem=points,
+        reward_description="Free coffee",
+        loyalty_program_id=ids.program_id if program else None
+    )
+
+
+def sale(ids, program=True, amount=10.0):
+    return schemas.TransactionCreate(
+        business_id=ids.business_id,
+        customer_phone_number=TEST_PHONE,
+        amount_spent=amount,
+        loyalty_program_id=ids.program_id if program else None
+    )
+
+
+def fire(SessionLocal, calls):
+    """Run (function, request) calls in parallel sessions; returns which succeeded"""
+    def attempt(call):
+        function, request = call
+        db = SessionLocal()
+        try:
+            function(db, request)
+            return True
+        except Exception as e:
+            assert "Not enough points" in str(e), str(e)
+            return False
+        finally:
+            db.close()
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        return list(pool.map(attempt, calls))
+
+
+def balances(db, ids):
+    db.expire_all()
+    membership = db.query(models.CustomerMembership).filter(models.CustomerMembership.customer_id == ids.customer_id).one()
+    return membership.points, db.get(models.Customer, ids.customer_id).total_points
+
+
+def test_parallel_program_redemptions_never_overspend(SessionLocal, db, ids):
+    succeeded = sum(fire(SessionLocal, [(crud_loyalty_programs.redeem_reward, redemption(ids))] * PARALLEL_REDEMPTIONS))
+    redemptions = db.query(models.Transaction).filter(
+        models.Transaction.transaction_type == models.TransactionType.REDEMPTION
+    ).count()
+
+    assert succeeded == STARTING_POINTS // POINTS_PER_REDEMPTION
+    assert redemptions == succeeded
+    points, total_points = balances(db, ids)
+    assert points == STARTING_POINTS - succeeded * POINTS_PER_REDEMPTION
+    assert total_points == points
+
+
+def test_parallel_legacy_redemptions_never_overspend(SessionLocal, db, ids):
+    succeeded = sum(fire(SessionLocal, [(crud.redeem_points, redemption(ids, program=False))] * PARALLEL_REDEMPTIONS))
+
+    assert succeeded == STARTING_POINTS // POINTS_PER_REDEMPTION
+    assert db.query(models.Transaction).count() == succeeded
+    assert balances(db, ids)[1] == STARTING_POINTS - succeeded * POINTS_PER_REDEMPTION
+
+
+def test_parallel_earns_and_redemptions_lose_no_updates(SessionLocal, db, ids):
+    calls = []
+    for _ in range(PARALLEL_EARNS):
+        calls += [
+            (crud.add_points, sale(ids, program=False)),
+            (crud_loyalty_programs.process_transaction, sale(ids)),
+            (crud_loyalty_programs.process_transaction, sale(ids, program=False)),
+            (crud.redeem_points, redemption(ids, program=False, points=5)),
+            (crud_loyalty_programs.redeem_reward, redemption(ids, points=5)),
+        ]
+    outcomes = fire(SessionLocal, calls)
+    assert all(outcomes)
+
+    points, total_points = balances(db, ids)
+    assert points == STARTING_POINTS + PARALLEL_EARNS * (10 - 5)
+    assert total_points == STARTING_POINTS + PARALLEL_EARNS * (3 * 10 - 2 * 5)
+
+
+def test_program_redemption_is_guarded_by_the_total_too(db, ids):
+    # A total below the program balance, e.g. after legacy redemptions made outside the program
+    crud.redeem_points(db, redemption(ids, program=False, points=STARTING_POINTS - 20))
+    with pytest.raises(Exception) as rejected:
+        crud_loyalty_programs.redeem_reward(db, redemption(ids))
+    assert "Not enough points" in str(rejected.value)
+    assert balances(db, ids) == (STARTING_POINTS, 20)
+
+
+def test_legacy_redemption_reports_the_current_balance(SessionLocal, db, ids):
+    # Loaded before another session spends most of the points
+    customer = db.query(models.Customer).filter(models.Customer.id == ids.customer_id).one()
+    assert customer.total_points == STARTING_POINTS
+    other = SessionLocal()
+    crud.redeem_points(other, redemption(ids, program=False, points=STARTING_POINTS - 20))
+    other.close()
+
+    with pytest.raises(Exception) as rejected:
+        crud.redeem_points(db, redemption(ids, program=False))
+    assert "Customer has 20 points" in str(rejected.value)
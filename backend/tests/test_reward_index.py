@@ -0,0 +1,62 @@
+"""
+Checks that the reward index picks up reward changes made through this process at once, and changes
+made by another process (written straight to the database, so no ORM events fire here) once its
+entries expire.
+"""
+
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import update
+
+import cache, crud_loyalty_programs, models
+
+PHONE = "+263770000001"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(cache, "time", SimpleNamespace(monotonic=lambda: now.value))
+    return now
+
+
+@pytest.fixture
+def program(db):
+    business = models.Business(name="Reward Store", contact_person="Test", email="rewards@example.com", password_hash="x")
+    db.add(business)
+    db.flush()
+    program = models.LoyaltyProgram(business_id=business.id, name="Points", program_type=models.LoyaltyProgramType.POINTS)
+    db.add(program)
+    db.flush()
+    customer = models.Customer(phone_number=PHONE, total_points=300)
+    db.add(customer)
+    db.flush()
+    db.add(models.CustomerMembership(customer_id=customer.id, loyalty_program_id=program.id, points=300))
+    for name, points_required in [("Coffee", 100), ("Lunch", 500)]:
+        db.add(models.Reward(loyalty_program_id=program.id, name=name, points_required=points_required))
+    db.commit()
+    return program.id
+
+
+def affordable(db):
+    return sorted(item["reward"].name for item in crud_loyalty_programs.get_available_rewards_for_customer(db, PHONE))
+
+
+def test_changes_in_this_process_apply_at_once(db, program, clock):
+    assert affordable(db) == ["Coffee"]
+    db.query(models.Reward).filter(models.Reward.name == "Lunch").one().points_required = 250
+    db.commit()
+    assert affordable(db) == ["Coffee", "Lunch"]
+
+
+def test_changes_from_another_process_apply_after_the_ttl(engine, db, program, clock):
+    assert affordable(db) == ["Coffee"]
+    with engine.begin() as other_process:
+        other_process.execute(update(models.Reward.__table__).where(models.Reward.name == "Lunch").values(points_required=250))
+        other_process.execute(update(models.Reward.__table__).where(models.Reward.name == "Coffee").values(is_active=False))
+
+    clock.value += crud_loyalty_programs.PROGRAM_CACHE_TTL_SECONDS - 1
+    assert affordable(db) == ["Coffee"]
+    clock.value += 1
+    assert affordable(db) == ["Lunch"]
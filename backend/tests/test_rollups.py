@@ -0,0 +1,191 @@
+"""
+Checks that the hourly rollups kept by the flush listener match a backfill of the same transactions
+through inserts, updates and deletes, that windows with partial hours add up to the raw rows, and
+that the analytics endpoints report the numbers the raw transactions give, also in local time in
+a zone whose UTC offset isn't a whole number of hours.
+"""
+
+import datetime
+import random
+from collections import Counter, defaultdict
+from zoneinfo import ZoneInfo
+
+import pytest
+from sqlalchemy import update
+
+import models, rollups
+from routers import extra
+
+BUSINESS_ID = 1
+OTHER_BUSINESS_ID = 2
+PROGRAMS = [None, 1, 2]
+
+
+def rollup_rows(db):
+    rollup = models.TransactionRollup
+    return {
+        (row.business_id, row.loyalty_program_id, row.bucket_start): tuple(getattr(row, m) for m in rollups.MEASURES)
+        for row in db.query(rollup)
+        if any(getattr(row, m) for m in rollups.MEASURES)
+    }
+
+
+def near_boundary(timestamp, now):
+    return any(abs(timestamp - (now - datetime.timedelta(days=days))) < datetime.timedelta(minutes=5) for days in (30, 60, 180))
+
+
+@pytest.fixture
+def transactions(db):
+    rng = random.Random(11)
+    now = datetime.datetime.utcnow()
+    rows = []
+    while len(rows) < 600:
+        timestamp = now - datetime.timedelta(seconds=rng.randrange(200 * 86400))
+        if near_boundary(timestamp, now):
+            continue
+        redemption = rng.random() < 0.15
+        amount = 0.0 if redemption else round(rng.uniform(1, 150), 2)
+        rows.append(models.Transaction(
+            business_id=rng.choice([BUSINESS_ID, BUSINESS_ID, OTHER_BUSINESS_ID]),
+            customer_id=rng.randrange(1, 80),
+            loyalty_program_id=rng.choice(PROGRAMS),
+            amount_spent=amount,
+            points_earned=-rng.randrange(10, 60) if redemption else int(amount),
+            transaction_type=models.TransactionType.REDEMPTION if redemption else models.TransactionType.EARN,
+            timestamp=timestamp,
+        ))
+    # Several flushes, so later ones add to rows the earlier ones created
+    for start in range(0, len(rows), 150):
+        db.add_all(rows[start:start + 150])
+        db.commit()
+    return rows
+
+
+def test_incremental_rollups_match_backfill(db, transactions):
+    incremental = rollup_rows(db)
+    assert rollups.check(db) == []
+    rollups.backfill(db)
+    assert rollup_rows(db) == incremental
+
+
+def test_updates_and_deletes_move_the_totals(db, transactions):
+    moved, edited, removed = transactions[:3]
+    moved.timestamp -= datetime.timedelta(days=3, minutes=17)
+    moved.business_id = OTHER_BUSINESS_ID if moved.business_id == BUSINESS_ID else BUSINESS_ID
+    edited.amount_spent += 12.5
+    edited.points_earned += 12
+    db.delete(removed)
+    db.commit()
+    # Objects expired by the commit are reloaded before the listener reads their previous values
+    transactions[3].loyalty_program_id = 2 if transactions[3].loyalty_program_id != 2 else None
+    db.delete(transactions[4])
+    db.commit()
+
+    assert rollups.check(db) == []
+    incremental = rollup_rows(db)
+    rollups.backfill(db)
+    assert rollup_rows(db) == incremental
+
+
+def test_bulk_statements_need_a_backfill(db, transactions):
+    db.execute(update(models.Transaction).where(models.Transaction.id <= 10).values(amount_spent=models.Transaction.amount_spent + 1))
+    db.commit()
+    assert rollups.check(db)
+    for business_id in (BUSINESS_ID, OTHER_BUSINESS_ID):
+        rollups.backfill(db, business_id)
+    assert rollups.check(db) == []
+
+
+def test_partial_hour_windows_match_raw(db, transactions):
+    now = datetime.datetime.utcnow()
+    hour = rollups.bucket_start(now) - datetime.timedelta(hours=5)
+    windows = [
+        (None, None),
+        (now - datetime.timedelta(days=30), None),
+        (now - datetime.timedelta(days=60, minutes=7), now - datetime.timedelta(days=30, minutes=41)),
+        # Both ends on hour boundaries: no edges at all
+        (hour - datetime.timedelta(days=20), hour - datetime.timedelta(days=5)),
+        # Inside a single hour
+        (hour + datetime.timedelta(minutes=10), hour + datetime.timedelta(minutes=50)),
+    ]
+    assert rollups.edge_filters(BUSINESS_ID, None, *windows[3]) == []
+    assert len(rollups.edge_filters(BUSINESS_ID, None, *windows[4])) == 1
+    assert len(rollups.edge_filters(BUSINESS_ID, None, *windows[2])) == 2
+
+    for program in (None, 1):
+        for since, until in windows:
+            selected = [
+                t for t in transactions
+                if t.business_id == BUSINESS_ID and (program is None or t.loyalty_program_id == program)
+                and (since is None or t.timestamp >= since) and (until is None or t.timestamp < until)
+            ]
+            totals = rollups.totals(db, BUSINESS_ID, program, since, until)
+            assert totals.transaction_count == len(selected)
+            assert totals.revenue == pytest.approx(sum(t.amount_spent for t in selected))
+            assert totals.points_issued == sum(max(t.points_earned, 0) for t in selected)
+
+
+def test_endpoints_match_raw_transactions(db, transactions):
+    now = datetime.datetime.utcnow()
+    own = [t for t in transactions if t.business_id == BUSINESS_ID]
+    redemptions = [t for t in own if t.transaction_type == models.TransactionType.REDEMPTION]
+    sales = [t for t in own if t.amount_spent > 0]
+
+    assert extra.total_points_issued(business_id=BUSINESS_ID, loyalty_program_id=None, db=db) == {
+        "total_points_issued": sum(t.points_earned for t in own if t.points_earned > 0)
+    }
+    assert extra.total_redemptions(business_id=BUSINESS_ID, loyalty_program_id=None, db=db) == {
+        "total_redemptions": -sum(t.points_earned for t in redemptions)
+    }
+
+    revenue = extra.revenue_stats(business_id=BUSINESS_ID, loyalty_program_id=None, tz="UTC", db=db)
+    monthly = defaultdict(float)
+    for t in own:
+        if t.timestamp >= now - datetime.timedelta(days=180):
+            monthly[t.timestamp.strftime("%Y-%m")] += t.amount_spent
+    assert revenue["total_revenue"] == pytest.approx(sum(t.amount_spent for t in own))
+    assert revenue["average_transaction"] == pytest.approx(sum(t.amount_spent for t in sales) / len(sales))
+    assert [m["month"] for m in revenue["monthly_revenue"]] == sorted(monthly)
+    for month in revenue["monthly_revenue"]:
+        assert month["revenue"] == pytest.approx(monthly[month["month"]])
+
+    health = extra.business_health(business_id=BUSINESS_ID, loyalty_program_id=None, tz="UTC", db=db, approx=False)
+    assert health["transactions_this_month"] == sum(t.timestamp >= now - datetime.timedelta(days=30) for t in own)
+    assert health["transactions_last_month"] == sum(
+        now - datetime.timedelta(days=60) <= t.timestamp < now - datetime.timedelta(days=30) for t in own
+    )
+    hours = Counter(t.timestamp.hour for t in own if t.timestamp >= now - datetime.timedelta(days=30))
+    assert sorted(peak["count"] for peak in health["peak_hours"]) == sorted(hours.values())[-3:]
+    for peak in health["peak_hours"]:
+        assert hours[peak["hour"]] == peak["count"]
+
+
+def test_endpoints_bucket_half_hour_zones_exactly(db):
+    """Sales in the first minutes of a local hour and month in India (UTC+5:30) land in that hour and month"""
+    business_id = 3
+    zone = ZoneInfo("Asia/Kolkata")
+    local_now = datetime.datetime.now(zone)
+    month_start = local_now.replace(day=1, hour=0, minute=15, second=0, microsecond=0)
+    just_after_midnight = (local_now - datetime.timedelta(days=1)).replace(hour=0, minute=15, second=0, microsecond=0)
+    moments = [month_start] + [just_after_midnight + datetime.timedelta(minutes=i) for i in range(3)]
+    timestamps = [moment.astimezone(datetime.timezone.utc).replace(tzinfo=None) for moment in moments]
+    db.add_all([
+        models.Transaction(business_id=business_id, customer_id=1, amount_spent=10.0 * (i + 1), points_earned=10, timestamp=timestamp)
+        for i, timestamp in enumerate(timestamps)
+    ])
+    db.commit()
+    now = datetime.datetime.utcnow()
+    local = [(t.replace(tzinfo=datetime.timezone.utc).astimezone(zone), 10.0 * (i + 1)) for i, t in enumerate(timestamps)]
+
+    revenue = extra.revenue_stats(business_id=business_id, loyalty_program_id=None, tz="Asia/Kolkata", db=db)
+    monthly = defaultdict(float)
+    for moment, amount in local:
+        monthly[moment.strftime("%Y-%m")] += amount
+    assert {m["month"]: m["revenue"] for m in revenue["monthly_revenue"]} == pytest.approx(dict(monthly))
+
+    health = extra.business_health(business_id=business_id, loyalty_program_id=None, tz="Asia/Kolkata", db=db, approx=False)
+    hours = Counter(
+        moment.hour for (moment, _), t in zip(local, timestamps) if t >= now - datetime.timedelta(days=30)
+    )
+    assert {peak["hour"]: peak["count"] for peak in health["peak_hours"]} == dict(hours)
+    assert health["peak_hours"][0]["hour"] == 0
@@ -0,0 +1,85 @@
+"""
+Checks the HyperLogLog and t-digest sketches stay within their stated error bounds when merged
+across days, that refresh keeps the daily sketches in step with new transactions, and that a business
+without sketches yet gets exact answers.
+"""
+
+import datetime
+
+import numpy as np
+from sqlalchemy import insert
+
+import models, sketches
+from routers.extra import customer_count, customer_insights
+
+BUSINESS_ID = 1
+
+
+def test_merged_hyperloglog_within_bound():
+    rng = np.random.default_rng(3)
+    ids = rng.choice(10 ** 9, 20_000, replace=False)
+    merged = sketches.HyperLogLog()
+    # Overlapping days: every id shows up on two of them
+    for day in np.array_split(np.concatenate([ids, rng.permutation(ids)]), 30):
+        sketch = sketches.HyperLogLog()
+        sketch.add(day.tolist())
+        merged.merge(sketches.HyperLogLog.from_bytes(sketch.to_bytes()))
+    assert abs(merged.count() / len(ids) - 1) <= merged.relative_error()
+
+    small = sketches.HyperLogLog()
+    small.add(range(1, 51))
+    assert small.count() == 50
+
+
+def test_merged_tdigest_within_bound():
+    values = np.random.default_rng(5).lognormal(3, 1, 100_000)
+    digests = []
+    for day in np.array_split(values, 365):
+        digest = sketches.TDigest()
+        digest.add(day.tolist())
+        digests.append(sketches.TDigest.from_bytes(digest.to_bytes()))
+    merged = sketches.TDigest.merge_all(digests)
+    ordered = np.sort(values)
+    assert merged.total == len(values)
+    for q in sketches.PERCENTILES:
+        rank = np.searchsorted(ordered, merged.quantile(q)) / len(values)
+        assert abs(rank - q) <= merged.rank_error(q), (q, rank)
+
+
+def test_refresh_and_approximate_endpoints(db):
+    now = datetime.datetime.utcnow()
+    db.execute(insert(models.Customer), [
+        {"id": i, "phone_number": f"+26377{i:07d}", "total_points": 0} for i in range(1, 3001)
+    ])
+
+    def add_transactions(customer_ids, days_ago):
+        db.execute(insert(models.Transaction), [
+            {
+                "business_id": BUSINESS_ID, "customer_id": customer_id, "amount_spent": float(customer_id % 100 + 1),
+                "points_earned": 1, "timestamp": now - datetime.timedelta(days=days_ago, minutes=customer_id % 600)
+            }
+            for customer_id in customer_ids
+        ])
+        db.commit()
+
+    add_transactions(range(1, 2001), 90)
+    add_transactions(range(1001, 2001), 45)
+    # Before the first refresh there are no sketches, so the exact answer stands in
+    assert customer_count(BUSINESS_ID, None, db=db, approx=True) == {"customer_count": 2000}
+    assert "approximate" not in customer_insights(BUSINESS_ID, None, db=db, approx=True)
+    first_days = sketches.refresh(db)
+    assert first_days >= 2
+    approx = customer_count(BUSINESS_ID, None, db=db, approx=True)
+    assert customer_count(BUSINESS_ID, None, db=db, approx=False)["customer_count"] == 2000
+    assert abs(approx["customer_count"] / 2000 - 1) <= approx["error_bounds"]["customers_relative_error"]
+
+    # Only the days of the new transactions are sketched on the next refresh, and the estimates follow them
+    add_transactions(range(2001, 3001), 0)
+    assert 1 <= sketches.refresh(db) < first_days + 2
+    approx = customer_insights(BUSINESS_ID, None, db=db, approx=True)
+    bound = approx["error_bounds"]["customers_relative_error"]
+    assert abs(approx["active_customers_this_month"] / 1000 - 1) <= bound
+    assert abs(approx["high_value_customers"] / (3000 // 5 + 1) - 1) <= bound
+    assert approx["approximate"] is True and approx["as_of"] is not None
+    assert 40 <= approx["sale_amount_percentiles"]["p50"] <= 60
+
@@ -0,0 +1,102 @@
+"""
+Checks that tiered sales and the set-based tier recalculation agree with calculate_customer_tier,
+and that editing a program's tier levels takes effect on the next sale, or once the cached ladder
+expires when the edit was made by another process.
+"""
+
+import random
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import update
+
+import cache, crud_loyalty_programs, models, schemas, tiers
+
+
+@pytest.fixture
+def program(db):
+    """(business_id, program_id) of a tiered program with Bronze, Silver and Gold levels"""
+    business = models.Business(
+        name="Tier Store", contact_person="Test", email="tiers@example.com", password_hash="x", loyalty_rate=1.0
+    )
+    db.add(business)
+    db.flush()
+    program = models.LoyaltyProgram(
+        business_id=business.id, name="Tiers", program_type=models.LoyaltyProgramType.TIERED, earn_rate=1.0
+    )
+    db.add(program)
+    db.flush()
+    for name, min_points, multiplier in [("Bronze", 0, 1.0), ("Silver", 500, 1.25), ("Gold", 2000, 1.5)]:
+        db.add(models.TierLevel(loyalty_program_id=program.id, name=name, min_points=min_points, multiplier=multiplier))
+    db.commit()
+    return business.id, program.id
+
+
+def sale(business_id, program_id, customer, amount):
+    return schemas.TransactionCreate(
+        business_id=business_id, customer_phone_number=f"+26377{customer:07d}",
+        amount_spent=amount, loyalty_program_id=program_id
+    )
+
+
+def tier_name(db, membership):
+    return db.get(models.TierLevel, membership.current_tier_id).name if membership.current_tier_id else None
+
+
+def test_sales_use_pre_earn_multiplier_and_tier_edits(db, program):
+    business_id, program_id = program
+    first = crud_loyalty_programs.process_transaction(db, sale(business_id, program_id, 1, 600))
+    assert first.points_earned == 600 and db.get(models.TierLevel, first.tier_id).name == "Bronze"
+    # The multiplier of the tier held before the sale applies
+    second = crud_loyalty_programs.process_transaction(db, sale(business_id, program_id, 1, 100))
+    assert second.points_earned == 125
+    membership = db.query(models.CustomerMembership).one()
+    assert membership.points == 725 and tier_name(db, membership) == "Silver"
+
+    silver = db.query(models.TierLevel).filter(models.TierLevel.name == "Silver").one()
+    silver.multiplier = 2.0
+    db.commit()
+    third = crud_loyalty_programs.process_transaction(db, sale(business_id, program_id, 1, 100))
+    assert third.points_earned == 200
+
+
+def test_recalculation_matches_calculate_customer_tier(db, program):
+    business_id, program_id = program
+    rng = random.Random(5)
+    for customer in range(1, 301):
+        crud_loyalty_programs.process_transaction(db, sale(business_id, program_id, customer, rng.choice([50, 400, 1500])))
+    for customer in range(1, 301, 3):
+        crud_loyalty_programs.process_transaction(db, sale(business_id, program_id, customer, 900))
+
+    # Members only below the new lowest threshold lose their tier
+    for name, min_points in [("Bronze", 100), ("Silver", 1000)]:
+        db.query(models.TierLevel).filter(models.TierLevel.name == name).one().min_points = min_points
+    db.commit()
+    result = tiers.recalculate_program(db, program_id, chunk_size=64)
+    assert result.members == 300 and result.moved > 0
+
+    memberships = db.query(models.CustomerMembership).all()
+    recalculated = {m.customer_id: tier_name(db, m) for m in memberships}
+    for m in memberships:
+        expected = crud_loyalty_programs.calculate_customer_tier(db, m.customer_id, program_id)
+        assert recalculated[m.customer_id] == (expected.name if expected else None)
+    assert tiers.recalculate_program(db, program_id).moved == 0
+
+
+
+def test_tier_edits_from_another_process_apply_after_the_ttl(engine, db, program, monkeypatch):
+    business_id, program_id = program
+    clock = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(cache, "time", SimpleNamespace(monotonic=lambda: clock.value))
+    crud_loyalty_programs.process_transaction(db, sale(business_id, program_id, 1, 600))
+    assert crud_loyalty_programs.calculate_customer_tier(db, 1, program_id).name == "Silver"
+
+    # Written straight to the database, so no ORM events reach this process's ladder
+    with engine.begin() as other_process:
+        tier_levels = models.TierLevel.__table__
+        other_process.execute(update(tier_levels).where(tier_levels.c.name == "Silver").values(min_points=700))
+
+    clock.value += crud_loyalty_programs.PROGRAM_CACHE_TTL_SECONDS - 1
+    assert crud_loyalty_programs.calculate_customer_tier(db, 1, program_id).name == "Silver"
+    clock.value += 1
+    assert crud_loyalty_programs.calculate_customer_tier(db, 1, program_id).name == "Bronze"
@@ -0,0 +1,98 @@
+"""
+Checks the SQLite time buckets against Python's zoneinfo for timestamps on both sides of spring-forward
+and fall-back transitions, a zone that switches on the half hour, and a local week boundary.
+"""
+
+import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+from sqlalchemy import insert
+
+import models, timebuckets
+
+UTC = datetime.timezone.utc
+HOUR = datetime.timedelta(hours=1)
+MINUTE = datetime.timedelta(minutes=1)
+
+# Naive UTC moments of the transitions in 2024
+TRANSITIONS = {
+    "Europe/London": [datetime.datetime(2024, 3, 31, 1), datetime.datetime(2024, 10, 27, 1)],
+    "America/New_York": [datetime.datetime(2024, 3, 10, 7), datetime.datetime(2024, 11, 3, 6)],
+    "Australia/Lord_Howe": [datetime.datetime(2024, 4, 6, 15), datetime.datetime(2024, 10, 5, 15, 30)],
+}
+# Sunday 23:59 and Monday 00:00 in Harare (UTC+2)
+WEEK_BOUNDARY = [datetime.datetime(2024, 5, 5, 21, 59), datetime.datetime(2024, 5, 5, 22, 0)]
+
+
+def around(moment):
+    return [moment - HOUR, moment - MINUTE, moment, moment + MINUTE, moment + HOUR]
+
+
+def expected(moment, zone):
+    local = moment.replace(tzinfo=UTC).astimezone(zone)
+    monday = local.date() - datetime.timedelta(days=local.weekday())
+    return {
+        "local": local.strftime("%Y-%m-%d %H:%M:%S"),
+        "hour": local.strftime("%Y-%m-%d %H:00"),
+        "day": local.strftime("%Y-%m-%d"),
+        "week": monday.isoformat(),
+        "month": local.strftime("%Y-%m"),
+        "hour_of_day": local.hour,
+    }
+
+
+def bucketed(db, moments, tz):
+    db.execute(insert(models.Transaction), [
+        {"business_id": 1, "customer_id": 1, "amount_spent": 1.0, "points_earned": 1, "timestamp": moment}
+        for moment in moments
+    ])
+    timestamp = models.Transaction.timestamp
+    window = {"since": min(moments), "until": max(moments) + HOUR}
+    rows = db.query(
+        timestamp,
+        timebuckets.local_time(db, timestamp, tz, **window),
+        *[timebuckets.truncate(db, timestamp, unit, tz, **window) for unit in ["hour", "day", "week", "month"]],
+        timebuckets.hour_of_day(db, timestamp, tz, **window),
+    ).order_by(models.Transaction.id).all()
+    return {
+        row[0]: dict(zip(["local", "hour", "day", "week", "month", "hour_of_day"], row[1:]))
+        for row in rows
+    }
+
+
+@pytest.mark.parametrize("tz", sorted(TRANSITIONS))
+def test_buckets_match_zoneinfo_across_transitions(db, tz):
+    moments = [moment for transition in TRANSITIONS[tz] for moment in around(transition)]
+    results = bucketed(db, moments, tz)
+    zone = ZoneInfo(tz)
+    for moment in moments:
+        assert results[moment] == expected(moment, zone), moment
+
+
+def test_week_starts_on_local_monday(db):
+    results = bucketed(db, WEEK_BOUNDARY, "Africa/Harare")
+    assert [results[moment]["week"] for moment in WEEK_BOUNDARY] == ["2024-04-29", "2024-05-06"]
+    zone = ZoneInfo("Africa/Harare")
+    for moment in WEEK_BOUNDARY:
+        assert results[moment] == expected(moment, zone)
+
+
+def test_utc_offset_periods():
+    spring, autumn = TRANSITIONS["Europe/London"]
+    periods = timebuckets.utc_offset_periods(ZoneInfo("Europe/London"), datetime.datetime(2024, 1, 1), datetime.datetime(2025, 1, 1))
+    assert periods == [(None, datetime.timedelta(0)), (spring, HOUR), (autumn, datetime.timedelta(0))]
+
+    lord_howe = timebuckets.utc_offset_periods(
+        ZoneInfo("Australia/Lord_Howe"), datetime.datetime(2024, 1, 1), datetime.datetime(2025, 1, 1)
+    )
+    assert [start for start, _ in lord_howe[1:]] == TRANSITIONS["Australia/Lord_Howe"]
+    assert [offset for _, offset in lord_howe] == [HOUR * 11, HOUR * 10.5, HOUR * 11]
+
+
+def test_whole_hour_offsets():
+    year = {"since": datetime.datetime(2024, 1, 1), "until": datetime.datetime(2025, 1, 1)}
+    assert all(timebuckets.whole_hour_offsets(tz, **year) for tz in [None, "UTC", "Europe/London", "America/New_York"])
+    # Half-hour offsets all year, or only outside daylight saving time
+    assert not any(timebuckets.whole_hour_offsets(tz, **year) for tz in ["Asia/Kolkata", "Asia/Kathmandu", "America/St_Johns", "Australia/Lord_Howe"])
+    assert timebuckets.whole_hour_offsets("Australia/Lord_Howe", datetime.datetime(2024, 1, 1), datetime.datetime(2024, 3, 1))
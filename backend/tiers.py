@@ -0,0 +1,94 @@
+"""
+Bulk tier recalculation for whole loyalty programs.
+After a program's tier thresholds change, or points are loaded from elsewhere, every membership's
+current tier is recomputed with one UPDATE ... CASE per chunk of memberships instead of a tier
+lookup per customer. Only memberships whose tier actually changes are written.
+
+Usage: python tiers.py recalculate --program-id N    recompute one program's tiers
+       python tiers.py recalculate --business-id N   recompute the tiers of a business's tiered programs
+       python tiers.py recalculate                   recompute every tiered program
+"""
+
+import argparse
+from types import SimpleNamespace
+
+from sqlalchemy import case, func, null, update
+from sqlalchemy.orm import Session
+
+import models
+from crud_loyalty_programs import tier_ladder
+
+# Memberships per UPDATE: each chunk commits, so sales in the program are never blocked for long
+CHUNK_SIZE = 50_000
+
+
+def tier_expression(db: Session, program_id: int):
+    """CASE giving the id of the highest tier a membership's points qualify for (NULL below the lowest)"""
+    thresholds, tiers = tier_ladder.load(db, {program_id})[program_id]
+    if not tiers:
+        return null()
+    points = func.coalesce(models.CustomerMembership.points, 0)
+    # Highest threshold first, so the first match is the highest tier reached
+    return case(
+        *[(points >= threshold, tier.id) for threshold, tier in reversed(list(zip(thresholds, tiers)))],
+        else_=null()
+    )
+
+
+def recalculate_program(db: Session, program_id: int, chunk_size: int = CHUNK_SIZE):
+    """Recompute current_tier_id for every member of a program; returns the member and moved counts"""
+    membership = models.CustomerMembership
+    # Read the tiers fresh, in case they were edited outside this process
+    tier_ladder.invalidate(program_id)
+    new_tier = tier_expression(db, program_id)
+
+    members, first_id, last_id = db.query(
+        func.count(membership.id), func.min(membership.id), func.max(membership.id)
+    ).filter(membership.loyalty_program_id == program_id).one()
+
+    moved = 0
+    if members:
+        for start in range(first_id, last_id + 1, chunk_size):
+            result = db.execute(
+                update(membership)
+                .where(
+                    membership.loyalty_program_id == program_id,
+                    membership.id >= start,
+                    membership.id < start + chunk_size,
+                    membership.current_tier_id.is_distinct_from(new_tier),
+                )
+                .values(current_tier_id=new_tier)
+                .execution_options(synchronize_session=False)
+            )
+            moved += result.rowcount
+            db.commit()
+    return SimpleNamespace(program_id=program_id, members=members, moved=moved)
+
+
+def recalculate(db: Session, program_id: int = None, business_id: int = None):
+    """Recalculate one program, the tiered programs of one business, or every tiered program"""
+    query = db.query(models.LoyaltyProgram.id).filter(
+        models.LoyaltyProgram.program_type == models.LoyaltyProgramType.TIERED
+    )
+    if program_id is not None:
+        query = query.filter(models.LoyaltyProgram.id == program_id)
+    if business_id is not None:
+        query = query.filter(models.LoyaltyProgram.business_id == business_id)
+    return [recalculate_program(db, pid) for pid, in query.order_by(models.LoyaltyProgram.id).all()]
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("command", choices=["recalculate"])
+    parser.add_argument("--program-id", type=int)
+    parser.add_argument("--business-id", type=int)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        for result in recalculate(db, args.program_id, args.business_id):
+            print(f"Program {result.program_id}: {result.moved} of {result.members} members moved tier")
+    finally:
+        db.close()
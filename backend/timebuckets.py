@@ -0,0 +1,117 @@
+"""
+Dialect-neutral time bucketing for the analytics queries.
+Each helper returns an SQL expression, so grouping happens in the database on SQLite and PostgreSQL alike.
+Timestamps are stored as naive UTC; passing tz buckets them by the local time of that IANA timezone.
+"""
+
+import datetime
+from typing import Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from sqlalchemy import Integer, case, cast, func
+from sqlalchemy.orm import Session
+
+# strftime/to_char formats for the label of each bucket; weeks are labelled by their Monday
+BUCKET_FORMATS = {
+    "hour": ("%Y-%m-%d %H:00", "YYYY-MM-DD HH24:00"),
+    "day": ("%Y-%m-%d", "YYYY-MM-DD"),
+    "week": ("%Y-%m-%d", "YYYY-MM-DD"),
+    "month": ("%Y-%m", "YYYY-MM"),
+}
+
+
+def dialect_name(db: Session) -> str:
+    return db.get_bind().dialect.name
+
+
+def validate_timezone(tz: str) -> ZoneInfo:
+    """The ZoneInfo for an IANA name such as 'Africa/Harare'; raises ValueError for unknown names"""
+    try:
+        return ZoneInfo(tz)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown timezone: {tz}")
+
+
+def utc_offset_periods(zone: ZoneInfo, since: datetime.datetime, until: datetime.datetime):
+    """[(start, offset)] for every UTC offset the zone uses between since and until (naive UTC); start is None for the first"""
+    def offset_at(moment):
+        return moment.replace(tzinfo=datetime.timezone.utc).astimezone(zone).utcoffset()
+
+    periods = [(None, offset_at(since))]
+    moment = since.replace(minute=0, second=0, microsecond=0)
+    while moment < until:
+        moment += datetime.timedelta(hours=1)
+        offset = offset_at(moment)
+        if offset != periods[-1][1]:
+            # A few zones switch on the half or quarter hour, so pin down the quarter it happened in
+            start = moment
+            while offset_at(start - datetime.timedelta(minutes=15)) == offset:
+                start -= datetime.timedelta(minutes=15)
+            periods.append((start, offset))
+    return periods
+
+
+def whole_hour_offsets(tz: Optional[str], since: Optional[datetime.datetime] = None,
+                       until: Optional[datetime.datetime] = None) -> bool:
+    """
+    Whether every UTC offset tz uses within [since, until) is a whole number of hours, so hourly UTC
+    buckets (such as the rollups) fall entirely into one local hour, day and month
+    """
+    if not tz or tz == "UTC":
+        return True
+    until = until or datetime.datetime.utcnow()
+    periods = utc_offset_periods(validate_timezone(tz), since or until, until)
+    return all(offset % datetime.timedelta(hours=1) == datetime.timedelta(0) for _, offset in periods)
+
+
+def _sqlite_shift(column, offset: datetime.timedelta):
+    minutes = int(offset.total_seconds() // 60)
+    return func.datetime(column, f"{minutes:+d} minutes") if minutes else func.datetime(column)
+
+
+def local_time(db: Session, column, tz: Optional[str] = None,
+               since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None):
+    """
+    The timestamp column converted to local time in tz. PostgreSQL converts with its own timezone
+    database; SQLite shifts by the zone's UTC offsets, switching at the DST transitions within
+    [since, until) (the offset in effect at until, or now, is used throughout when since is omitted).
+    """
+    if not tz or tz == "UTC":
+        return column
+    zone = validate_timezone(tz)
+    if dialect_name(db) != "sqlite":
+        return func.timezone(tz, func.timezone("UTC", column))
+    until = until or datetime.datetime.utcnow()
+    periods = utc_offset_periods(zone, since or until, until)
+    if len(periods) == 1:
+        return _sqlite_shift(column, periods[0][1])
+    whens = [
+        (column < start, _sqlite_shift(column, previous_offset))
+        for (_, previous_offset), (start, _) in zip(periods, periods[1:])
+    ]
+    return case(*whens, else_=_sqlite_shift(column, periods[-1][1]))
+
+
+def hour_of_day(db: Session, column, tz: Optional[str] = None,
+                since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None):
+    """Hour of the timestamp (0-23) as an integer, in local time when tz is given"""
+    local = local_time(db, column, tz, since, until)
+    if dialect_name(db) == "sqlite":
+        return cast(func.strftime("%H", local), Integer)
+    return cast(func.extract("hour", local), Integer)
+
+
+def truncate(db: Session, column, unit: str, tz: Optional[str] = None,
+             since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None):
+    """Label of the hour, day, week or month the timestamp falls in, e.g. '2024-05' for a month"""
+    if unit not in BUCKET_FORMATS:
+        raise ValueError(f"Unsupported bucket unit: {unit}")
+    sqlite_format, postgres_format = BUCKET_FORMATS[unit]
+    local = local_time(db, column, tz, since, until)
+    if dialect_name(db) == "sqlite":
+        if unit == "week":
+            # Back to the Monday on or before the date
+            return func.date(local, "weekday 0", "-6 days")
+        return func.strftime(sqlite_format, local)
+    return func.to_char(func.date_trunc(unit, local), postgres_format)
+
@@ -137,6 +137,24 @@ Remember: You have real access to customer data through tools - use them!`;
         }
     }
 
+    // Execute several tool calls concurrently through the MCP batch endpoint
+    async executeTools(toolCalls) {
+        try {
+            const response = await axios.post(`${this.backendUrl}/mcp/tools/batch`, {
+                requests: toolCalls.map(toolCall => ({
+                    tool: toolCall.name,
+                    parameters: toolCall.args || {},
+                    context: {}
+                }))
+            });
+            
+            return response.data.results;
+        } catch (error) {
+            console.error('Error executing batched tools, falling back to single calls:', error);
+            return Promise.all(toolCalls.map(toolCall => this.executeTool(toolCall.name, toolCall.args)));
+        }
+    }
+
     // Tool implementations
     async checkPoints(phoneNumber) {
         try {
@@ -322,20 +340,22 @@ Remember: You have real access to customer data through tools - use them!`;
             
             // Handle tool calls
             if (response.functionCalls && response.functionCalls.length > 0) {
-                const toolCall = response.functionCalls[0];
-                console.log('Tool call requested:', toolCall.name, toolCall.args);
+                const toolCalls = response.functionCalls;
+                console.log('Tool calls requested:', toolCalls.map(call => call.name));
                 
-                // Execute the tool
-                const toolResult = await this.executeTool(toolCall.name, toolCall.args);
-                console.log('Tool result:', toolResult);
+                // Execute the tools, batching several calls into one round-trip
+                const toolResults = toolCalls.length > 1
+                    ? await this.executeTools(toolCalls)
+                    : [await this.executeTool(toolCalls[0].name, toolCalls[0].args)];
+                console.log('Tool results:', toolResults);
                 
-                // Send tool result back to the model
-                const toolResponse = await chat.sendMessage([{
+                // Send tool results back to the model
+                const toolResponse = await chat.sendMessage(toolCalls.map((toolCall, index) => ({
                     functionResponse: {
                         name: toolCall.name,
-                        response: toolResult
+                        response: toolResults[index]
                     }
-                }]);
+                })));
                 
                 const finalResponse = await toolResponse.response;
                 const finalText = finalResponse.text();
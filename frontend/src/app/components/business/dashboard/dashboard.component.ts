@@ -111,16 +111,11 @@ export class DashboardComponent implements OnInit, OnDestroy {
     const id = this.business.id;
     const programId = this.selectedLoyaltyProgramId || undefined;
     
-    Promise.all([
-      this.reportService.getRevenueStats(id, programId).toPromise(),
-      this.reportService.getCustomerInsights(id, programId).toPromise(),
-      this.reportService.getLoyaltyPerformance(id, programId).toPromise(),
-      this.reportService.getBusinessHealth(id, programId).toPromise()
-    ]).then(([revenue, customer, loyalty, health]) => {
-      this.revenueStats = revenue!;
-      this.customerInsights = customer!;
-      this.loyaltyPerformance = loyalty!;
-      this.businessHealth = health!;
+    this.reportService.getDashboard(id, programId).toPromise().then(dashboard => {
+      this.revenueStats = dashboard!.revenue_stats;
+      this.customerInsights = dashboard!.customer_insights;
+      this.loyaltyPerformance = dashboard!.loyalty_performance;
+      this.businessHealth = dashboard!.business_health;
       
       // Create charts after data is loaded
       setTimeout(() => {
@@ -33,6 +33,14 @@ export interface BusinessHealth {
   peak_hours: { hour: number; count: number }[];
 }
 
+export interface AnalyticsDashboard {
+  revenue_stats: RevenueStats;
+  customer_insights: CustomerInsights;
+  loyalty_performance: LoyaltyPerformance;
+  business_health: BusinessHealth;
+  generated_at: string;
+}
+
 @Injectable({ providedIn: 'root' })
 export class ReportService {
   private apiUrl = environment.apiUrl;
@@ -104,4 +112,11 @@ export class ReportService {
     }
     return this.http.get<BusinessHealth>(`${this.apiUrl}/analytics/business_health`, { params });
   }
+  getDashboard(businessId: number, loyaltyProgramId?: number): Observable<AnalyticsDashboard> {
+    const params: any = { business_id: businessId };
+    if (loyaltyProgramId) {
+      params.loyalty_program_id = loyaltyProgramId;
+    }
+    return this.http.get<AnalyticsDashboard>(`${this.apiUrl}/analytics/dashboard`, { params });
+  }
 }